@@ -0,0 +1,116 @@
+"""
+What-if evaluation of a checker over its history.  Every minute a requirement
+line would have been checked in a date range is evaluated against the stored
+results, to see how often (and when) it would have alerted.  Handy when tuning
+MINNUM/MAXNUM.  Nothing is written to the checks table and no handlers are called.
+
+The checker's timestamps are loaded once for the whole range, and every window
+is then counted against that sorted list in memory, rather than a query per minute.
+"""
+
+import argparse
+import datetime
+import time
+
+import dwmon
+
+
+def evaluate_history(checker_name, requirements_list, start_epoch, end_epoch):
+    """
+    Evaluates each set of parsed requirements at every scheduled minute in
+    [start_epoch, end_epoch].  Returns one list of check details (the same
+    dicts do_single_history_check makes) per set of requirements.
+    """
+    longest_lookback = max(x["lookback_seconds"] for x in requirements_list)
+    timestamps = dwmon._get_event_timestamps(
+        checker_name, start_epoch - longest_lookback, end_epoch)
+    all_check_details = []
+    for requirements in requirements_list:
+        minute_epochs = dwmon.matching_minutes(requirements, start_epoch, end_epoch)
+        event_counts = dwmon.count_in_windows(
+            timestamps, minute_epochs, requirements["lookback_seconds"])
+        all_check_details.append([
+            dwmon._make_check_details(checker_name, minute_epoch, requirements, event_count)
+            for minute_epoch, event_count in zip(minute_epochs, event_counts)
+        ])
+    return all_check_details
+
+
+def summarize(check_details):
+    """How one requirement line would have fared"""
+    counts = sorted(x["event_count"] for x in check_details)
+    bad_minutes = [x for x in check_details if x["check_status"] == "BAD"]
+    # Runs of consecutive BAD checks - each one is an alert somebody would have gotten
+    bad_runs = 0
+    previous_status = "GOOD"
+    for details in check_details:
+        if details["check_status"] == "BAD" and previous_status != "BAD":
+            bad_runs += 1
+        previous_status = details["check_status"]
+    summary = {
+        "minutes_checked": len(check_details),
+        "good": len(check_details) - len(bad_minutes),
+        "bad": len(bad_minutes),
+        "bad_runs": bad_runs,
+        "min_count": counts[0] if counts else None,
+        "median_count": counts[len(counts) // 2] if counts else None,
+        "max_count": counts[-1] if counts else None,
+    }
+    return summary
+
+
+def _parse_when(value):
+    """An epoch, or a local date/time like 2016-02-20 or 2016-02-20T13:45"""
+    if value.isdigit():
+        return int(value)
+    for date_format in ["%Y-%m-%d", "%Y-%m-%dT%H:%M"]:
+        try:
+            parsed = datetime.datetime.strptime(value, date_format)
+        except ValueError:
+            continue
+        return int(time.mktime(parsed.timetuple()))
+    raise argparse.ArgumentTypeError("Can't make sense of time %s" % value)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", required=True, help="checker name")
+    parser.add_argument("--start", type=_parse_when,
+                        help="epoch or local date to start at, defaults to --days ago")
+    parser.add_argument("--end", type=_parse_when, help="epoch or local date to end at, defaults to now")
+    parser.add_argument("--days", type=int, default=30, help="how far back to go without --start")
+    parser.add_argument("-r", action="append",
+                        help="a requirements line to try instead of the config's, can be repeated")
+    parser.add_argument("--summary-only", action="store_true", help="skip the per-minute lines")
+    args = parser.parse_args()
+
+    end_epoch = args.end or int(time.time())
+    start_epoch = args.start or end_epoch - args.days * 24 * 3600
+    if args.r:
+        requirements_strings = args.r
+        requirements_list = [dwmon.parse_requirements(x) for x in args.r]
+    else:
+        _, requirements_list, _ = dwmon.parse_config_file(args.c)
+        requirements_strings = ["line %s" % (i + 1) for i in range(len(requirements_list))]
+
+    start_time = time.time()
+    all_check_details = evaluate_history(args.c, requirements_list, start_epoch, end_epoch)
+
+    if not args.summary_only:
+        print("requirements|minute_epoch|minute_local_time|event_count|status")
+        for requirements_string, check_details in zip(requirements_strings, all_check_details):
+            for details in check_details:
+                print("%s|%s|%s|%s|%s" % (
+                    requirements_string, details["minute_epoch"], details["minute_local_time"],
+                    details["event_count"], details["check_status"]))
+        print("")
+
+    print("requirements|minutes_checked|good|bad|bad_runs|min_count|median_count|max_count")
+    for requirements_string, check_details in zip(requirements_strings, all_check_details):
+        summary = summarize(check_details)
+        print("%s|%s|%s|%s|%s|%s|%s|%s" % (
+            requirements_string, summary["minutes_checked"], summary["good"], summary["bad"],
+            summary["bad_runs"], summary["min_count"], summary["median_count"],
+            summary["max_count"]))
+    print("# evaluated in %s seconds" % round(time.time() - start_time, 3))
@@ -0,0 +1,265 @@
+"""
+Benchmarks for dwmon.  A synthetic load (N checkers with M requirement lines
+each, over K rows of history in fake_records.py's tables) is generated into
+throwaway sqlite files, the main phases of a cycle are timed against it, and
+the results are printed as JSON so runs can be compared between commits.
+The cycle can be run against either storage engine (see STORAGE_ENGINE in
+config.py).
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sqlite3
+import string
+import subprocess
+import tempfile
+import time
+
+import dwmon
+import fake_records
+
+# Lookbacks handed out to the requirement lines, in turn
+LOOKBACKS = [60, 180, 300, 600, 900, 1800, 3600]
+
+
+def random_key(rand, key_length):
+    """A random key like the long text keys people feed us"""
+    return "".join(rand.choice(string.ascii_letters + string.digits) for _ in range(key_length))
+
+
+def _fresh_db(tmp_dir, name):
+    """Points dwmon at a brand new database file in tmp_dir, and a fresh storage engine"""
+    dwmon.close_connection()
+    dwmon.reset_storage_engine()
+    dwmon.DB_NAME = os.path.join(tmp_dir, name)
+    dwmon.create_tables()
+    return dwmon.DB_NAME
+
+
+def _db_size(db_name):
+    """Size on disk once the WAL has been folded back in"""
+    dwmon._get_rows_from_query("PRAGMA wal_checkpoint(TRUNCATE)", ())
+    return os.path.getsize(db_name)
+
+
+def bench_key_storage(num_rows, key_length, seed=0):
+    """
+    Ingests the same num_rows random keys with plain and with hashed key
+    storage, then ingests them all again (all duplicates), timing both and
+    measuring the database file each time.
+    """
+    rand = random.Random(seed)
+    start_epoch = int(time.time()) - num_rows
+    rows = [(random_key(rand, key_length), start_epoch + i) for i in range(num_rows)]
+    results = {"num_rows": num_rows, "key_length": key_length}
+    tmp_dir = tempfile.mkdtemp()
+    old_db_name = dwmon.DB_NAME
+    try:
+        for mode, hashed_keys in [("plain", False), ("hashed", True)]:
+            db_name = _fresh_db(tmp_dir, mode + ".db")
+            start_time = time.time()
+            dwmon.store_results("bench", rows, hashed_keys)
+            ingest_seconds = time.time() - start_time
+            start_time = time.time()
+            dwmon.store_results("bench", rows, hashed_keys)
+            duplicate_seconds = time.time() - start_time
+            results[mode] = {
+                "ingest_seconds": round(ingest_seconds, 4),
+                "duplicate_ingest_seconds": round(duplicate_seconds, 4),
+                "db_bytes": _db_size(db_name),
+            }
+    finally:
+        dwmon.close_handler_dispatcher()
+        dwmon.close_connection()
+        dwmon.DB_NAME = old_db_name
+        shutil.rmtree(tmp_dir)
+    return results
+
+
+class SourceRowGetter(object):
+    """
+    Plays your_orgs_row_getter, running checker queries against the fake
+    source database.  Hands back the cursor so rows stream into dwmon.
+    """
+
+    def __init__(self, source_db_name):
+        self.source_db_name = source_db_name
+
+    def get_rows_from_query(self, query_details):
+        source_conn = sqlite3.connect(self.source_db_name, check_same_thread=False)
+        return source_conn.cursor().execute(query_details["query"], query_details["params"])
+
+
+class NullCheckHandler(object):
+    """Plays your_orgs_check_handler, doing nothing"""
+
+    def handle_check(self, details, extra_config):
+        pass
+
+
+class FixedRowPurger(object):
+    """Plays your_orgs_row_purger, with one cutoff for everybody"""
+
+    def __init__(self, delete_older_than_epoch):
+        self.delete_older_than_epoch = delete_older_than_epoch
+
+    def identify_old(self, checker_name, extra_config):
+        return {"delete_older_than_epoch": self.delete_older_than_epoch}
+
+
+def _timed(func, *args, **kwargs):
+    """(whatever func returns, how many seconds it took)"""
+    start_time = time.time()
+    result = func(*args, **kwargs)
+    return result, round(time.time() - start_time, 4)
+
+
+def _write_configs(configs_folder, num_checkers, num_requirements):
+    """One incremental checker per fake model, each with num_requirements lines"""
+    for i in range(num_checkers):
+        requirements = "\n".join(
+            "CHECKHOURS0-23 CHECKMINUTES0-59 WEEKDAYS WEEKENDS MINNUM0 MAXNUM1000000 "
+            "LOOKBACKSECONDS%s" % LOOKBACKS[j % len(LOOKBACKS)]
+            for j in range(num_requirements)
+        )
+        with open(os.path.join(configs_folder, "model_%s.dwmon" % i), "w") as f_handle:
+            f_handle.write(
+                "__QUERY__\n"
+                "SELECT execution_id AS dwmon_unique_key, ts AS dwmon_timestamp\n"
+                "FROM model_executions WHERE model_name = 'model_%s' AND ts > ?\n"
+                "__REQUIREMENTS__\n%s\n"
+                "__SOURCE__\nFAKE_SQLITE\n"
+                "__EXTRA__\n{\"dwmon_incremental\": true}\n" % (i, requirements)
+            )
+
+
+def bench_cycle(num_checkers, num_requirements, num_rows, history_hours, seed=0,
+                storage_engine="sqlite"):
+    """
+    Times, against num_rows of history spread over num_checkers checkers:
+    storing all of it, one do_multiple_history_check, a full check_all catch-up
+    cycle, the steady state cycle a minute later, and a retention pass
+    purging the older half.
+    """
+    tmp_dir = tempfile.mkdtemp()
+    old_db_name = dwmon.DB_NAME
+    old_configs_folder = dwmon.CONFIGS_FOLDER
+    old_storage_engine = dwmon.config.STORAGE_ENGINE
+    dwmon.config.STORAGE_ENGINE = storage_engine
+    old_journal_path = dwmon.config.HANDLER_JOURNAL_PATH
+    dwmon.config.HANDLER_JOURNAL_PATH = os.path.join(tmp_dir, "handler_journal.jsonl")
+    now = int(time.time()) // 60 * 60
+    history_start = now - history_hours * 3600
+    results = {
+        "num_checkers": num_checkers,
+        "num_requirements": num_requirements,
+        "num_rows": num_rows,
+        "history_hours": history_hours,
+        "storage_engine": storage_engine,
+        "events_per_minute_per_checker": round(
+            float(num_rows) / num_checkers / (history_hours * 60), 3),
+    }
+    timings = {}
+    try:
+        source_db_name = os.path.join(tmp_dir, "source.db")
+        source_conn = sqlite3.connect(source_db_name)
+        fake_records.create_tables(source_conn)
+        model_names = ["model_%s" % i for i in range(num_checkers)]
+        _, timings["generate_source_rows"] = _timed(
+            fake_records.bulk_fake_executions, num_rows, history_start, now, model_names,
+            conn=source_conn, seed=seed)
+        source_conn.close()
+
+        dwmon.CONFIGS_FOLDER = os.path.join(tmp_dir, "configs")
+        os.mkdir(dwmon.CONFIGS_FOLDER)
+        _write_configs(dwmon.CONFIGS_FOLDER, num_checkers, num_requirements)
+        _fresh_db(tmp_dir, "dwmon.db")
+        row_getter = SourceRowGetter(source_db_name)
+        dwmon.your_orgs_row_getter = row_getter
+        dwmon.your_orgs_check_handler = NullCheckHandler()
+        dwmon.your_orgs_row_purger = FixedRowPurger(history_start + history_hours * 1800)
+
+        # Ingest everything the way the first fetch of each checker would
+        start_time = time.time()
+        for checker_name in model_names:
+            query_details, _, extra_config = dwmon.load_checker_config(checker_name)
+            prepared = dwmon.prepare_query_details(checker_name, query_details, extra_config)
+            with dwmon.get_storage_engine().transaction():
+                newest_timestamp = dwmon.store_results(
+                    checker_name, row_getter.get_rows_from_query(prepared))
+                dwmon.advance_watermark(checker_name, newest_timestamp)
+        timings["store_results"] = round(time.time() - start_time, 4)
+        results["store_rows_per_second"] = int(num_rows / max(timings["store_results"], 1e-6))
+
+        query_details, requirements, extra_config = dwmon.load_checker_config(model_names[0])
+        checks, timings["do_multiple_history_check"] = _timed(
+            dwmon.do_multiple_history_check, model_names[0], query_details,
+            requirements[-1], extra_config)
+        results["do_multiple_history_check_minutes"] = len(checks)
+        # Leave that checker as it was for the cycle
+        dwmon.get_storage_engine().delete_checks(model_names[0], now + 60)
+
+        _, timings["check_all_catch_up"] = _timed(dwmon.check_all, None, now)
+        results["checks_after_catch_up"] = sum(
+            len(dwmon.get_storage_engine().get_checked_minutes(x)) for x in model_names)
+        _, timings["check_all_steady_state"] = _timed(dwmon.check_all, None, now + 60)
+        _, timings["handler_drain"] = _timed(dwmon.get_handler_dispatcher().join)
+
+        retention, timings["retention"] = _timed(dwmon.run_retention, now + 60)
+        results["retention_results_deleted"] = retention["results_deleted"]
+    finally:
+        dwmon.close_handler_dispatcher()
+        dwmon.close_connection()
+        dwmon.DB_NAME = old_db_name
+        dwmon.CONFIGS_FOLDER = old_configs_folder
+        dwmon.config.STORAGE_ENGINE = old_storage_engine
+        dwmon.config.HANDLER_JOURNAL_PATH = old_journal_path
+        dwmon.reset_storage_engine()
+        shutil.rmtree(tmp_dir)
+    results["seconds"] = timings
+    return results
+
+
+def _git_commit():
+    """The commit being benchmarked, if we can tell"""
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--checkers", type=int, default=20, help="number of checkers")
+    parser.add_argument("--requirements", type=int, default=3,
+                        help="requirement lines per checker")
+    parser.add_argument("--rows", type=int, default=500000, help="rows of history in total")
+    parser.add_argument("--history-hours", type=int, default=24,
+                        help="how far back the history goes")
+    parser.add_argument("--storage-engine", default="sqlite",
+                        choices=sorted(dwmon.STORAGE_ENGINES),
+                        help="which storage engine to run the cycle against")
+    parser.add_argument("--key-storage", action="store_true",
+                        help="also compare plain and hashed key storage")
+    parser.add_argument("--key-length", type=int, default=60,
+                        help="key length for --key-storage")
+    parser.add_argument("--output", help="write the JSON here as well as to stdout")
+    args = parser.parse_args()
+
+    report = {
+        "commit": _git_commit(),
+        "started": int(time.time()),
+        "cycle": bench_cycle(args.checkers, args.requirements, args.rows, args.history_hours,
+                             storage_engine=args.storage_engine),
+    }
+    if args.key_storage:
+        report["key_storage"] = bench_key_storage(args.rows, args.key_length)
+    report_json = json.dumps(report, indent=2, sort_keys=True)
+    print(report_json)
+    if args.output:
+        with open(args.output, "w") as f_handle:
+            f_handle.write(report_json + "\n")
@@ -3,3 +3,90 @@ Keeps some configuration for dwmon.  Maybe could go into environment variables b
 """
 
 SQLITE_DB_NAME = 'dwmon.db'
+
+# Where results and the checks log are kept: "sqlite" (SQLITE_DB_NAME) or "memory", which
+# keeps them in the process and loses them when it exits - for tests and benchmarks.
+STORAGE_ENGINE = "sqlite"
+
+# How many result rows go into a single INSERT batch when storing results
+STORE_BATCH_SIZE = 5000
+
+# sqlite connection tuning.  We keep one connection per thread open for the life of the process.
+SQLITE_BUSY_TIMEOUT_SECONDS = 30
+SQLITE_CACHE_KB = 65536
+
+# Row getters run on a pool of threads so one slow query doesn't hold up every other checker.
+FETCH_WORKERS = 8
+# At most this many queries run against any one __SOURCE__ at once.  Override per source below,
+# e.g. {"AWS": 4}
+FETCH_CONCURRENCY_PER_SOURCE = 2
+FETCH_CONCURRENCY_OVERRIDES = {}
+# A query running longer than this is reported as timed out and its checker skipped for the cycle
+FETCH_TIMEOUT_SECONDS = 45
+# Same for a query that spends this long waiting for a free worker / source slot
+FETCH_QUEUE_TIMEOUT_SECONDS = 90
+# Fetch workers pull rows off the row getter's results STORE_BATCH_SIZE at a time, and can get
+# at most this many batches ahead of them being stored
+FETCH_BUFFER_BATCHES = 4
+
+# Incremental checkers re-fetch this far behind their watermark to catch late arriving rows.
+# Can be overridden per checker with "dwmon_watermark_overlap_seconds" in __EXTRA__.
+WATERMARK_OVERLAP_SECONDS = 300
+
+# Checkers with "dwmon_adaptive_fetch": true in __EXTRA__ wait at least this many times their
+# usual query latency between fetches, doubled for every fetch in a row that failed, but never
+# more than FETCH_ADAPTIVE_MAX_INTERVAL_SECONDS.  See plan_fetch in dwmon.py.
+FETCH_ADAPTIVE_LATENCY_MULTIPLIER = 10
+FETCH_ADAPTIVE_MAX_INTERVAL_SECONDS = 1800
+
+# The scheduler wakes this long after each minute boundary, giving rows stamped right at
+# the boundary a moment to land.
+SCHEDULER_WAKE_DELAY_SECONDS = 1
+
+# Retention (purging old results through your_orgs_row_purger, and old check logs) runs as its
+# own pass this often, deleting this many rows per transaction.
+RETENTION_INTERVAL_SECONDS = 3600
+RETENTION_BATCH_SIZE = 5000
+# How long to keep the log of which minutes were checked.  A checker's latest check is always kept.
+CHECKS_RETENTION_SECONDS = 30 * 24 * 3600
+# Free pages to give back to the filesystem after each retention pass.  Needs a database with
+# incremental auto_vacuum, which new ones have.  0 turns it off.
+RETENTION_INCREMENTAL_VACUUM_PAGES = 2000
+
+# Per-phase timings and counters (see metrics.py).  Set a path to have them written out in
+# Prometheus' text format after every cycle, e.g. for node_exporter's textfile collector, and/or
+# a port to serve them at http://METRICS_HTTP_HOST:METRICS_HTTP_PORT/metrics.
+METRICS_TEXTFILE_PATH = None
+METRICS_HTTP_PORT = None
+METRICS_HTTP_HOST = "127.0.0.1"
+
+# Check details are handed to your_orgs_check_handler by this many worker threads (0 calls it
+# inline, as dwmon used to), in batches of up to HANDLER_BATCH_SIZE.  See handler_dispatch.py.
+HANDLER_WORKERS = 2
+HANDLER_BATCH_SIZE = 100
+# Details waiting for a worker.  Past this many, new ones just wait in the journal (and are fed
+# back in later) rather than holding up checks.
+HANDLER_QUEUE_SIZE = 10000
+# Every detail is written here before its check is committed, and crossed off once handled
+HANDLER_JOURNAL_PATH = "dwmon_handler_journal.jsonl"
+# A failing handler call is retried this many times, HANDLER_RETRY_DELAY_SECONDS later,
+# then twice that, and so on.  Details it still fails on are appended to HANDLER_FAILED_PATH.
+HANDLER_MAX_RETRIES = 3
+HANDLER_RETRY_DELAY_SECONDS = 5
+HANDLER_FAILED_PATH = "dwmon_handler_failed.jsonl"
+# How long to give the workers to finish up when dwmon stops
+HANDLER_SHUTDOWN_TIMEOUT_SECONDS = 30
+
+# When running several workers (--worker-id), each holds its checkers for this long between
+# renewals.  A worker that dies loses its checkers to the others after about this long, so it
+# should comfortably exceed a cycle.
+WORKER_LEASE_SECONDS = 180
+
+# Set to 24 * 3600 (daily) or 7 * 24 * 3600 (weekly, starting Mondays UTC) to store results in a
+# table per day/week, so retention can drop a whole table instead of deleting rows one by one.
+# Move an existing database's results over with python dwmon.py --partition-results.
+RESULTS_PARTITION_SECONDS = None
+
+# Snapshot exports (snapshot.py) stop this far short of now, so results that land a little late
+# still go in.  Later ones than that need a --full export.
+SNAPSHOT_SETTLE_SECONDS = 3600
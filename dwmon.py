@@ -4,19 +4,65 @@ It calls out to some custom defined "row getters" and "check handlers".
 It makes determinations about whether or not events are meeting their config'ed behavior.
 """
 
+import argparse
+import bisect
+import concurrent.futures
+import contextlib
 import datetime
+import hashlib
+import heapq
+import itertools
 import json
 import logging
 import os
 import math
+import queue
 import re
 import sqlite3
+import struct
+import threading
 import time
 
 import config
+import handler_dispatch
+import metrics
 
 DB_NAME = config.SQLITE_DB_NAME
 CONFIGS_FOLDER = "./checker_configs"
+STORE_BATCH_SIZE = config.STORE_BATCH_SIZE
+
+MINUTES_PER_WEEK = 7 * 24 * 60
+# Results partitions line up with weeks starting on a Monday (1970-01-05), as well as with days
+_PARTITION_ORIGIN = 4 * 24 * 3600
+# The unix epoch fell on a Thursday, and weekday() counts Monday as 0
+_EPOCH_WEEKDAY = 3
+# The parts of the requirements that make up the time pattern
+_SCHEDULE_FIELDS = (
+    "check_hours_lower", "check_hours_upper", "check_minutes_lower",
+    "check_minutes_upper", "check_minutes_star", "include_weekdays", "include_weekends",
+)
+# Compiled schedules by time pattern, see compile_schedule
+_SCHEDULE_CACHE = {}
+
+# Holds each thread's sqlite connection and transaction nesting depth
+_THREAD_STATE = threading.local()
+
+# Parsed checker configs by path, see load_checker_config
+_CONFIG_CACHE = {}
+
+# Row getters run on this pool, throttled per __SOURCE__
+_FETCH_POOL = None
+_SOURCE_SEMAPHORES = {}
+_SOURCE_SEMAPHORES_LOCK = threading.Lock()
+
+# Check details reach your_orgs_check_handler through this, see get_handler_dispatcher
+_HANDLER_DISPATCHER = None
+
+# WindowIndex by checker name, for checkers with "dwmon_window_index": true
+_WINDOW_INDEXES = {}
+
+# Where results and checks are kept, see get_storage_engine
+_STORAGE_ENGINE = None
 
 # Strings used in the config format
 QUERY_SENTINEL = "__QUERY__"
@@ -47,12 +93,21 @@ def pull_sections_from_config(config_as_string):
     }
 
 
+def _config_path(checker_name):
+    """Where a checker's config lives"""
+    return CONFIGS_FOLDER + "/" + checker_name + ".dwmon"
+
+
 def parse_config_file(checker_name):
     """Parses our custom config format"""
 
-    with open(CONFIGS_FOLDER + "/" + checker_name + ".dwmon") as f_handle:
+    with open(_config_path(checker_name)) as f_handle:
         config_as_string = f_handle.read()
+    return parse_config_string(config_as_string, checker_name)
 
+
+def parse_config_string(config_as_string, checker_name):
+    """Parses the contents of a config file"""
     assert QUERY_SENTINEL in config_as_string, "Expected %s" \
         % QUERY_SENTINEL
     assert REQUIREMENTS_SENTINEL in config_as_string, "Expected %s" \
@@ -84,87 +139,1187 @@ def parse_config_file(checker_name):
     return (query_details, requirements, extra_json)
 
 
+def load_checker_config(checker_name):
+    """
+    parse_config_file with a cache in front of it.  A config is only re-read and
+    re-parsed when its file changes (by mtime, size or inode), so a cycle over
+    hundreds of untouched configs is just a stat apiece.  If an edit breaks a
+    config that parsed fine before, we log an error and keep running the last
+    good version until the file is fixed.
+    """
+    path = _config_path(checker_name)
+    stat = os.stat(path)
+    signature = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+    cached = _CONFIG_CACHE.get(path)
+    if cached and signature in (cached["signature"], cached["broken_signature"]):
+        return cached["config"]
+
+    try:
+        with open(path) as f_handle:
+            config_as_string = f_handle.read()
+        parsed = parse_config_string(config_as_string, checker_name)
+    except Exception as exc:
+        if not cached:
+            raise
+        logging.error("Config for checker %s is broken (%s), still using the last good version",
+                      checker_name, exc)
+        cached["broken_signature"] = signature
+        return cached["config"]
+
+    _CONFIG_CACHE[path] = {
+        "signature": signature,
+        "broken_signature": None,
+        "config": parsed,
+    }
+    return parsed
+
+
+def _forget_missing_configs(checker_names):
+    """Drops cached configs for checkers whose files have gone away"""
+    live_paths = set(_config_path(x) for x in checker_names)
+    for path in list(_CONFIG_CACHE):
+        if path not in live_paths:
+            del _CONFIG_CACHE[path]
+
+
+def _get_connection():
+    """
+    Hands back this thread's long lived connection, opening it on first use.
+    Reconnecting for every statement (and fsyncing on every commit) used to
+    be most of a cycle's run time, so we keep one connection per thread and
+    tune it once.
+    """
+    db_conn = getattr(_THREAD_STATE, "db_conn", None)
+    if db_conn is not None and _THREAD_STATE.db_name != DB_NAME:
+        # Somebody pointed us at a different database (tests do this)
+        close_connection()
+        db_conn = None
+    if db_conn is None:
+        db_conn = sqlite3.connect(DB_NAME, timeout=config.SQLITE_BUSY_TIMEOUT_SECONDS)
+        db_conn.execute("PRAGMA journal_mode = WAL")
+        db_conn.execute("PRAGMA synchronous = NORMAL")
+        db_conn.execute("PRAGMA cache_size = -%d" % config.SQLITE_CACHE_KB)
+        db_conn.create_function("dwmon_key_hash", 1, hash_unique_key, deterministic=True)
+        _THREAD_STATE.db_conn = db_conn
+        _THREAD_STATE.db_name = DB_NAME
+        _THREAD_STATE.transaction_depth = 0
+    return db_conn
+
+
+def close_connection():
+    """Closes this thread's connection, if it has one open"""
+    db_conn = getattr(_THREAD_STATE, "db_conn", None)
+    if db_conn is not None:
+        db_conn.close()
+    _THREAD_STATE.db_conn = None
+    _THREAD_STATE.transaction_depth = 0
+
+
+@contextlib.contextmanager
+def transaction():
+    """
+    Unit of work.  Writes made inside the block are committed together when it
+    exits, or rolled back if it raises.  Nested blocks just join the outermost one.
+    The write lock is taken up front, waiting out SQLITE_BUSY_TIMEOUT_SECONDS for
+    it if need be: a block that reads first would otherwise fail outright on its
+    first write if another worker had committed since the read.
+    """
+    db_conn = _get_connection()
+    if not _THREAD_STATE.transaction_depth and not db_conn.in_transaction:
+        # Explicit so that schema changes are covered too, not just DML
+        db_conn.execute("BEGIN IMMEDIATE")
+    _THREAD_STATE.transaction_depth += 1
+    try:
+        yield db_conn
+    except:
+        _THREAD_STATE.transaction_depth -= 1
+        if _THREAD_STATE.transaction_depth == 0:
+            db_conn.rollback()
+            # Inserts the window indexes already counted may just have been undone
+            _WINDOW_INDEXES.clear()
+        raise
+    _THREAD_STATE.transaction_depth -= 1
+    if _THREAD_STATE.transaction_depth == 0:
+        db_conn.commit()
+
+
 def _get_rows_from_query(query, data):
     """Just returns tuples of rows in memory"""
-    to_return = []
-    db_conn = sqlite3.connect(DB_NAME)
-    results = db_conn.cursor().execute(query, data)
-    for result in results:
-        to_return.append(result)
-    db_conn.close()
-    return to_return
+    return _get_connection().cursor().execute(query, data).fetchall()
 
 
 def _write_query(query, data, many=False):
-    """wrapper around writes"""
-    db_conn = sqlite3.connect(DB_NAME)
+    """
+    wrapper around writes.  Only commits when we're not inside a transaction().
+    Returns how many rows the write changed.
+    """
+    db_conn = _get_connection()
     if many:
-        db_conn.cursor().executemany(query, data)
+        cursor = db_conn.cursor().executemany(query, data)
+    else:
+        cursor = db_conn.cursor().execute(query, data)
+    if not _THREAD_STATE.transaction_depth:
+        db_conn.commit()
+    return cursor.rowcount
+
+
+def _iter_chunks(results, chunk_size):
+    """
+    Lists of at most chunk_size rows from whatever a row getter handed back:
+    a list, any iterator or generator, or a DB-API cursor.
+    """
+    if hasattr(results, "fetchmany"):
+        while True:
+            chunk = results.fetchmany(chunk_size)
+            if not chunk:
+                return
+            yield chunk
     else:
-        db_conn.cursor().execute(query, data)
-    db_conn.commit()
-    db_conn.close()
+        iterator = iter(results)
+        while True:
+            chunk = list(itertools.islice(iterator, chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
+
+def hash_unique_key(unique_id):
+    """
+    A stable signed 64 bit hash of a unique key (the first 8 bytes of its
+    blake2b digest), small enough to store as a sqlite INTEGER.
+    """
+    digest = hashlib.blake2b(str(unique_id).encode("utf-8"), digest_size=8).digest()
+    return struct.unpack(">q", digest)[0]
+
+
+class SqliteEngine(object):
+    """
+    Keeps results and checks in the sqlite database at DB_NAME: the results
+    tables (partitioned or not) with their per-minute rollup and window
+    indexes, and the checks log.  This is dwmon's own storage, and the only
+    one the rollup-based tools (histogram.py, recommend.py, snapshot.py) and
+    the --migrate/--rebuild-rollups/--hash-keys/--partition-results
+    maintenance know about.
+
+    A storage engine is anything with these methods (see also MemoryEngine):
+    transaction() -- a context manager; writes inside it land together
+    store_results(checker_name, results, hashed_keys) -- ingest, skipping stored
+        keys.  Returns (newest timestamp, rows fetched, rows inserted).
+    count_events(checker_name, seconds_lower, seconds_upper) -- events in the
+        window, inclusive at both ends
+    count_in_windows(checker_name, minute_epochs, lookback_seconds) -- the same
+        for the window ending at each of minute_epochs
+    get_event_timestamps(checker_name, seconds_lower, seconds_upper) -- sorted
+    get_time_of_most_recent_check(checker_name) -- None if there's no check
+    log_check(checker_name, minute_epoch) -- False if it was already logged
+    get_checked_minutes(checker_name) -- every logged check, oldest first
+    get_checker_names_with_checks()
+    get_watermark(checker_name), advance_watermark(checker_name, timestamp) -- see
+        the module functions of the same names
+    get_fetch_state(checker_name), set_fetch_state(checker_name, fetch_state) -- see
+        get_fetch_state and record_fetch
+    delete_old_rows(checker_name, older_than_epoch) -- purges results, returns how many
+    delete_checks(checker_name, older_than_epoch) -- purges checks, returns how many
+    drop_old_partitions(cutoffs) -- see drop_old_partitions
+    reclaim_space() -- after a retention pass
+    """
+
+    name = "sqlite"
+
+    def transaction(self):
+        return transaction()
+
+    def store_results(self, checker_name, results, hashed_keys):
+        return _sqlite_store_results(checker_name, results, hashed_keys)
+
+    def count_events(self, checker_name, seconds_lower, seconds_upper):
+        return _count_events(checker_name, seconds_lower, seconds_upper)
+
+    def count_in_windows(self, checker_name, minute_epochs, lookback_seconds):
+        return _sqlite_count_in_windows(checker_name, minute_epochs, lookback_seconds)
+
+    def get_event_timestamps(self, checker_name, seconds_lower, seconds_upper):
+        return _sqlite_get_event_timestamps(checker_name, seconds_lower, seconds_upper)
+
+    def get_time_of_most_recent_check(self, checker_name):
+        # Answered straight from the end of idx_checks_checker_ts
+        previous_checks_query = """
+            SELECT max(timestamp) FROM checks
+            WHERE checker = ?
+        """
+        return _get_rows_from_query(previous_checks_query, (checker_name,))[0][0]
 
+    def log_check(self, checker_name, minute_epoch):
+        insert_query = """
+            INSERT OR IGNORE INTO checks (checker, timestamp) VALUES (?, ?)
+        """
+        return _write_query(insert_query, (checker_name, minute_epoch)) == 1
 
-def store_results(checker_name, results):
-    """Merge the passed results with all existing results"""
-    id_query = """
-        SELECT unique_id FROM results WHERE checker = ?
+    def get_checked_minutes(self, checker_name):
+        rows = _get_rows_from_query(
+            "SELECT timestamp FROM checks WHERE checker = ? ORDER BY timestamp",
+            (checker_name,))
+        return [x[0] for x in rows]
+
+    def get_checker_names_with_checks(self):
+        return [x[0] for x in _get_rows_from_query("SELECT DISTINCT checker FROM checks", ())]
+
+    def get_watermark(self, checker_name):
+        rows = _get_rows_from_query(
+            "SELECT timestamp FROM watermarks WHERE checker = ?",
+            (checker_name,)
+        )
+        if not rows:
+            return None
+        return rows[0][0]
+
+    def advance_watermark(self, checker_name, timestamp):
+        upsert_query = """
+            INSERT INTO watermarks (checker, timestamp) VALUES (?, ?)
+            ON CONFLICT (checker) DO UPDATE SET timestamp = max(timestamp, excluded.timestamp)
+        """
+        _write_query(upsert_query, (checker_name, timestamp))
+
+    def get_fetch_state(self, checker_name):
+        rows = _get_rows_from_query(
+            "SELECT last_attempt, last_success, latency_seconds, failures "
+            "FROM fetch_state WHERE checker = ?",
+            (checker_name,)
+        )
+        if not rows:
+            return None
+        return dict(zip(("last_attempt", "last_success", "latency_seconds", "failures"), rows[0]))
+
+    def set_fetch_state(self, checker_name, fetch_state):
+        _write_query(
+            "INSERT OR REPLACE INTO fetch_state VALUES (?, ?, ?, ?, ?)",
+            (checker_name, fetch_state["last_attempt"], fetch_state["last_success"],
+             fetch_state["latency_seconds"], fetch_state["failures"])
+        )
+
+    def delete_old_rows(self, checker_name, older_than_epoch):
+        if checker_name in _WINDOW_INDEXES:
+            _WINDOW_INDEXES[checker_name].forget_before(older_than_epoch)
+        return sum(
+            _delete_in_batches(x, checker_name, older_than_epoch)
+            for x in _results_tables(None, older_than_epoch)
+        )
+
+    def delete_checks(self, checker_name, older_than_epoch):
+        return _delete_in_batches("checks", checker_name, older_than_epoch)
+
+    def drop_old_partitions(self, cutoffs):
+        return drop_old_partitions(cutoffs)
+
+    def reclaim_space(self):
+        """Hands some free pages back, if the database uses incremental auto_vacuum"""
+        vacuum_pages = config.RETENTION_INCREMENTAL_VACUUM_PAGES
+        if vacuum_pages and _get_rows_from_query("PRAGMA auto_vacuum", ())[0][0] == 2:
+            _get_rows_from_query("PRAGMA incremental_vacuum(%d)" % vacuum_pages, ())
+
+
+class MemoryEngine(object):
+    """
+    Keeps results and checks in this process's memory.  Per checker there's a
+    sorted list of event timestamps, so any window count is two binary
+    searches, a dict of the keys already stored (key -> timestamp) for dedup
+    and purging, and a set of the minutes checked.  Watermarks and fetch
+    policy state are kept alongside, so they're forgotten together with the
+    rows they describe.  Nothing outlives the process, and other processes
+    can't see any of it (so no --worker-id), so this is for tests, benchmarks
+    and trying configs out rather than for production.
+    """
+
+    name = "memory"
+
+    def __init__(self):
+        self.timestamps = {}
+        self.keys = {}
+        self.checks = {}
+        # The newest of each checker's checks, which pruning never removes
+        self.latest_checks = {}
+        self.watermarks = {}
+        self.fetch_states = {}
+        # Checkers that have stored keys as they are, rather than hashed
+        self.plain_key_checkers = set()
+        # Inside a transaction, what to call to undo each write made so far
+        self.undo_log = None
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Writes land as they're made, and are undone if the block raises.
+        Nested blocks just join the outermost one.
+        """
+        if self.undo_log is not None:
+            yield self
+            return
+        self.undo_log = []
+        try:
+            yield self
+        except:
+            for undo in reversed(self.undo_log):
+                undo()
+            raise
+        finally:
+            self.undo_log = None
+
+    def _on_rollback(self, undo):
+        if self.undo_log is not None:
+            self.undo_log.append(undo)
+
+    def _unstore(self, checker_name, inserted):
+        timestamps = self.timestamps[checker_name]
+        keys = self.keys[checker_name]
+        # A chunk that broke partway may not have been sorted yet
+        timestamps.sort()
+        for key, timestamp in inserted:
+            del keys[key]
+            del timestamps[bisect.bisect_left(timestamps, timestamp)]
+
+    def _hash_keys(self, checker_name):
+        """convert_to_hashed_keys for one checker's keys; a key whose hash is taken is dropped"""
+        old_keys = self.keys.get(checker_name, {})
+        old_timestamps = self.timestamps.get(checker_name, [])
+        keys = dict((k, v) for k, v in old_keys.items() if not isinstance(k, str))
+        timestamps = list(old_timestamps)
+        for key, timestamp in old_keys.items():
+            if not isinstance(key, str):
+                continue
+            hashed_key = hash_unique_key(key)
+            if hashed_key in keys:
+                del timestamps[bisect.bisect_left(timestamps, timestamp)]
+            else:
+                keys[hashed_key] = timestamp
+        self.keys[checker_name] = keys
+        self.timestamps[checker_name] = timestamps
+        self.plain_key_checkers.discard(checker_name)
+
+        def undo():
+            self.keys[checker_name] = old_keys
+            self.timestamps[checker_name] = old_timestamps
+            self.plain_key_checkers.add(checker_name)
+        self._on_rollback(undo)
+
+    def store_results(self, checker_name, results, hashed_keys):
+        if hashed_keys:
+            make_key = hash_unique_key
+            if checker_name in self.plain_key_checkers:
+                self._hash_keys(checker_name)
+        else:
+            make_key = str
+            self.plain_key_checkers.add(checker_name)
+        timestamps = self.timestamps.setdefault(checker_name, [])
+        keys = self.keys.setdefault(checker_name, {})
+        # (key, timestamp) of every row inserted, if a rollback might need them
+        inserted = None
+        if self.undo_log is not None:
+            inserted = []
+            self._on_rollback(lambda: self._unstore(checker_name, inserted))
+        newest_timestamp = None
+        rows_fetched = 0
+        rows_inserted = 0
+        for chunk in _iter_chunks(results, STORE_BATCH_SIZE):
+            out_of_order = False
+            for row in chunk:
+                key = make_key(row[0])
+                if key in keys:
+                    continue
+                # As given, like sqlite keeps it: a fraction past the minute isn't on it
+                timestamp = row[1]
+                keys[key] = timestamp
+                if inserted is not None:
+                    inserted.append((key, timestamp))
+                if timestamps and timestamp < timestamps[-1]:
+                    out_of_order = True
+                timestamps.append(timestamp)
+                rows_inserted += 1
+            if out_of_order:
+                # Mostly in order already, which is what sort is quickest at
+                timestamps.sort()
+            rows_fetched += len(chunk)
+            chunk_newest = max(int(x[1]) for x in chunk)
+            if newest_timestamp is None or chunk_newest > newest_timestamp:
+                newest_timestamp = chunk_newest
+        return newest_timestamp, rows_fetched, rows_inserted
+
+    def count_events(self, checker_name, seconds_lower, seconds_upper):
+        timestamps = self.timestamps.get(checker_name, [])
+        return (bisect.bisect_right(timestamps, seconds_upper)
+                - bisect.bisect_left(timestamps, seconds_lower))
+
+    def count_in_windows(self, checker_name, minute_epochs, lookback_seconds):
+        return count_in_windows(
+            self.timestamps.get(checker_name, []), minute_epochs, lookback_seconds)
+
+    def get_event_timestamps(self, checker_name, seconds_lower, seconds_upper):
+        timestamps = self.timestamps.get(checker_name, [])
+        return timestamps[bisect.bisect_left(timestamps, seconds_lower):
+                          bisect.bisect_right(timestamps, seconds_upper)]
+
+    def get_time_of_most_recent_check(self, checker_name):
+        return self.latest_checks.get(checker_name)
+
+    def log_check(self, checker_name, minute_epoch):
+        checks = self.checks.setdefault(checker_name, set())
+        if minute_epoch in checks:
+            return False
+        previous_latest = self.latest_checks.get(checker_name)
+        checks.add(minute_epoch)
+        self.latest_checks[checker_name] = max(
+            minute_epoch, self.latest_checks.get(checker_name, minute_epoch))
+        self._on_rollback(lambda: self._unlog_check(checker_name, minute_epoch, previous_latest))
+        return True
+
+    def _unlog_check(self, checker_name, minute_epoch, previous_latest):
+        self.checks[checker_name].discard(minute_epoch)
+        if previous_latest is None:
+            self.latest_checks.pop(checker_name, None)
+        else:
+            self.latest_checks[checker_name] = previous_latest
+
+    def get_checked_minutes(self, checker_name):
+        return sorted(self.checks.get(checker_name, ()))
+
+    def get_checker_names_with_checks(self):
+        return sorted(x for x in self.checks if self.checks[x])
+
+    def get_watermark(self, checker_name):
+        return self.watermarks.get(checker_name)
+
+    def advance_watermark(self, checker_name, timestamp):
+        previous = self.watermarks.get(checker_name)
+        if previous is None or timestamp > previous:
+            self.watermarks[checker_name] = timestamp
+            self._on_rollback(lambda: self._set_or_pop(self.watermarks, checker_name, previous))
+
+    def get_fetch_state(self, checker_name):
+        fetch_state = self.fetch_states.get(checker_name)
+        return None if fetch_state is None else dict(fetch_state)
+
+    def set_fetch_state(self, checker_name, fetch_state):
+        previous = self.fetch_states.get(checker_name)
+        self.fetch_states[checker_name] = dict(fetch_state)
+        self._on_rollback(lambda: self._set_or_pop(self.fetch_states, checker_name, previous))
+
+    @staticmethod
+    def _set_or_pop(values, checker_name, value):
+        if value is None:
+            values.pop(checker_name, None)
+        else:
+            values[checker_name] = value
+
+    def delete_old_rows(self, checker_name, older_than_epoch):
+        timestamps = self.timestamps.get(checker_name, [])
+        deleted = bisect.bisect_left(timestamps, older_than_epoch)
+        del timestamps[:deleted]
+        if deleted:
+            keys = self.keys[checker_name]
+            self.keys[checker_name] = dict(
+                (k, v) for k, v in keys.items() if v >= older_than_epoch)
+        return deleted
+
+    def delete_checks(self, checker_name, older_than_epoch):
+        checks = self.checks.get(checker_name, set())
+        old_checks = [x for x in checks if x < older_than_epoch]
+        checks.difference_update(old_checks)
+        return len(old_checks)
+
+    def drop_old_partitions(self, cutoffs):
+        return {}
+
+    def reclaim_space(self):
+        pass
+
+
+STORAGE_ENGINES = {"sqlite": SqliteEngine, "memory": MemoryEngine}
+
+
+def get_storage_engine():
+    """The engine config.STORAGE_ENGINE names, created on first use"""
+    global _STORAGE_ENGINE
+    if _STORAGE_ENGINE is not None and _STORAGE_ENGINE.name != config.STORAGE_ENGINE:
+        _STORAGE_ENGINE = None
+    if _STORAGE_ENGINE is None:
+        _STORAGE_ENGINE = STORAGE_ENGINES[config.STORAGE_ENGINE]()
+    return _STORAGE_ENGINE
+
+
+def reset_storage_engine():
+    """Starts over with a new engine, which for the memory engine means an empty one"""
+    global _STORAGE_ENGINE
+    _STORAGE_ENGINE = None
+
+
+def _partition_start(timestamp):
+    """Where the results partition a timestamp belongs in starts"""
+    partition_seconds = config.RESULTS_PARTITION_SECONDS
+    return ((int(timestamp) - _PARTITION_ORIGIN) // partition_seconds * partition_seconds
+            + _PARTITION_ORIGIN)
+
+
+def _partition_name(start_epoch):
+    if start_epoch < 0:
+        return "results_pm%d" % -start_epoch
+    return "results_p%d" % start_epoch
+
+
+def get_partitions(seconds_lower=None, seconds_upper=None):
+    """
+    (name, start_epoch, end_epoch) of the results partitions that overlap
+    [seconds_lower, seconds_upper] (all of them by default), oldest first
+    """
+    partitions_query = """
+        SELECT name, start_epoch, end_epoch FROM results_partitions
+        WHERE end_epoch > ? AND start_epoch <= ?
+        ORDER BY start_epoch
+    """
+    if seconds_lower is None:
+        seconds_lower = -2 ** 62
+    if seconds_upper is None:
+        seconds_upper = 2 ** 62
+    return _get_rows_from_query(partitions_query, (seconds_lower, seconds_upper))
+
+
+def _results_tables(seconds_lower=None, seconds_upper=None):
     """
-    existing_ids = [
-        x[0] for x in _get_rows_from_query(id_query, (checker_name,))
+    Every table that can hold results in [seconds_lower, seconds_upper]: the
+    original results table, which counts as a partition covering all time,
+    and then the partitions
+    """
+    return ["results"] + [x[0] for x in get_partitions(seconds_lower, seconds_upper)]
+
+
+def _create_partition(start_epoch):
+    """Makes a results partition (if it isn't there already) and returns its name"""
+    table_name = _partition_name(start_epoch)
+    creation_query = """
+        CREATE TABLE IF NOT EXISTS %s (
+            unique_id text, checker text, timestamp integer, unique_hash integer
+        )
+    """ % table_name
+    index_queries = [
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_%s_checker_id
+        ON %s (checker, unique_id) WHERE unique_id IS NOT NULL
+        """,
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_%s_checker_hash
+        ON %s (checker, unique_hash) WHERE unique_hash IS NOT NULL
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_%s_checker_ts
+        ON %s (checker, timestamp)
+        """,
     ]
-    existing_ids = set(existing_ids)
-    insert_query = """
-        INSERT INTO results (checker, unique_id, timestamp)
-        VALUES (?, ?, ?)
-    """
-    to_insert = []
-    # Don't insert dupes within this batch either
-    already_seen = {}
-    for row in results:
-        id_ = str(row[0])
-        timestamp = row[1]
-        if id_ not in existing_ids and id_ not in already_seen:
-            already_seen[id_] = 1
-            to_insert.append((checker_name, id_, timestamp))
-    _write_query(insert_query, to_insert, many=True)
+    catalog_query = """
+        INSERT OR IGNORE INTO results_partitions (name, start_epoch, end_epoch) VALUES (?, ?, ?)
+    """
+    with transaction():
+        _write_query(creation_query, ())
+        for index_query in index_queries:
+            _write_query(index_query % (table_name, table_name), ())
+        _create_minute_count_triggers(table_name)
+        _write_query(catalog_query, (
+            table_name, start_epoch, start_epoch + config.RESULTS_PARTITION_SECONDS))
+    return table_name
+
+
+def _insert_results(to_insert, hashed_keys):
+    """
+    Inserts (checker, key, timestamp) rows, skipping keys that are already
+    stored, and returns how many went in.  With RESULTS_PARTITION_SECONDS set,
+    each row goes to the partition for its timestamp, and a key already stored
+    in any live partition counts as stored, whatever its timestamp was then.
+    """
+    key_column = "unique_hash" if hashed_keys else "unique_id"
+    if not config.RESULTS_PARTITION_SECONDS:
+        insert_query = """
+            INSERT OR IGNORE INTO results (checker, %s, timestamp) VALUES (?, ?, ?)
+        """ % key_column
+        return _write_query(insert_query, to_insert, many=True)
+
+    rows_by_partition = {}
+    for row in to_insert:
+        rows_by_partition.setdefault(_partition_start(row[2]), []).append(row)
+    existing = set(x[1] for x in get_partitions())
+    for start_epoch in rows_by_partition:
+        if start_epoch not in existing:
+            _create_partition(start_epoch)
+    # Until the original table has been moved into partitions (partition_legacy_results),
+    # keys stored there count as stored too
+    table_names = [x[0] for x in get_partitions()]
+    if _get_rows_from_query("SELECT 1 FROM results LIMIT 1", ()):
+        table_names.append("results")
+    inserted = 0
+    for start_epoch, rows in sorted(rows_by_partition.items()):
+        table_name = _partition_name(start_epoch)
+        # Its own partition's unique index covers the rest
+        stored_elsewhere = " OR ".join(
+            "EXISTS (SELECT 1 FROM %s WHERE checker = ?1 AND %s = ?2)" % (x, key_column)
+            for x in table_names if x != table_name
+        ) or "0"
+        insert_query = """
+            INSERT OR IGNORE INTO %s (checker, %s, timestamp)
+            SELECT ?1, ?2, ?3 WHERE NOT (%s)
+        """ % (table_name, key_column, stored_elsewhere)
+        inserted += _write_query(insert_query, rows, many=True)
+    return inserted
+
+
+def partition_legacy_results(batch_size=10000):
+    """
+    Moves the rows in the original results table into partitions, a batch at
+    a time so the write lock is never held for long, for databases that
+    predate RESULTS_PARTITION_SECONDS being set.  Safe to stop and re-run.
+    Returns how many rows were moved.
+    """
+    assert config.RESULTS_PARTITION_SECONDS, "Set RESULTS_PARTITION_SECONDS in config.py first"
+    batch_query = """
+        SELECT rowid, unique_id, checker, timestamp, unique_hash FROM results LIMIT ?
+    """
+    moved = 0
+    while True:
+        with transaction():
+            rows = _get_rows_from_query(batch_query, (batch_size,))
+            if not rows:
+                break
+            rows_by_partition = {}
+            for row in rows:
+                rows_by_partition.setdefault(_partition_start(row[3]), []).append(row[1:])
+            for start_epoch, partition_rows in rows_by_partition.items():
+                insert_query = """
+                    INSERT OR IGNORE INTO %s (unique_id, checker, timestamp, unique_hash)
+                    VALUES (?, ?, ?, ?)
+                """ % _create_partition(start_epoch)
+                _write_query(insert_query, partition_rows, many=True)
+            placeholders = ", ".join("?" * len(rows))
+            _write_query("DELETE FROM results WHERE rowid IN (%s)" % placeholders,
+                         [x[0] for x in rows])
+            moved += len(rows)
+    return moved
+
+
+def store_results(checker_name, results, hashed_keys=False):
+    """
+    Merge the passed results with all existing results, skipping keys that
+    are already stored.  Results are consumed STORE_BATCH_SIZE rows at a
+    time, so a generator or cursor is never held in memory all at once.
+    Returns the newest timestamp seen, handy for moving the watermark along
+    (see prepare_query_details).
+    Args:
+    hashed_keys -- store hash_unique_key(key) instead of the key itself, for
+        checkers with "dwmon_hashed_keys": true in __EXTRA__.  Any keys the
+        checker stored before that was switched on are converted first (see
+        convert_to_hashed_keys), so they keep deduping against new rows.
+    """
+    newest_timestamp, rows_fetched, rows_inserted = get_storage_engine().store_results(
+        checker_name, results, hashed_keys)
+    metrics.increment("rows_fetched", rows_fetched, checker=checker_name)
+    metrics.increment("rows_inserted", rows_inserted, checker=checker_name)
+    metrics.increment("duplicates_skipped", rows_fetched - rows_inserted, checker=checker_name)
+    return newest_timestamp
+
+
+def _sqlite_store_results(checker_name, results, hashed_keys):
+    """
+    store_results for the sqlite engine.  Dedup is left to the unique
+    (checker, unique_id) index, so the cost scales with the batch rather than
+    with everything we've ever stored for the checker.  If the checker has a
+    WindowIndex, it's kept up to date with what went in.
+    Returns (newest timestamp, rows fetched, rows inserted).
+    """
+    if hashed_keys:
+        make_key = hash_unique_key
+        if _has_plain_keys(checker_name):
+            logging.info("Checker %s switched to hashed keys, converting the keys it has",
+                         checker_name)
+            convert_to_hashed_keys(checker_name)
+    else:
+        make_key = str
+    window_index = _WINDOW_INDEXES.get(checker_name)
+    newest_timestamp = None
+    rows_fetched = 0
+    rows_inserted = 0
+    for chunk in _iter_chunks(results, STORE_BATCH_SIZE):
+        to_insert = [(checker_name, make_key(row[0]), row[1]) for row in chunk]
+        chunk_inserted = _insert_results(to_insert, hashed_keys)
+        if window_index is not None and chunk_inserted:
+            if chunk_inserted == len(to_insert):
+                window_index.add(x[2] for x in to_insert)
+            else:
+                # Some were duplicates and we can't tell which, so ask the rollup
+                chunk_minutes = [int(x[2]) // 60 * 60 for x in to_insert]
+                minute_lower = min(chunk_minutes)
+                minute_upper = max(chunk_minutes)
+                window_index.set_minutes(
+                    _get_minute_counts(checker_name, minute_lower, minute_upper),
+                    minute_lower, minute_upper)
+        rows_inserted += chunk_inserted
+        rows_fetched += len(to_insert)
+        chunk_newest = max(int(x[2]) for x in to_insert)
+        if newest_timestamp is None or chunk_newest > newest_timestamp:
+            newest_timestamp = chunk_newest
+    return newest_timestamp, rows_fetched, rows_inserted
+
+
+def get_watermark(checker_name):
+    """The newest timestamp we've stored for an incremental checker, None if we have none"""
+    return get_storage_engine().get_watermark(checker_name)
+
+
+def advance_watermark(checker_name, timestamp):
+    """Moves a checker's watermark up to timestamp.  It never moves backwards."""
+    get_storage_engine().advance_watermark(checker_name, timestamp)
+
+
+def prepare_query_details(checker_name, query_details, extra_config):
+    """
+    What we actually hand the row getter.  Checkers that opt into incremental
+    fetching with "dwmon_incremental": true in __EXTRA__ get the newest timestamp
+    we've stored for them, less an overlap for stragglers, as the single bound
+    parameter in "params" (0 the first time).  Everyone else gets no params.
+    """
+    prepared = dict(query_details)
+    prepared["params"] = ()
+    if extra_config.get("dwmon_incremental"):
+        overlap_seconds = extra_config.get(
+            "dwmon_watermark_overlap_seconds", config.WATERMARK_OVERLAP_SECONDS)
+        watermark = get_watermark(checker_name)
+        since = 0 if watermark is None else watermark - overlap_seconds
+        prepared["params"] = (since,)
+    return prepared
+
+
+_FETCH_POLICY_KEYS = (
+    "dwmon_min_fetch_interval_seconds", "dwmon_max_staleness_seconds", "dwmon_adaptive_fetch")
+# How much each new fetch latency moves a checker's smoothed latency
+_FETCH_LATENCY_WEIGHT = 0.3
+
+
+def has_fetch_policy(extra_config):
+    """Whether a checker's __EXTRA__ asks for its fetches to be spaced out (see plan_fetch)"""
+    return any(extra_config.get(x) for x in _FETCH_POLICY_KEYS)
+
+
+def get_fetch_state(checker_name):
+    """
+    How a checker's recent fetches went, None if it hasn't had one: a dict of
+    last_attempt, last_success, latency_seconds and failures
+    """
+    return get_storage_engine().get_fetch_state(checker_name)
+
+
+def record_fetch(checker_name, attempt_epoch, succeeded, latency_seconds=None):
+    """
+    Notes a fetch started at attempt_epoch for the checker's fetch policy.
+    Latencies are smoothed, and failures counts the failed fetches in a row.
+    """
+    fetch_state = get_fetch_state(checker_name) or {
+        "last_success": None, "latency_seconds": None, "failures": 0}
+    last_success = attempt_epoch if succeeded else fetch_state["last_success"]
+    failures = 0 if succeeded else fetch_state["failures"] + 1
+    smoothed_latency = fetch_state["latency_seconds"]
+    if latency_seconds is not None:
+        if smoothed_latency is None:
+            smoothed_latency = latency_seconds
+        else:
+            smoothed_latency += _FETCH_LATENCY_WEIGHT * (latency_seconds - smoothed_latency)
+    get_storage_engine().set_fetch_state(checker_name, {
+        "last_attempt": attempt_epoch,
+        "last_success": last_success,
+        "latency_seconds": smoothed_latency,
+        "failures": failures,
+    })
+
+
+def plan_fetch(extra_config, fetch_state, current_epoch):
+    """
+    Whether a checker should fetch now, going by the fetch policy in its __EXTRA__:
+    "dwmon_min_fetch_interval_seconds" -- leave at least this long between fetches
+    "dwmon_max_staleness_seconds" -- don't fetch until the rows we have are this old
+    "dwmon_adaptive_fetch" -- also leave FETCH_ADAPTIVE_LATENCY_MULTIPLIER times the
+        query's usual latency between fetches, doubled for each failure in a row
+    Returns (fetch_now, checkable_through, next_fetch_epoch).  Without a fetch,
+    only minutes up to checkable_through (None for none) can be checked with
+    the rows we have: a later minute's window runs past the last fetch, so
+    its events can't all be in yet.  The rest wait for the fetch at next_fetch_epoch.
+    """
+    if fetch_state is None or not has_fetch_policy(extra_config):
+        return True, None, None
+    interval = extra_config.get("dwmon_min_fetch_interval_seconds", 0)
+    if extra_config.get("dwmon_adaptive_fetch"):
+        adaptive_interval = ((fetch_state["latency_seconds"] or 0)
+                             * config.FETCH_ADAPTIVE_LATENCY_MULTIPLIER)
+        if fetch_state["failures"]:
+            # From at least a minute, since a fetch that timed out has no latency
+            adaptive_interval = max(adaptive_interval, 60) * 2 ** fetch_state["failures"]
+        interval = max(interval, min(adaptive_interval, config.FETCH_ADAPTIVE_MAX_INTERVAL_SECONDS))
+    max_staleness = extra_config.get("dwmon_max_staleness_seconds")
+    last_success = fetch_state["last_success"]
+    next_fetch_epoch = fetch_state["last_attempt"] + interval
+    if max_staleness is not None and last_success is not None:
+        next_fetch_epoch = max(next_fetch_epoch, last_success + max_staleness)
+    if current_epoch >= next_fetch_epoch:
+        return True, None, None
+    return False, last_success, next_fetch_epoch
+
+
+def _defer_minutes(checker_name, eligible_minutes, checkable_through):
+    """Splits off the minutes that have to wait for a fresher fetch, and says so"""
+    ready_minutes = [
+        x for x in eligible_minutes if checkable_through is not None and x <= checkable_through]
+    deferred = len(eligible_minutes) - len(ready_minutes)
+    if deferred:
+        logging.info("Deferring %s minutes of checker %s until its next fetch",
+                     deferred, checker_name)
+        metrics.increment("minutes_deferred", deferred, checker=checker_name)
+    return ready_minutes, deferred
 
 
 def log_check(checker_name, minute_epoch):
     """
     Make a record of us checking this event as of a certain time, so we don't try to do it again.
+    Returns False if it was already logged (by another worker, say), in which
+    case whoever logged it is the one to follow it up.
     """
     assert isinstance(minute_epoch, int)
-    insert_query = """
-        INSERT INTO checks (checker, timestamp) VALUES (?, ?)
-    """
-    insert_data = (checker_name, minute_epoch)
-    _write_query(insert_query, insert_data)
+    return get_storage_engine().log_check(checker_name, minute_epoch)
 
 
 def create_tables():
     """Sets up tables used internally. Probably should let this work on more
     than just sqlite"""
+    if not _get_rows_from_query("SELECT count(1) FROM sqlite_master", ())[0][0]:
+        # Lets retention hand pages back.  Only cheap to switch on while the database is empty.
+        _write_query("PRAGMA auto_vacuum = INCREMENTAL", ())
+        _write_query("VACUUM", ())
     results_creation_query = """
-        CREATE TABLE results (unique_id text, checker text, timestamp integer)
-    """
-    results_index_query = """
-        CREATE INDEX idx_results_id ON results (unique_id)
+        CREATE TABLE IF NOT EXISTS results (unique_id text, checker text, timestamp integer)
     """
     _write_query(results_creation_query, ())
-    _write_query(results_index_query, ())
 
     # I'm avoiding the primary key on replace thing cause postgres doesn't have
     # that feature :(
     checks_creation_query = """
-        CREATE TABLE checks (checker text, timestamp integer)
+        CREATE TABLE IF NOT EXISTS checks (checker text, timestamp integer)
+    """
+    _write_query(checks_creation_query, ())
+
+    # Indexes and everything added since live in the migrations, so new and
+    # old databases end up with exactly the same schema.
+    migrate_schema()
+
+
+def migrate_results_dedup():
+    """
+    Brings a results table created before the unique (checker, unique_id)
+    index up to date.  Any duplicate keys that slipped in are collapsed onto
+    the earliest row, then the unique index replaces the old unique_id-only one.
+    Safe to run more than once.
+    """
+    dedup_query = """
+        DELETE FROM results WHERE rowid NOT IN (
+            SELECT min(rowid) FROM results GROUP BY checker, unique_id
+        )
+    """
+    index_query = """
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_results_checker_id
+        ON results (checker, unique_id)
+    """
+    drop_query = """
+        DROP INDEX IF EXISTS idx_results_id
+    """
+    _write_query(dedup_query, ())
+    _write_query(index_query, ())
+    _write_query(drop_query, ())
+
+
+def migrate_covering_indexes():
+    """
+    Adds (checker, timestamp) indexes so window counts, purges and the most
+    recent check lookup are index range scans instead of checker-wide scans.
+    The checks index makes the old checker-only one redundant.
+    """
+    results_index_query = """
+        CREATE INDEX IF NOT EXISTS idx_results_checker_ts
+        ON results (checker, timestamp)
     """
     checks_index_query = """
-        CREATE INDEX idx_checker_key ON checks (checker)
+        CREATE INDEX IF NOT EXISTS idx_checks_checker_ts
+        ON checks (checker, timestamp)
     """
-    _write_query(checks_creation_query, ())
+    drop_query = """
+        DROP INDEX IF EXISTS idx_checker_key
+    """
+    _write_query(results_index_query, ())
     _write_query(checks_index_query, ())
+    _write_query(drop_query, ())
+
+
+def migrate_watermarks():
+    """Somewhere to keep incremental checkers' high water marks across restarts"""
+    watermarks_creation_query = """
+        CREATE TABLE IF NOT EXISTS watermarks (checker text PRIMARY KEY, timestamp integer)
+    """
+    _write_query(watermarks_creation_query, ())
+
+
+def migrate_minute_counts():
+    """
+    Adds the results_minute_counts rollup: how many results each checker has
+    per minute, and how many of those sit exactly on the minute (window upper
+    bounds are inclusive, so those need telling apart).  Triggers keep it in
+    step with every insert into and delete from results.  Existing rows are
+    rolled up here too.
+    """
+    creation_query = """
+        CREATE TABLE IF NOT EXISTS results_minute_counts (
+            checker text,
+            minute_epoch integer,
+            n integer,
+            n_on_minute integer,
+            PRIMARY KEY (checker, minute_epoch)
+        ) WITHOUT ROWID
+    """
+    _write_query(creation_query, ())
+    _create_minute_count_triggers("results")
+    # There are no partitions yet at this point
+    rebuild_minute_counts(tables=["results"])
+
+
+def _create_minute_count_triggers(table_name):
+    """The triggers that keep results_minute_counts in step with a results table"""
+    insert_trigger_query = """
+        CREATE TRIGGER IF NOT EXISTS trg_%s_minute_counts_insert
+        AFTER INSERT ON %s
+        BEGIN
+            INSERT INTO results_minute_counts (checker, minute_epoch, n, n_on_minute)
+            VALUES (
+                NEW.checker,
+                CAST(NEW.timestamp AS INTEGER) / 60 * 60,
+                1,
+                NEW.timestamp = CAST(NEW.timestamp AS INTEGER) / 60 * 60
+            )
+            ON CONFLICT (checker, minute_epoch) DO UPDATE
+            SET n = n + 1, n_on_minute = n_on_minute + excluded.n_on_minute;
+        END
+    """ % (table_name, table_name)
+    delete_trigger_query = """
+        CREATE TRIGGER IF NOT EXISTS trg_%s_minute_counts_delete
+        AFTER DELETE ON %s
+        BEGIN
+            UPDATE results_minute_counts
+            SET n = n - 1,
+                n_on_minute = n_on_minute
+                    - (OLD.timestamp = CAST(OLD.timestamp AS INTEGER) / 60 * 60)
+            WHERE checker = OLD.checker
+            AND minute_epoch = CAST(OLD.timestamp AS INTEGER) / 60 * 60;
+            DELETE FROM results_minute_counts
+            WHERE checker = OLD.checker
+            AND minute_epoch = CAST(OLD.timestamp AS INTEGER) / 60 * 60
+            AND n <= 0;
+        END
+    """ % (table_name, table_name)
+    _write_query(insert_trigger_query, ())
+    _write_query(delete_trigger_query, ())
+
+
+def rebuild_minute_counts(checker_name=None, tables=None):
+    """
+    Recomputes the results_minute_counts rollup from results, for one checker
+    or for everyone.  The triggers keep it right from then on.
+    Args:
+    tables -- the results tables to roll up, by default all of them
+    """
+    if tables is None:
+        tables = _results_tables()
+    delete_query = "DELETE FROM results_minute_counts"
+    rollup_query = """
+        INSERT INTO results_minute_counts (checker, minute_epoch, n, n_on_minute)
+        SELECT
+        checker,
+        CAST(timestamp AS INTEGER) / 60 * 60 AS minute_epoch,
+        count(1),
+        sum(timestamp = CAST(timestamp AS INTEGER) / 60 * 60)
+        FROM (%s)
+        GROUP BY checker, minute_epoch
+    """
+    if checker_name is None:
+        data = ()
+        where = ""
+    else:
+        data = (checker_name,)
+        delete_query += " WHERE checker = ?"
+        where = "WHERE checker = ?"
+    rollup_query = rollup_query % " UNION ALL ".join(
+        "SELECT checker, timestamp FROM %s %s" % (x, where) for x in tables)
+    with transaction():
+        _write_query(delete_query, data)
+        _write_query(rollup_query, data * len(tables))
+
+
+def migrate_hashed_keys():
+    """
+    Makes room for checkers that store 64 bit key hashes instead of keys.
+    Hashed rows have a NULL unique_id, so both unique indexes become partial:
+    each one only covers the rows that use it.  Duplicate keys are collapsed
+    onto the earliest row first, leaving hashed rows alone.
+    """
+    columns = [x[1] for x in _get_rows_from_query("PRAGMA table_info(results)", ())]
+    if "unique_hash" not in columns:
+        _write_query("ALTER TABLE results ADD COLUMN unique_hash integer", ())
+    hash_index_query = """
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_results_checker_hash
+        ON results (checker, unique_hash) WHERE unique_hash IS NOT NULL
+    """
+    _write_query(hash_index_query, ())
+    dedup_query = """
+        DELETE FROM results WHERE unique_id IS NOT NULL AND rowid NOT IN (
+            SELECT min(rowid) FROM results WHERE unique_id IS NOT NULL
+            GROUP BY checker, unique_id
+        )
+    """
+    _write_query(dedup_query, ())
+    _write_query("DROP INDEX IF EXISTS idx_results_checker_id", ())
+    id_index_query = """
+        CREATE UNIQUE INDEX idx_results_checker_id
+        ON results (checker, unique_id) WHERE unique_id IS NOT NULL
+    """
+    _write_query(id_index_query, ())
+
+
+def _has_plain_keys(checker_name):
+    """Whether the checker has any keys stored as they are, rather than hashed"""
+    query = "SELECT 1 FROM %s WHERE checker = ? AND unique_id IS NOT NULL LIMIT 1"
+    return any(_get_rows_from_query(query % x, (checker_name,)) for x in _results_tables())
+
+
+def convert_to_hashed_keys(checker_name, batch_size=10000):
+    """
+    Rewrites a checker's stored keys as hashes, a batch at a time so the write
+    lock is never held for long.  store_results does this by itself the first
+    time it stores hashed keys for a checker that still has plain ones, inside
+    whatever transaction it's in; running it ahead of switching the checker to
+    "dwmon_hashed_keys" gets it done off the check path instead.  A key whose hash is already taken (a collision, or a
+    key re-fetched after the switch) is a duplicate as far as hashed storage is
+    concerned, so its row is dropped.  Returns (rows converted, rows dropped).
+    """
+    batch_query = """
+        SELECT rowid FROM %s WHERE checker = ? AND unique_id IS NOT NULL LIMIT ?
+    """
+    converted = 0
+    dropped = 0
+    for table_name in _results_tables():
+        while True:
+            with transaction():
+                rowids = [x[0] for x in _get_rows_from_query(
+                    batch_query % table_name, (checker_name, batch_size))]
+                if not rowids:
+                    break
+                placeholders = ", ".join("?" * len(rowids))
+                db_conn = _get_connection()
+                converted += db_conn.execute(
+                    "UPDATE OR IGNORE %s SET unique_hash = dwmon_key_hash(unique_id), "
+                    "unique_id = NULL WHERE rowid IN (%s)" % (table_name, placeholders),
+                    rowids).rowcount
+                dropped += db_conn.execute(
+                    "DELETE FROM %s WHERE unique_id IS NOT NULL AND rowid IN (%s)"
+                    % (table_name, placeholders), rowids).rowcount
+    if dropped:
+        logging.warning("Dropped %s rows of checker %s whose key hash was already stored",
+                        dropped, checker_name)
+        _WINDOW_INDEXES.pop(checker_name, None)
+    return converted, dropped
+
+
+def migrate_worker_leases():
+    """
+    What several worker processes need to share the checkers (see
+    acquire_leases): a leases table, a workers table for heartbeats, and a
+    unique (checker, timestamp) index on checks, so that a minute can only be
+    logged once however many workers try.  Any duplicate checks already
+    logged are dropped first.
+    """
+    dedupe_query = """
+        DELETE FROM checks WHERE rowid NOT IN (
+            SELECT min(rowid) FROM checks GROUP BY checker, timestamp
+        )
+    """
+    leases_creation_query = """
+        CREATE TABLE IF NOT EXISTS leases (checker text PRIMARY KEY, worker text, expires integer)
+    """
+    workers_creation_query = """
+        CREATE TABLE IF NOT EXISTS workers (worker text PRIMARY KEY, heartbeat integer)
+    """
+    _write_query(dedupe_query, ())
+    _write_query("DROP INDEX IF EXISTS idx_checks_checker_ts", ())
+    _write_query(
+        "CREATE UNIQUE INDEX idx_checks_checker_ts ON checks (checker, timestamp)", ())
+    _write_query(leases_creation_query, ())
+    _write_query(workers_creation_query, ())
+
+
+def migrate_partitions():
+    """
+    The catalog of results partitions (see RESULTS_PARTITION_SECONDS), each
+    one a table holding the results with timestamps in [start_epoch, end_epoch).
+    """
+    catalog_creation_query = """
+        CREATE TABLE IF NOT EXISTS results_partitions (
+            name text PRIMARY KEY, start_epoch integer, end_epoch integer
+        )
+    """
+    _write_query(catalog_creation_query, ())
+
+
+def migrate_fetch_state():
+    """Somewhere for fetch policies (see plan_fetch) to remember how recent fetches went"""
+    fetch_state_creation_query = """
+        CREATE TABLE IF NOT EXISTS fetch_state (
+            checker text PRIMARY KEY, last_attempt integer, last_success integer,
+            latency_seconds real, failures integer
+        )
+    """
+    _write_query(fetch_state_creation_query, ())
+
+
+# (version, description, function), applied in order.  Only ever append to this,
+# databases in the wild record the last version they ran.
+SCHEMA_MIGRATIONS = [
+    (1, "unique (checker, unique_id) index on results", migrate_results_dedup),
+    (2, "covering (checker, timestamp) indexes on results and checks",
+     migrate_covering_indexes),
+    (3, "watermarks table for incremental fetching", migrate_watermarks),
+    (4, "results_minute_counts rollup", migrate_minute_counts),
+    (5, "unique_hash column for hashed key storage", migrate_hashed_keys),
+    (6, "leases and workers tables, unique checks", migrate_worker_leases),
+    (7, "results partitions catalog", migrate_partitions),
+    (8, "fetch_state table for fetch policies", migrate_fetch_state),
+]
+
+
+def get_schema_version():
+    """The last migration applied to the database, 0 if none"""
+    return _get_rows_from_query("PRAGMA user_version", ())[0][0]
+
+
+def migrate_schema():
+    """
+    Upgrades the database in place to the newest schema version.  Each migration
+    runs in its own transaction along with its version bump, and every migration
+    is idempotent, so this is safe to run while dwmon is running (readers keep
+    going under WAL, writers wait out the busy timeout) or to re-run after a crash.
+    """
+    current_version = get_schema_version()
+    for version, description, migration in SCHEMA_MIGRATIONS:
+        if version <= current_version:
+            continue
+        logging.info("Migrating schema to version %s: %s", version, description)
+        with transaction():
+            migration()
+            _write_query("PRAGMA user_version = %d" % version, ())
+    return get_schema_version()
 
 
 def parse_hours_info(requirements_string):
@@ -325,30 +1480,39 @@ def matches_time_pattern(requirements, epoch):
     indeed in the 23rd minute of the first hour of the day on a weekend.
     """
     datetime_obj = datetime.datetime.fromtimestamp(epoch)
+    return _matches_local_time(
+        requirements,
+        datetime_obj.weekday(),
+        datetime_obj.hour,
+        datetime_obj.minute
+    )
 
+
+def _matches_local_time(requirements, day_of_week, hour, minute):
+    """
+    The guts of matches_time_pattern, for a local day of week (Monday is 0),
+    hour and minute.
+    """
     if not requirements["check_minutes_star"]:
-        if datetime_obj.minute < requirements["check_minutes_lower"]:
+        if minute < requirements["check_minutes_lower"]:
             return False
-        if datetime_obj.minute > requirements["check_minutes_upper"]:
+        if minute > requirements["check_minutes_upper"]:
             return False
     else:
-        if datetime_obj.minute % requirements["check_minutes_star"] != 0:
+        if minute % requirements["check_minutes_star"] != 0:
             return False
-    if datetime_obj.hour < requirements["check_hours_lower"]:
+    if hour < requirements["check_hours_lower"]:
         return False
-    if datetime_obj.hour > requirements["check_hours_upper"]:
+    if hour > requirements["check_hours_upper"]:
         return False
 
-    # Monday is 0, sunday is 6
-    day_of_week = datetime_obj.weekday()
-
     matches_day_of_week = False
     if requirements["include_weekdays"]:
         if day_of_week in [0, 1, 2, 3, 4]:
             matches_day_of_week = True
 
     if requirements["include_weekends"]:
-        if datetime_obj.weekday() in [5, 6]:
+        if day_of_week in [5, 6]:
             matches_day_of_week = True
 
     if not matches_day_of_week:
@@ -357,40 +1521,103 @@ def matches_time_pattern(requirements, epoch):
     return True
 
 
-def get_time_of_most_recent_check(checker_name):
+def compile_schedule(requirements):
     """
-    Figures out the last time a check was performed for this checker,
-    useful in avoiding alerts on old things we don't care about anymore.
+    Boils the time pattern in the requirements down to the minutes of the local
+    week (Monday 00:00 is minute 0) it matches, both as a 10080 bit bitmap and
+    as a sorted list.  Compiled schedules are cached, so this is paid once per
+    distinct pattern rather than once per minute we look at.
     """
-    previous_checks_query = """
-        SELECT max(timestamp) FROM checks
-        WHERE checker = ?
-        ORDER BY timestamp DESC
-        LIMIT 10000
+    schedule_key = tuple(requirements[x] for x in _SCHEDULE_FIELDS)
+    schedule = _SCHEDULE_CACHE.get(schedule_key)
+    if schedule is None:
+        bitmap = bytearray(MINUTES_PER_WEEK // 8)
+        week_minutes = []
+        for week_minute in range(MINUTES_PER_WEEK):
+            day_of_week, minute_of_day = divmod(week_minute, 24 * 60)
+            hour, minute = divmod(minute_of_day, 60)
+            if _matches_local_time(requirements, day_of_week, hour, minute):
+                bitmap[week_minute >> 3] |= 1 << (week_minute & 7)
+                week_minutes.append(week_minute)
+        schedule = {"bitmap": bitmap, "week_minutes": week_minutes}
+        _SCHEDULE_CACHE[schedule_key] = schedule
+    return schedule
+
+
+def _week_minute(epoch):
+    """Which minute of the local week an epoch falls in, DST and all"""
+    utc_offset = time.localtime(epoch).tm_gmtoff
+    return ((epoch + utc_offset) // 60 + _EPOCH_WEEKDAY * 24 * 60) % MINUTES_PER_WEEK
+
+
+def _iter_matching_minutes(requirements, start_epoch, end_epoch):
     """
-    previous_check_results = _get_rows_from_query(
-        previous_checks_query,
-        (checker_name,)
-    )
-    time_of_most_recent_check = previous_check_results[0][0]
-    return time_of_most_recent_check
+    Yields, in order, the minute epochs in [start_epoch, end_epoch] that match
+    the requirements.  The range is walked a day at a time.  Within a day that
+    starts and ends on the same UTC offset the matches are read straight off
+    the compiled schedule, and only a day with a DST change in it falls back
+    to looking up every minute.
+    """
+    schedule = compile_schedule(requirements)
+    bitmap = schedule["bitmap"]
+    week_minutes = schedule["week_minutes"]
+    chunk_start = int(math.ceil(start_epoch / 60.0) * 60)
+    while chunk_start <= end_epoch:
+        chunk_last = min(chunk_start + (24 * 60 - 1) * 60, int(end_epoch) // 60 * 60)
+        utc_offset = time.localtime(chunk_start).tm_gmtoff
+        if time.localtime(chunk_last).tm_gmtoff != utc_offset:
+            for minute_epoch in range(chunk_start, chunk_last + 1, 60):
+                week_minute = _week_minute(minute_epoch)
+                if bitmap[week_minute >> 3] & (1 << (week_minute & 7)):
+                    yield minute_epoch
+        else:
+            first_week_minute = _week_minute(chunk_start)
+            last_week_minute = first_week_minute + (chunk_last - chunk_start) // 60
+            # A day can run past the end of the week, but only once
+            segments = [(first_week_minute, min(last_week_minute, MINUTES_PER_WEEK - 1), 0)]
+            if last_week_minute >= MINUTES_PER_WEEK:
+                segments.append((0, last_week_minute - MINUTES_PER_WEEK, MINUTES_PER_WEEK))
+            for lower, upper, wrapped in segments:
+                i = bisect.bisect_left(week_minutes, lower)
+                while i < len(week_minutes) and week_minutes[i] <= upper:
+                    yield chunk_start + (week_minutes[i] + wrapped - first_week_minute) * 60
+                    i += 1
+        chunk_start = chunk_last + 60
+
+
+def matching_minutes(requirements, start_epoch, end_epoch):
+    """The minute epochs in [start_epoch, end_epoch] matching the requirements, ascending"""
+    return list(_iter_matching_minutes(requirements, start_epoch, end_epoch))
+
+
+def next_due_minute(requirements, after_epoch):
+    """The first minute epoch after after_epoch that the requirements want checked"""
+    # Every pattern matches something within a week, give or take DST
+    return next(_iter_matching_minutes(
+        requirements,
+        after_epoch + 1,
+        after_epoch + (MINUTES_PER_WEEK + 2 * 24 * 60) * 60
+    ), None)
 
 
-def do_multiple_history_check(checker_name, query_details, requirements):
+def get_time_of_most_recent_check(checker_name):
     """
-    Check that events recorded match the requirements in the config
-    Args:
-    requirements -- ONE set of parsed requirements (not all)
+    Figures out the last time a check was performed for this checker,
+    useful in avoiding alerts on old things we don't care about anymore.
     """
+    return get_storage_engine().get_time_of_most_recent_check(checker_name)
 
-    assert "select" in query_details["query"].lower()
-    assert len(checker_name) < 100
-    assert isinstance(requirements, dict)
 
+def get_eligible_minutes(requirements, time_of_most_recent_check, current_epoch=None):
+    """
+    The minutes (newest first) that the requirements want checked and that
+    haven't been covered by a check yet.
+    """
     # Go through a bunch of recent minutes, check for cron eligibility
     # If we do a check, mark that so we don't do it again
     # Get the current epoch and round it down to the nearest minute
-    current_epoch = int(time.time())
+    if current_epoch is None:
+        current_epoch = int(time.time())
     minute_epoch_max = int(math.floor(current_epoch / 60) * 60)
     # If the epoch is 1 trillion, say, let's pretend that it's
     # 1trillion - 60, 1trillion - 120, 1trillion - 180, etc.
@@ -400,54 +1627,392 @@ def do_multiple_history_check(checker_name, query_details, requirements):
 
     num_minutes_to_check = int(
         math.ceil(requirements['lookback_seconds'] / 60) * 10)
-    minute_epochs_to_check = [minute_epoch_max - (60 * i) for i in range(num_minutes_to_check)]
+    minute_epoch_min = minute_epoch_max - 60 * (num_minutes_to_check - 1)
 
-    time_of_most_recent_check = get_time_of_most_recent_check(checker_name)
+    # A checker that has never been checked has no most recent check
+    time_of_most_recent_check = time_of_most_recent_check or 0
     eligible_minutes = [
-        x for x in minute_epochs_to_check \
-            if matches_time_pattern(requirements, x) and x > time_of_most_recent_check
+        x for x in matching_minutes(requirements, minute_epoch_min, minute_epoch_max) \
+            if x > time_of_most_recent_check
     ]
+    eligible_minutes.reverse()
+    return eligible_minutes
+
+
+def do_multiple_history_check(checker_name, query_details, requirements, extra_config=None,
+                              fetch_cache=None):
+    """
+    Check that events recorded match the requirements in the config
+    Args:
+    requirements -- ONE set of parsed requirements (not all)
+    fetch_cache -- a FetchCache to share fetches with other calls in the same cycle
+    A checker with a fetch policy (see plan_fetch) may have its fetch skipped,
+    in which case the minutes it can't check yet are left for a later call.
+    """
+
+    assert "select" in query_details["query"].lower()
+    assert len(checker_name) < 100
+    assert isinstance(requirements, dict)
+
+    eligible_minutes = get_eligible_minutes(
+        requirements,
+        get_time_of_most_recent_check(checker_name)
+    )
     all_new_checks = []
-    if eligible_minutes:
+    if not eligible_minutes:
+        return all_new_checks
+    extra_config = extra_config or {}
+    current_epoch = int(time.time())
+    fetch_state = get_fetch_state(checker_name) if has_fetch_policy(extra_config) else None
+    fetch_now, checkable_through, _ = plan_fetch(extra_config, fetch_state, current_epoch)
+    if fetch_now:
         # Refresh results, just once if we have reason to check
-        rows = your_orgs_row_getter.get_rows_from_query(query_details)
-        store_results(checker_name, rows)
-
-        for elig_min in eligible_minutes:
-            logging.info("eligible minute is %s minutes ago", ((int(time.time()) - elig_min) / 60))
-            logging.info("Checking history for %s", checker_name)
-            start_time = time.time()
-            check_details = do_single_history_check(
-                checker_name,
-                elig_min,
-                requirements
-            )
-            end_time = time.time()
-            logging.info("Check took %s seconds", round(end_time - start_time, 5))
-            assert check_details["check_status"] in ["GOOD", "BAD"]
-            all_new_checks.append(check_details)
+        prepared = prepare_query_details(checker_name, query_details, extra_config)
+        fetch_started = time.time()
+        try:
+            if fetch_cache is None:
+                rows = your_orgs_row_getter.get_rows_from_query(prepared)
+            else:
+                rows = fetch_cache.get_rows(prepared)
+        except Exception:
+            if has_fetch_policy(extra_config):
+                record_fetch(checker_name, current_epoch, False)
+            raise
+        fetch_seconds = time.time() - fetch_started
+        newest_timestamp = store_results(
+            checker_name, rows, extra_config.get("dwmon_hashed_keys", False))
+        if extra_config.get("dwmon_incremental") and newest_timestamp is not None:
+            advance_watermark(checker_name, newest_timestamp)
+        if has_fetch_policy(extra_config):
+            record_fetch(checker_name, current_epoch, True, fetch_seconds)
+        return _check_eligible_minutes(checker_name, eligible_minutes, requirements)
+    logging.info("Skipping fetch for checker %s, its fetch policy says it isn't due",
+                 checker_name)
+    metrics.increment("fetches_skipped", checker=checker_name)
+    eligible_minutes, _ = _defer_minutes(checker_name, eligible_minutes, checkable_through)
+    if eligible_minutes:
+        all_new_checks = _check_eligible_minutes(
+            checker_name, eligible_minutes, requirements, "SKIPPED",
+            current_epoch - fetch_state["last_success"])
     return all_new_checks
 
 
-def do_single_history_check(checker_name, minute_epoch, requirements):
+def _check_eligible_minutes(checker_name, eligible_minutes, requirements,
+                            fetch_status="FETCHED", fetch_age_seconds=0):
+    """
+    Runs the checks for a requirement's eligible minutes, with some logging.
+    Each check's details say whether its rows were just fetched (FETCHED) or
+    the fetch was skipped (SKIPPED), and how old the rows are.
+    """
+    for elig_min in eligible_minutes:
+        logging.info("eligible minute is %s minutes ago", ((int(time.time()) - elig_min) / 60))
+    logging.info("Checking history for %s", checker_name)
+    start_time = time.time()
+    all_new_checks = do_batched_history_check(
+        checker_name,
+        eligible_minutes,
+        requirements
+    )
+    end_time = time.time()
+    logging.info("Checks for %s minutes took %s seconds",
+                 len(eligible_minutes), round(end_time - start_time, 5))
+    for check_details in all_new_checks:
+        assert check_details["check_status"] in ["GOOD", "BAD"]
+        check_details["fetch_status"] = fetch_status
+        check_details["fetch_age_seconds"] = fetch_age_seconds
+    return all_new_checks
+
+
+def _get_fetch_pool():
+    """The worker pool that row getters run on, created on first use"""
+    global _FETCH_POOL
+    if _FETCH_POOL is None:
+        _FETCH_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=config.FETCH_WORKERS)
+    return _FETCH_POOL
+
+
+def _get_source_semaphore(source):
+    """Caps how many queries can be running against one __SOURCE__ at a time"""
+    with _SOURCE_SEMAPHORES_LOCK:
+        if source not in _SOURCE_SEMAPHORES:
+            limit = config.FETCH_CONCURRENCY_OVERRIDES.get(
+                source, config.FETCH_CONCURRENCY_PER_SOURCE)
+            _SOURCE_SEMAPHORES[source] = threading.BoundedSemaphore(limit)
+        return _SOURCE_SEMAPHORES[source]
+
+
+class _RowStream(object):
+    """
+    A fetch's rows on their way from the fetch worker to the thread storing
+    them.  The worker pulls them off whatever the row getter handed back, a
+    batch at a time, and queues them up here; that way a DB-API cursor is only
+    ever used on the thread that made it, and a fetch that stops handing its
+    rows over for FETCH_TIMEOUT_SECONDS is given up on.  Only the worker going
+    quiet counts: time the rows spend waiting on us to store them doesn't.
+    Iterating gives the rows, and raises if the fetch broke or stalled partway through.
+    """
+
+    def __init__(self):
+        # When the fetch got going and when the row getter returned
+        self.fetch_started = []
+        # When the worker last got anywhere: the row getter returning, or a batch queued
+        self.last_progress = None
+        self.batches = queue.Queue(config.FETCH_BUFFER_BATCHES)
+        self.abandoned = threading.Event()
+
+    def produce(self, results):
+        """Runs on the fetch worker, until every row is queued or nobody wants them any more"""
+        try:
+            for batch in _iter_chunks(results, STORE_BATCH_SIZE):
+                if not self._put(batch):
+                    return
+        except Exception as exc:
+            self._put(exc)
+            return
+        self._put(None)
+
+    def _put(self, item):
+        while not self.abandoned.is_set():
+            try:
+                self.batches.put(item, timeout=1)
+                self.last_progress = time.time()
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def abandon(self):
+        """Lets the fetch worker stop"""
+        self.abandoned.set()
+
+    def __iter__(self):
+        try:
+            while True:
+                try:
+                    item = self.batches.get(timeout=1)
+                except queue.Empty:
+                    if time.time() - self.last_progress > config.FETCH_TIMEOUT_SECONDS:
+                        raise concurrent.futures.TimeoutError(
+                            "Fetch stalled for over %s seconds" % config.FETCH_TIMEOUT_SECONDS)
+                    continue
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                for row in item:
+                    yield row
+        finally:
+            self.abandon()
+
+
+def _fetch_rows(query_details, stream, ready):
+    """
+    Runs on a fetch worker.  This must never touch sqlite - all of our writes
+    stay on the thread that called fetch_rows_concurrently.  Puts
+    (stream, exception or None) on ready as soon as the row getter is done,
+    then feeds the rows into the stream.
     """
+    with _get_source_semaphore(query_details["source"]):
+        stream.fetch_started.append(time.time())
+        try:
+            results = your_orgs_row_getter.get_rows_from_query(query_details)
+        except Exception as exc:
+            ready.put((stream, exc))
+            return
+        stream.last_progress = time.time()
+        stream.fetch_started.append(stream.last_progress)
+        ready.put((stream, None))
+        stream.produce(results)
+
+
+def _materialize(rows):
+    """Rows as a list, so they can be handed to more than one checker"""
+    if isinstance(rows, list):
+        return rows
+    if hasattr(rows, "fetchall"):
+        return rows.fetchall()
+    return list(rows)
+
+
+class FetchCache(object):
+    """
+    Lives for one cycle and makes sure each distinct query - by query text,
+    source and params - hits the warehouse at most once in it, no matter how
+    many requirement lines or checkers want its rows.  Keeps hit/miss counts.
+    check_all also notes here how long each checker's fetch took, and which
+    checkers' fetch policies left minutes for later (see plan_fetch).
+    """
+
+    def __init__(self):
+        self.rows = {}
+        self.hits = 0
+        self.misses = 0
+        self.fetch_seconds = {}
+        # {checker_name: (requirement line indices, when its next fetch is due)}
+        self.deferred = {}
+
+    @staticmethod
+    def key(query_details):
+        """What makes two fetches the same fetch"""
+        return (
+            query_details["query"],
+            query_details["source"],
+            tuple(query_details.get("params", ()))
+        )
+
+    def get_rows(self, query_details):
+        """The query's rows, running it only if nobody has yet this cycle"""
+        key = self.key(query_details)
+        if key in self.rows:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.rows[key] = _materialize(
+                your_orgs_row_getter.get_rows_from_query(query_details))
+        return self.rows[key]
+
+
+def fetch_rows_concurrently(queries_by_checker, fetch_cache=None):
+    """
+    Runs the row getter for every checker on the fetch pool and yields
+    (checker_name, rows) as each one finishes.  A row getter that runs longer
+    than FETCH_TIMEOUT_SECONDS, or that is still waiting for its source after
+    FETCH_QUEUE_TIMEOUT_SECONDS, is reported and skipped, and so is one that
+    raises (and one whose rows stall, see _RowStream).  Nothing gets logged for skipped checkers, and check_all marks
+    them to be retried at the next wakeup.
+    Checkers with identical queries (see FetchCache.key) share one fetch.
+    """
+    fetch_cache = FetchCache() if fetch_cache is None else fetch_cache
+    checkers_by_key = {}
+    query_details_by_key = {}
+    for checker_name, query_details in sorted(queries_by_checker.items()):
+        key = FetchCache.key(query_details)
+        checkers_by_key.setdefault(key, []).append(checker_name)
+        query_details_by_key[key] = query_details
+
+    pool = _get_fetch_pool()
+    cycle_start = time.time()
+    # Fetch workers hand each stream back through here once its row getter is done
+    ready = queue.Queue()
+    pending = {}
+    for key, checker_names in checkers_by_key.items():
+        if key in fetch_cache.rows:
+            fetch_cache.hits += len(checker_names)
+            for checker_name in checker_names:
+                yield checker_name, fetch_cache.rows[key]
+            continue
+        fetch_cache.misses += 1
+        fetch_cache.hits += len(checker_names) - 1
+        stream = _RowStream()
+        future = pool.submit(_fetch_rows, query_details_by_key[key], stream, ready)
+        pending[stream] = (key, future)
+
+    while pending:
+        # Take everything that has landed before looking for timeouts, however
+        # long the checkers ahead of it keep us busy
+        wait_seconds = 1
+        while True:
+            try:
+                stream, error = ready.get(timeout=wait_seconds)
+            except queue.Empty:
+                break
+            wait_seconds = 0
+            if stream not in pending:
+                continue
+            key, _ = pending.pop(stream)
+            checker_names = checkers_by_key[key]
+            if error is not None:
+                logging.error("Fetching rows for checker(s) %s failed", ", ".join(checker_names),
+                              exc_info=error)
+                for checker_name in checker_names:
+                    metrics.increment("fetch_failures", checker=checker_name, source=key[1])
+                continue
+            fetch_seconds = stream.fetch_started[1] - stream.fetch_started[0]
+            logging.info("Fetch for checker(s) %s (source %s) took %s seconds",
+                         ", ".join(checker_names), key[1], round(fetch_seconds, 5))
+            for checker_name in checker_names:
+                metrics.observe("fetch", fetch_seconds, checker=checker_name, source=key[1])
+                fetch_cache.fetch_seconds[checker_name] = fetch_seconds
+            rows = stream
+            try:
+                if len(checker_names) > 1:
+                    # Can't stream one fetch into several checkers
+                    try:
+                        rows = _materialize(rows)
+                    except Exception:
+                        logging.exception("Fetching rows for checker(s) %s failed",
+                                          ", ".join(checker_names))
+                        for checker_name in checker_names:
+                            metrics.increment(
+                                "fetch_failures", checker=checker_name, source=key[1])
+                        continue
+                    fetch_cache.rows[key] = rows
+                for checker_name in checker_names:
+                    yield checker_name, rows
+            finally:
+                stream.abandon()
+
+        now = time.time()
+        for stream in list(pending):
+            key, future = pending[stream]
+            checker_names = ", ".join(checkers_by_key[key])
+            fetch_started = stream.fetch_started
+            # Only while the row getter is still running; once it returns the stream is ours
+            getter_running = len(fetch_started) == 1
+            if getter_running and now - fetch_started[0] > config.FETCH_TIMEOUT_SECONDS:
+                # We can't kill the thread, but we can stop waiting on it
+                logging.error("Fetch for checker(s) %s (source %s) timed out after %s seconds",
+                              checker_names, key[1], config.FETCH_TIMEOUT_SECONDS)
+                for checker_name in checkers_by_key[key]:
+                    metrics.increment("fetch_timeouts", checker=checker_name, source=key[1])
+                stream.abandon()
+                del pending[stream]
+            elif not fetch_started and now - cycle_start > config.FETCH_QUEUE_TIMEOUT_SECONDS:
+                logging.error("Fetch for checker(s) %s (source %s) never got a worker, "
+                              "skipping it this cycle", checker_names, key[1])
+                for checker_name in checkers_by_key[key]:
+                    metrics.increment("fetch_timeouts", checker=checker_name, source=key[1])
+                stream.abandon()
+                future.cancel()
+                del pending[stream]
+
+
+def count_in_windows(timestamps, minute_epochs, lookback_seconds):
+    """
+    Counts events per window without going back to the database.
     Args:
-    minute_epoch - the epoch at the start of the (hypothetical) minute
+    timestamps -- event timestamps, sorted ascending
+    minute_epochs -- the minutes to evaluate; each window is
+        [minute - lookback_seconds, minute], inclusive like the SQL BETWEEN
     """
-    assert isinstance(minute_epoch, int)
-    lookback_seconds = requirements["lookback_seconds"]
-    seconds_lower = minute_epoch - lookback_seconds
-    seconds_upper = minute_epoch
-    events_query = """
-        SELECT count(1) FROM results WHERE checker = ?
+    return [
+        bisect.bisect_right(timestamps, minute_epoch)
+        - bisect.bisect_left(timestamps, minute_epoch - lookback_seconds)
+        for minute_epoch in minute_epochs
+    ]
+
+
+def _get_event_timestamps(checker_name, seconds_lower, seconds_upper):
+    """Sorted timestamps of a checker's stored events in [seconds_lower, seconds_upper]"""
+    return get_storage_engine().get_event_timestamps(checker_name, seconds_lower, seconds_upper)
+
+
+def _sqlite_get_event_timestamps(checker_name, seconds_lower, seconds_upper):
+    """_get_event_timestamps for the sqlite engine"""
+    tables = _results_tables(seconds_lower, seconds_upper)
+    timestamps_query = " UNION ALL ".join("""
+        SELECT timestamp FROM %s WHERE checker = ?
         AND timestamp BETWEEN ? and ?
-    """
-    events_query_data = (checker_name, seconds_lower, seconds_upper)
-    rows = _get_rows_from_query(events_query, events_query_data)
-    event_count = rows[0][0]
-    logging.info("Found %s events in the time window", event_count)
-    check_status = ""
+    """ % x for x in tables) + " ORDER BY timestamp"
+    rows = _get_rows_from_query(
+        timestamps_query,
+        (checker_name, seconds_lower, seconds_upper) * len(tables)
+    )
+    return [x[0] for x in rows]
 
+
+def _make_check_details(checker_name, minute_epoch, requirements, event_count):
+    """Judges an event count against the requirements"""
     if event_count < requirements["min_num"] or event_count > requirements["max_num"]:
         check_status = "BAD"
     else:
@@ -462,26 +2027,534 @@ def do_single_history_check(checker_name, minute_epoch, requirements):
         "check_status": check_status,
         "minute_epoch": minute_epoch,
         "minute_local_time": str(datetime.datetime.fromtimestamp(minute_epoch)),
-        "lookback_seconds": lookback_seconds,
+        "lookback_seconds": requirements["lookback_seconds"],
     }
     return check_details
 
 
+def _get_minute_counts(checker_name, minute_lower, minute_upper):
+    """
+    The rollup rows (minute_epoch, n, n_on_minute) for a checker's minutes in
+    [minute_lower, minute_upper], oldest first
+    """
+    minute_counts_query = """
+        SELECT minute_epoch, n, n_on_minute FROM results_minute_counts
+        WHERE checker = ? AND minute_epoch BETWEEN ? AND ?
+        ORDER BY minute_epoch
+    """
+    return _get_rows_from_query(
+        minute_counts_query,
+        (checker_name, minute_lower, minute_upper)
+    )
+
+
+def count_in_windows_from_minute_counts(minute_counts, minute_epochs, lookback_seconds):
+    """
+    count_in_windows, but from per-minute rollup rows instead of raw timestamps.
+    Only exact when the minute epochs and lookback_seconds are whole minutes.
+    Args:
+    minute_counts -- (minute_epoch, n, n_on_minute) rows, sorted by minute_epoch
+    """
+    bucket_minutes = [x[0] for x in minute_counts]
+    running_totals = [0]
+    on_minute = {}
+    for minute_epoch, n, n_on_minute in minute_counts:
+        running_totals.append(running_totals[-1] + n)
+        if n_on_minute:
+            on_minute[minute_epoch] = n_on_minute
+    event_counts = []
+    for minute_epoch in minute_epochs:
+        # The buckets in [minute - lookback, minute) are wholly inside the window,
+        # and from the minute itself only events right on it count.
+        upper = bisect.bisect_left(bucket_minutes, minute_epoch)
+        lower = bisect.bisect_left(bucket_minutes, minute_epoch - lookback_seconds)
+        event_counts.append(
+            running_totals[upper] - running_totals[lower] + on_minute.get(minute_epoch, 0))
+    return event_counts
+
+
+class WindowIndex(object):
+    """
+    One checker's recent per-minute counts (n and n_on_minute, as in the
+    rollup) held in memory, so its checks don't need a trip to the database.
+    Buckets live in a ring of span_minutes + 2 slots, next to running totals,
+    which makes counting a window two lookups however long it is.  The
+    database stays the source of truth: the index is loaded from the rollup,
+    kept up to date by store_results and purges, dropped on rollback, and
+    anything it doesn't cover (windows too old, or not whole minutes) is
+    counted with SQL as before.
+    """
+
+    def __init__(self, span_minutes, newest_minute):
+        self.span_minutes = span_minutes
+        self.size = span_minutes + 2
+        self.n = [0] * self.size
+        self.n_on_minute = [0] * self.size
+        # Events up to and including each bucket's minute, from an arbitrary start
+        self.totals = [0] * self.size
+        self.newest_minute = newest_minute
+        # Windows can be counted if they start after this minute
+        self.oldest_minute = newest_minute - (self.size - 1) * 60
+
+    def _slot(self, minute_epoch):
+        return (minute_epoch // 60) % self.size
+
+    def _advance(self, minute_epoch):
+        """Moves the ring forward so minute_epoch is in it, reusing the oldest slots"""
+        if minute_epoch <= self.newest_minute:
+            return
+        carry = self.totals[self._slot(self.newest_minute)]
+        steps = min((minute_epoch - self.newest_minute) // 60, self.size)
+        for new_minute in range(minute_epoch - (steps - 1) * 60, minute_epoch + 60, 60):
+            slot = self._slot(new_minute)
+            self.n[slot] = 0
+            self.n_on_minute[slot] = 0
+            self.totals[slot] = carry
+        self.newest_minute = minute_epoch
+        self.oldest_minute = max(self.oldest_minute, minute_epoch - (self.size - 1) * 60)
+
+    def _retotal(self, from_minute):
+        """Recomputes the running totals from from_minute up to the newest minute"""
+        if from_minute <= self.oldest_minute:
+            # Only differences between totals matter, so any starting point will do
+            from_minute = self.oldest_minute
+            running = 0
+        else:
+            running = self.totals[self._slot(from_minute - 60)]
+        for minute_epoch in range(from_minute, self.newest_minute + 60, 60):
+            slot = self._slot(minute_epoch)
+            running += self.n[slot]
+            self.totals[slot] = running
+
+    def add(self, timestamps):
+        """Counts newly stored events"""
+        earliest_minute = None
+        for timestamp in timestamps:
+            minute_epoch = int(timestamp) // 60 * 60
+            if minute_epoch < self.oldest_minute:
+                continue
+            self._advance(minute_epoch)
+            slot = self._slot(minute_epoch)
+            self.n[slot] += 1
+            self.n_on_minute[slot] += timestamp == minute_epoch
+            if earliest_minute is None or minute_epoch < earliest_minute:
+                earliest_minute = minute_epoch
+        if earliest_minute is not None:
+            self._retotal(earliest_minute)
+
+    def set_minutes(self, minute_counts, minute_lower, minute_upper):
+        """
+        Replaces the buckets for [minute_lower, minute_upper] with rollup rows
+        (minute_epoch, n, n_on_minute) covering that range
+        """
+        self._advance(minute_upper)
+        minute_lower = max(minute_lower, self.oldest_minute)
+        for minute_epoch in range(minute_lower, minute_upper + 60, 60):
+            slot = self._slot(minute_epoch)
+            self.n[slot] = 0
+            self.n_on_minute[slot] = 0
+        for minute_epoch, n, n_on_minute in minute_counts:
+            if minute_lower <= minute_epoch <= minute_upper:
+                slot = self._slot(minute_epoch)
+                self.n[slot] = n
+                self.n_on_minute[slot] = n_on_minute
+        self._retotal(minute_lower)
+
+    def forget_before(self, epoch):
+        """Stops answering for windows reaching back past epoch, after a purge"""
+        first_intact_minute = int(math.ceil(epoch / 60.0) * 60)
+        self.oldest_minute = max(self.oldest_minute, first_intact_minute - 60)
+
+    def count(self, seconds_lower, seconds_upper):
+        """Events in [seconds_lower, seconds_upper], or None if the index can't say"""
+        if seconds_lower % 60 or seconds_upper % 60 or seconds_upper < seconds_lower:
+            return None
+        if seconds_lower - 60 < self.oldest_minute:
+            return None
+
+        def total_through(minute_epoch):
+            return self.totals[self._slot(min(minute_epoch, self.newest_minute))]
+
+        on_minute = 0
+        if seconds_upper <= self.newest_minute:
+            on_minute = self.n_on_minute[self._slot(seconds_upper)]
+        return total_through(seconds_upper - 60) - total_through(seconds_lower - 60) + on_minute
+
+
+def refresh_window_index(checker_name, requirements, extra_config, current_epoch=None):
+    """
+    Makes sure a checker has a WindowIndex if it wants one ("dwmon_window_index":
+    true in __EXTRA__), and doesn't if it doesn't.  The index covers every
+    window get_eligible_minutes can ask about for the longest lookback, and is
+    (re)loaded from the rollup when it's new or that changes.  Only the sqlite
+    engine has a rollup to put an index in front of.
+    """
+    if not extra_config.get("dwmon_window_index") or config.STORAGE_ENGINE != "sqlite":
+        _WINDOW_INDEXES.pop(checker_name, None)
+        return None
+    # Eligible minutes go back 10 lookbacks, and their windows one more
+    span_minutes = 11 * max(
+        int(math.ceil(x["lookback_seconds"] / 60.0)) for x in requirements)
+    window_index = _WINDOW_INDEXES.get(checker_name)
+    if window_index is None or window_index.span_minutes != span_minutes:
+        if current_epoch is None:
+            current_epoch = int(time.time())
+        window_index = WindowIndex(span_minutes, current_epoch // 60 * 60)
+        minute_counts = _get_minute_counts(
+            checker_name, window_index.oldest_minute, 2 ** 62)
+        minute_upper = window_index.newest_minute
+        if minute_counts:
+            minute_upper = max(minute_upper, minute_counts[-1][0])
+        window_index.set_minutes(minute_counts, window_index.oldest_minute, minute_upper)
+        _WINDOW_INDEXES[checker_name] = window_index
+    return window_index
+
+
+def do_batched_history_check(checker_name, minute_epochs, requirements):
+    """
+    Same answers as calling do_single_history_check for every minute, but
+    with every window counted in one go by the storage engine.
+    Args:
+    minute_epochs -- the epochs at the start of the (hypothetical) minutes
+    """
+    if not minute_epochs:
+        return []
+    for minute_epoch in minute_epochs:
+        assert isinstance(minute_epoch, int)
+    event_counts = get_storage_engine().count_in_windows(
+        checker_name, minute_epochs, requirements["lookback_seconds"])
+    return [
+        _make_check_details(checker_name, minute_epoch, requirements, event_count)
+        for minute_epoch, event_count in zip(minute_epochs, event_counts)
+    ]
+
+
+def _sqlite_count_in_windows(checker_name, minute_epochs, lookback_seconds):
+    """
+    Counts the window ending at each of minute_epochs for the sqlite engine.
+    Everything needed is pulled once for the span of all the windows and each
+    window is counted in memory.  After an outage this is one query instead of
+    hundreds.  When the lookback is a whole number of minutes, that one query
+    reads the per-minute rollup (at most one row per minute) instead of raw
+    results, and for checkers with a WindowIndex there's usually no query at all.
+    """
+    seconds_lower = min(minute_epochs) - lookback_seconds
+    seconds_upper = max(minute_epochs)
+    whole_minutes = lookback_seconds % 60 == 0 and all(x % 60 == 0 for x in minute_epochs)
+    event_counts = None
+    window_index = _WINDOW_INDEXES.get(checker_name)
+    if whole_minutes and window_index is not None:
+        event_counts = [
+            window_index.count(minute_epoch - lookback_seconds, minute_epoch)
+            for minute_epoch in minute_epochs
+        ]
+        if None in event_counts:
+            event_counts = None
+            metrics.increment("window_index_fallbacks", checker=checker_name)
+    if event_counts is None and whole_minutes:
+        minute_counts = _get_minute_counts(checker_name, seconds_lower, seconds_upper)
+        event_counts = count_in_windows_from_minute_counts(
+            minute_counts, minute_epochs, lookback_seconds)
+    elif event_counts is None:
+        timestamps = _sqlite_get_event_timestamps(checker_name, seconds_lower, seconds_upper)
+        event_counts = count_in_windows(timestamps, minute_epochs, lookback_seconds)
+    return event_counts
+
+
+def _count_events(checker_name, seconds_lower, seconds_upper):
+    """
+    How many of a checker's events fall in [seconds_lower, seconds_upper].
+    Whole minutes inside the range come from the rollup, and only the ragged
+    ends (if any) are counted from raw results.  A checker's WindowIndex, if
+    it has one and it covers the range, answers without any of that.
+    """
+    window_index = _WINDOW_INDEXES.get(checker_name)
+    if window_index is not None:
+        event_count = window_index.count(seconds_lower, seconds_upper)
+        if event_count is not None:
+            return event_count
+    first_minute = int(math.ceil(seconds_lower / 60.0) * 60)
+    last_minute = int(seconds_upper) // 60 * 60
+    if last_minute <= first_minute:
+        return _count_results(checker_name, "timestamp BETWEEN ? and ?",
+                              (seconds_lower, seconds_upper), seconds_lower, seconds_upper)
+
+    sum_query = """
+        SELECT coalesce(sum(n), 0) FROM results_minute_counts
+        WHERE checker = ? AND minute_epoch >= ? AND minute_epoch < ?
+    """
+    # The buckets from first_minute up to (not including) last_minute
+    event_count = _get_rows_from_query(sum_query, (checker_name, first_minute, last_minute))[0][0]
+    # Whatever is left on either side of them
+    event_count += _count_results(
+        checker_name,
+        "((timestamp >= ? AND timestamp < ?) OR (timestamp >= ? AND timestamp <= ?))",
+        (seconds_lower, first_minute, last_minute, seconds_upper),
+        seconds_lower, seconds_upper)
+    return event_count
+
+
+def _count_results(checker_name, condition, data, seconds_lower, seconds_upper):
+    """
+    How many of a checker's results match condition, looking only at the
+    tables that can hold [seconds_lower, seconds_upper]
+    """
+    tables = _results_tables(seconds_lower, seconds_upper)
+    count_query = "SELECT sum(n) FROM (%s)" % " UNION ALL ".join(
+        "SELECT count(1) AS n FROM %s WHERE checker = ? AND %s" % (x, condition) for x in tables)
+    return _get_rows_from_query(count_query, ((checker_name,) + tuple(data)) * len(tables))[0][0]
+
+
+def do_single_history_check(checker_name, minute_epoch, requirements):
+    """
+    Args:
+    minute_epoch - the epoch at the start of the (hypothetical) minute
+    """
+    assert isinstance(minute_epoch, int)
+    lookback_seconds = requirements["lookback_seconds"]
+    seconds_lower = minute_epoch - lookback_seconds
+    seconds_upper = minute_epoch
+    event_count = get_storage_engine().count_events(checker_name, seconds_lower, seconds_upper)
+    logging.info("Found %s events in the time window", event_count)
+    return _make_check_details(checker_name, minute_epoch, requirements, event_count)
+
+
+def _delete_in_batches(table_name, checker_name, older_than_epoch):
+    """
+    Deletes a checker's rows in table_name with timestamp < older_than_epoch.
+    Each batch of RETENTION_BATCH_SIZE rows is found through the (checker,
+    timestamp) index and committed on its own, so the write lock is only ever
+    held briefly.  Returns how many rows went.
+    """
+    deletion_query = """
+        DELETE FROM %s WHERE rowid IN (
+            SELECT rowid FROM %s WHERE checker = ? AND timestamp < ? LIMIT ?
+        )
+    """ % (table_name, table_name)
+    deleted = 0
+    while True:
+        with transaction() as db_conn:
+            batch_deleted = db_conn.execute(
+                deletion_query,
+                (checker_name, older_than_epoch, config.RETENTION_BATCH_SIZE)
+            ).rowcount
+        deleted += batch_deleted
+        if batch_deleted < config.RETENTION_BATCH_SIZE:
+            return deleted
+
+
 def delete_old_rows(checker_name, old_if_this_criteria):
     """
     Deletes old rows for a checker if a certain epoch limit is set.
     """
     # This key being set to None means we don't want to do a deletion
-    # One example of this is opting to do a deletion after each check with .01 probability,
-    # just to keep from doing excessive table scanning.
     if not old_if_this_criteria["delete_older_than_epoch"]:
         return False
     logging.info("Purging old rows for checker %s", checker_name)
-    delete_older_than_epoch = old_if_this_criteria["delete_older_than_epoch"]
-    deletion_query = """
-        DELETE FROM results WHERE timestamp < ? AND checker = ?
+    return get_storage_engine().delete_old_rows(
+        checker_name, old_if_this_criteria["delete_older_than_epoch"])
+
+
+def drop_old_partitions(cutoffs):
+    """
+    Drops the results partitions that every checker with rows in them is done
+    with, which is a lot cheaper than deleting the rows.  Their rollup rows
+    are cleared out along with them.  Checkers without a config any more
+    don't hold a partition back.  Returns {checker_name: rows dropped}.
+    Args:
+    cutoffs -- {checker_name: delete_older_than_epoch (None to keep everything)}
+        for every checker with a config
+    """
+    if _get_rows_from_query("SELECT 1 FROM results LIMIT 1", ()):
+        # The rollup can't tell a partition's rows from the original table's
+        return {}
+    rollup_sum_query = """
+        SELECT coalesce(sum(n), 0) FROM results_minute_counts
+        WHERE checker = ? AND minute_epoch >= ? AND minute_epoch < ?
+    """
+    rollup_delete_query = """
+        DELETE FROM results_minute_counts
+        WHERE checker = ? AND minute_epoch >= ? AND minute_epoch < ?
+    """
+    partitions = get_partitions()
+    dropped = {}
+    for table_name, start_epoch, end_epoch in partitions:
+        # Only if no other partition overlaps it (RESULTS_PARTITION_SECONDS changed) for the same reason
+        if any(x[0] != table_name and x[1] < end_epoch and x[2] > start_epoch for x in partitions):
+            continue
+        checker_names = [x[0] for x in _get_rows_from_query(
+            "SELECT DISTINCT checker FROM %s" % table_name, ())]
+        if any(x in cutoffs and (cutoffs[x] or 0) < end_epoch for x in checker_names):
+            continue
+        with transaction():
+            for checker_name in checker_names:
+                data = (checker_name, start_epoch, end_epoch)
+                dropped[checker_name] = (dropped.get(checker_name, 0)
+                                         + _get_rows_from_query(rollup_sum_query, data)[0][0])
+                _write_query(rollup_delete_query, data)
+                if checker_name in _WINDOW_INDEXES:
+                    _WINDOW_INDEXES[checker_name].forget_before(end_epoch)
+            _write_query("DROP TABLE IF EXISTS %s" % table_name, ())
+            _write_query("DELETE FROM results_partitions WHERE name = ?", (table_name,))
+        logging.info("Dropped results partition %s", table_name)
+    return dropped
+
+
+def prune_checks(checker_name, older_than_epoch):
+    """
+    Deletes a checker's check log entries older than older_than_epoch, except
+    for its most recent one, which get_time_of_most_recent_check relies on.
     """
-    _write_query(deletion_query, (delete_older_than_epoch, checker_name))
+    most_recent_check = get_time_of_most_recent_check(checker_name)
+    if most_recent_check is None:
+        return 0
+    return get_storage_engine().delete_checks(
+        checker_name, min(older_than_epoch, most_recent_check))
+
+
+def run_retention(current_epoch=None, checker_names=None):
+    """
+    One retention pass, run on its own schedule (see Scheduler) rather than
+    after every check.  Every checker's retention epoch comes from
+    your_orgs_row_purger.identify_old.  Partitions that everyone is done
+    with are dropped whole, and then old results of every checker (or just
+    checker_names) are deleted in short batches.  The checks log is pruned
+    down to CHECKS_RETENTION_SECONDS, for checkers that have since been
+    removed too, and then the storage engine gets a chance to hand space back.
+    """
+    if current_epoch is None:
+        current_epoch = int(time.time())
+    start_time = time.time()
+    criteria_by_checker = {}
+    for checker_name in get_checker_names():
+        try:
+            _, _, extra_config = load_checker_config(checker_name)
+        except Exception:
+            logging.exception("Couldn't parse config for checker %s, "
+                              "skipping its retention", checker_name)
+            criteria_by_checker[checker_name] = {"delete_older_than_epoch": None}
+            continue
+        criteria_by_checker[checker_name] = your_orgs_row_purger.identify_old(
+            checker_name, extra_config)
+
+    results_deleted = 0
+    cutoffs = dict((k, v["delete_older_than_epoch"]) for k, v in criteria_by_checker.items())
+    storage_engine = get_storage_engine()
+    for checker_name, checker_dropped in storage_engine.drop_old_partitions(cutoffs).items():
+        metrics.increment("rows_purged", checker_dropped, checker=checker_name)
+        results_deleted += checker_dropped
+    if checker_names is None:
+        checker_names = sorted(criteria_by_checker)
+    for checker_name in checker_names:
+        old_if_this_criteria = criteria_by_checker.get(
+            checker_name, {"delete_older_than_epoch": None})
+        checker_deleted = delete_old_rows(checker_name, old_if_this_criteria) or 0
+        metrics.increment("rows_purged", checker_deleted, checker=checker_name)
+        results_deleted += checker_deleted
+
+    checks_deleted = 0
+    checks_cutoff = current_epoch - config.CHECKS_RETENTION_SECONDS
+    for checker_name in storage_engine.get_checker_names_with_checks():
+        checks_deleted += prune_checks(checker_name, checks_cutoff)
+    storage_engine.reclaim_space()
+
+    logging.info("Retention deleted %s results and %s checks in %s seconds",
+                 results_deleted, checks_deleted, round(time.time() - start_time, 5))
+    return {"results_deleted": results_deleted, "checks_deleted": checks_deleted}
+
+
+def get_handler_dispatcher():
+    """The HandlerDispatcher for your_orgs_check_handler, created on first use"""
+    global _HANDLER_DISPATCHER
+    if _HANDLER_DISPATCHER is not None and _HANDLER_DISPATCHER.handler is not your_orgs_check_handler:
+        close_handler_dispatcher()
+    if _HANDLER_DISPATCHER is None:
+        _HANDLER_DISPATCHER = handler_dispatch.HandlerDispatcher(
+            your_orgs_check_handler,
+            workers=config.HANDLER_WORKERS,
+            queue_size=config.HANDLER_QUEUE_SIZE,
+            batch_size=config.HANDLER_BATCH_SIZE,
+            max_retries=config.HANDLER_MAX_RETRIES,
+            retry_delay_seconds=config.HANDLER_RETRY_DELAY_SECONDS,
+            journal_path=config.HANDLER_JOURNAL_PATH,
+            failed_path=config.HANDLER_FAILED_PATH,
+        )
+    return _HANDLER_DISPATCHER
+
+
+def close_handler_dispatcher(timeout=None):
+    """Lets the handler workers finish up, leaving anything unhandled in the journal"""
+    global _HANDLER_DISPATCHER
+    if _HANDLER_DISPATCHER is not None:
+        _HANDLER_DISPATCHER.close(timeout)
+        _HANDLER_DISPATCHER = None
+
+
+def heartbeat(worker_id, current_epoch):
+    """
+    Records that a worker is alive, forgets the ones that haven't said so
+    within WORKER_LEASE_SECONDS, and returns how many are left
+    """
+    upsert_query = """
+        INSERT INTO workers (worker, heartbeat) VALUES (?, ?)
+        ON CONFLICT (worker) DO UPDATE SET heartbeat = excluded.heartbeat
+    """
+    with transaction():
+        _write_query(upsert_query, (worker_id, current_epoch))
+        _write_query("DELETE FROM workers WHERE heartbeat < ?",
+                     (current_epoch - config.WORKER_LEASE_SECONDS,))
+        return _get_rows_from_query("SELECT count(1) FROM workers", ())[0][0]
+
+
+def acquire_leases(worker_id, checker_names, current_epoch):
+    """
+    Works out which checkers this worker gets to check, for when several
+    worker processes share one database.  Each checker is leased to one
+    worker at a time, for WORKER_LEASE_SECONDS, and the lease is renewed
+    every time its worker comes through here.  A worker keeps no more than
+    its fair share of the live workers' checkers, giving the rest up so that
+    new workers get some, and takes unleased or expired ones to make up its
+    share.  A dead worker's leases run out and get picked up by the others.
+    Returns the set of checker names this worker holds.
+    """
+    renew_query = "UPDATE leases SET expires = ? WHERE worker = ?"
+    take_query = """
+        INSERT INTO leases (checker, worker, expires) VALUES (?, ?, ?)
+        ON CONFLICT (checker) DO UPDATE
+        SET worker = excluded.worker, expires = excluded.expires
+        WHERE leases.expires < ?
+    """
+    expires = current_epoch + config.WORKER_LEASE_SECONDS
+    with transaction():
+        num_workers = heartbeat(worker_id, current_epoch)
+        _write_query(renew_query, (expires, worker_id))
+        share = int(math.ceil(len(checker_names) / float(max(num_workers, 1))))
+        held_rows = _get_rows_from_query(
+            "SELECT checker FROM leases WHERE worker = ? ORDER BY checker", (worker_id,))
+        names = set(checker_names)
+        held = [x[0] for x in held_rows if x[0] in names]
+        for checker_name in held[share:]:
+            _write_query("DELETE FROM leases WHERE checker = ? AND worker = ?",
+                         (checker_name, worker_id))
+        held = held[:share]
+        # Start looking at a different spot for every worker so they don't all fight over the same ones
+        candidates = sorted(names - set(held))
+        if candidates:
+            offset = hash_unique_key(worker_id) % len(candidates)
+            candidates = candidates[offset:] + candidates[:offset]
+        for checker_name in candidates:
+            if len(held) >= share:
+                break
+            if _write_query(take_query, (checker_name, worker_id, expires, current_epoch)):
+                held.append(checker_name)
+    return set(held)
+
+
+def release_leases(worker_id):
+    """Gives up all of a worker's leases straight away, for a clean shutdown"""
+    with transaction():
+        _write_query("DELETE FROM leases WHERE worker = ?", (worker_id,))
+        _write_query("DELETE FROM workers WHERE worker = ?", (worker_id,))
 
 
 def get_checker_names():
@@ -498,27 +2571,321 @@ def get_checker_names():
     return names
 
 
-def check_all():
+def check_all(due=None, current_epoch=None):
     """
     Get all checker names and do all their checks
+    Args:
+    due -- optionally, {checker_name: requirement line indices} to limit the
+        work to (see Scheduler).  By default everything is checked.
+    current_epoch -- what time to consider it, defaults to now
     """
-    checker_names = get_checker_names()
+    if due is None:
+        checker_names = get_checker_names()
+        _forget_missing_configs(checker_names)
+    else:
+        checker_names = sorted(due)
+    if current_epoch is None:
+        current_epoch = int(time.time())
+    # First work out who has minutes to check, which only needs our own db
+    due_checkers = {}
+    queries_by_checker = {}
+    fetch_cache = FetchCache()
     for checker_name in checker_names:
         try:
-            query_details, requirements, extra_config = parse_config_file(checker_name)
+            with metrics.timed("config_load", checker=checker_name):
+                query_details, requirements, extra_config = load_checker_config(checker_name)
         except:
             logging.error("Couldn't parse config for checker %s", checker_name)
             raise
-        for req in requirements:
-            all_check_details = do_multiple_history_check(checker_name, query_details, req)
-            for details in all_check_details:
-                your_orgs_check_handler.handle_check(details, extra_config)
-                log_check(checker_name, details["minute_epoch"])
-                old_if_this_criteria = your_orgs_row_purger.identify_old(checker_name, extra_config)
-                delete_old_rows(checker_name, old_if_this_criteria)
+        refresh_window_index(checker_name, requirements, extra_config, current_epoch)
+        with metrics.timed("schedule", checker=checker_name):
+            time_of_most_recent_check = get_time_of_most_recent_check(checker_name)
+            due_requirements = []
+            for index, req in enumerate(requirements):
+                if due is not None and index not in due[checker_name]:
+                    continue
+                eligible_minutes = get_eligible_minutes(
+                    req, time_of_most_recent_check, current_epoch)
+                if eligible_minutes:
+                    due_requirements.append((index, req, eligible_minutes))
+        if not due_requirements:
+            continue
+        fetch_state = get_fetch_state(checker_name) if has_fetch_policy(extra_config) else None
+        fetch_now, checkable_through, next_fetch_epoch = plan_fetch(
+            extra_config, fetch_state, current_epoch)
+        if fetch_now:
+            due_checkers[checker_name] = (due_requirements, extra_config)
+            queries_by_checker[checker_name] = prepare_query_details(
+                checker_name, query_details, extra_config)
+            continue
+        # Its policy says not to fetch yet, so check what the rows we have can tell us
+        logging.info("Skipping fetch for checker %s, its fetch policy has it due at %s",
+                     checker_name, next_fetch_epoch)
+        metrics.increment("fetches_skipped", checker=checker_name)
+        ready_requirements = []
+        deferred_indices = set()
+        for index, req, eligible_minutes in due_requirements:
+            ready_minutes, deferred = _defer_minutes(
+                checker_name, eligible_minutes, checkable_through)
+            if ready_minutes:
+                ready_requirements.append((index, req, ready_minutes))
+            if deferred:
+                deferred_indices.add(index)
+        if deferred_indices:
+            fetch_cache.deferred[checker_name] = (deferred_indices, next_fetch_epoch)
+        if ready_requirements and not _try_due_checks(
+                checker_name, ready_requirements, extra_config, None,
+                current_epoch - fetch_state["last_success"]):
+            fetch_cache.deferred[checker_name] = (
+                set(x[0] for x in due_requirements), current_epoch)
+
+    # Then fetch all of their rows at once, and deal with each as it lands
+    fetched = set()
+    for checker_name, rows in fetch_rows_concurrently(queries_by_checker, fetch_cache):
+        due_requirements, extra_config = due_checkers[checker_name]
+        if not _try_due_checks(checker_name, due_requirements, extra_config, rows, 0):
+            continue
+        fetched.add(checker_name)
+        if has_fetch_policy(extra_config):
+            record_fetch(checker_name, current_epoch, True,
+                         fetch_cache.fetch_seconds.get(checker_name))
+    for checker_name in sorted(set(queries_by_checker) - fetched):
+        due_requirements, extra_config = due_checkers[checker_name]
+        if has_fetch_policy(extra_config):
+            record_fetch(checker_name, current_epoch, False)
+        # Failed, timed out or couldn't be stored.  Retry at the next wakeup, not the
+        # line's next scheduled minute, which for a sparse line could be past where
+        # its lookback can reach back to.
+        fetch_cache.deferred[checker_name] = (
+            set(x[0] for x in due_requirements), current_epoch)
+    if queries_by_checker:
+        logging.info("Fetch cache had %s hits and %s misses",
+                     fetch_cache.hits, fetch_cache.misses)
+    return fetch_cache
+
+
+def _try_due_checks(checker_name, due_requirements, extra_config, rows, fetch_age_seconds):
+    """
+    _run_due_checks, except that a checker whose rows or checks couldn't be
+    stored is reported and left for a retry instead of taking the whole cycle
+    down.  Its transaction has been rolled back, so nothing of it was kept.
+    Returns whether it went through.
+    """
+    try:
+        _run_due_checks(checker_name, due_requirements, extra_config, rows, fetch_age_seconds)
+    except Exception:
+        logging.exception("Checking checker %s failed, it will be retried", checker_name)
+        metrics.increment("check_failures", checker=checker_name)
+        return False
+    return True
+
+
+def _run_due_checks(checker_name, due_requirements, extra_config, rows, fetch_age_seconds):
+    """
+    Stores a checker's freshly fetched rows (rows is None when its fetch was
+    skipped), checks and logs its due minutes, all in one commit, and then
+    hands the checks it logged to the check handler.
+    Args:
+    due_requirements -- (line index, requirements, eligible minutes) for each due line
+    """
+    fetch_status = "SKIPPED" if rows is None else "FETCHED"
+    to_handle = []
+    dispatcher = get_handler_dispatcher()
+    journaled = []
+    try:
+        # Each checker's inserts and check logs go out in one commit
+        with get_storage_engine().transaction():
+            if rows is not None:
+                with metrics.timed("store", checker=checker_name):
+                    newest_timestamp = store_results(
+                        checker_name, rows, extra_config.get("dwmon_hashed_keys", False))
+                    if extra_config.get("dwmon_incremental") and newest_timestamp is not None:
+                        advance_watermark(checker_name, newest_timestamp)
+            for _, req, eligible_minutes in due_requirements:
+                with metrics.timed("count", checker=checker_name):
+                    all_check_details = _check_eligible_minutes(
+                        checker_name, eligible_minutes, req, fetch_status, fetch_age_seconds)
+                for details in all_check_details:
+                    metrics.increment("checks_run", checker=checker_name,
+                                      status=details["check_status"])
+                    with metrics.timed("log_check", checker=checker_name):
+                        logged = log_check(checker_name, details["minute_epoch"])
+                    if logged:
+                        to_handle.append((details, extra_config))
+            # On disk before the checks are committed, so a crash can't lose them
+            journaled = dispatcher.journal(to_handle)
+    except:
+        # Not logged after all, so they'll be checked, and journaled, again
+        dispatcher.discard(journaled)
+        raise
+    # Only once the checks are committed, so a rollback can't lead to alerting twice
+    dispatcher.enqueue(journaled)
+
+
+class Scheduler(object):
+    """
+    Runs checks as they fall due, instead of re-evaluating every checker and
+    then sleeping a minute (which drifts by however long the checks took).
+
+    Each requirement line has an entry in a heap keyed on the next minute it's
+    due.  Every wakeup we pop whatever has come due, check just those lines,
+    and push each one back with its following due minute.  Catching up works
+    the same as always: a due line is checked with get_eligible_minutes, which
+    rewinds over its lookback window, so minutes missed while we were busy or
+    down are picked up.  New and edited configs are due straight away so they
+    get that catch-up too.  Entries for configs that have since changed or
+    gone are just dropped when they come off the heap.  Lines whose fetch
+    policy left minutes unchecked (see plan_fetch) are due again as soon as
+    their next fetch is, and lines whose fetch failed or timed out are due
+    again at the next wakeup, rather than waiting for their next scheduled minute.
+
+    With a worker_id, this is one of several worker processes sharing the
+    database, and it only checks the checkers it holds leases on (see
+    acquire_leases).  Checkers it newly takes over are due straight away.
+    """
+
+    def __init__(self, worker_id=None):
+        self.worker_id = worker_id
+        # The checkers this worker currently holds leases on
+        self.leased = set()
+        self.heap = []
+        # The config each checker's heap entries were built from
+        self.configs = {}
+        # Tie breaker so the heap never has to compare configs
+        self.sequence = itertools.count()
+        # {checker_name: (requirement line indices, epoch)} to retry once their fetch is due
+        self.deferred = {}
+        # Retention runs first thing, then every RETENTION_INTERVAL_SECONDS
+        self.next_retention = 0
+
+    def _push(self, after_epoch, checker_name, index, checker_config):
+        """Queues a requirement line up for the first minute it's due after after_epoch"""
+        due_minute = next_due_minute(checker_config[1][index], after_epoch)
+        if due_minute is not None:
+            heapq.heappush(
+                self.heap,
+                (due_minute, next(self.sequence), checker_name, index, checker_config)
+            )
+
+    def refresh(self, minute_epoch):
+        """
+        Picks up new, edited and removed configs.  Returns the work that's due
+        because of it: every line of the new and edited ones.
+        """
+        checker_names = get_checker_names()
+        _forget_missing_configs(checker_names)
+        due = {}
+        for checker_name in checker_names:
+            try:
+                checker_config = load_checker_config(checker_name)
+            except:
+                logging.error("Couldn't parse config for checker %s", checker_name)
+                raise
+            if checker_config is self.configs.get(checker_name):
+                continue
+            self.configs[checker_name] = checker_config
+            due[checker_name] = set(range(len(checker_config[1])))
+            for index in range(len(checker_config[1])):
+                self._push(minute_epoch, checker_name, index, checker_config)
+        for checker_name in set(self.configs) - set(checker_names):
+            del self.configs[checker_name]
+        return due
+
+    def pop_due(self, minute_epoch, due=None):
+        """Takes everything due by minute_epoch off the heap and schedules its next go"""
+        due = {} if due is None else due
+        while self.heap and self.heap[0][0] <= minute_epoch:
+            _, _, checker_name, index, checker_config = heapq.heappop(self.heap)
+            if self.configs.get(checker_name) is not checker_config:
+                continue
+            due.setdefault(checker_name, set()).add(index)
+            self._push(minute_epoch, checker_name, index, checker_config)
+        return due
+
+    def run_once(self, current_epoch=None):
+        """Does whatever is due as of current_epoch (default now), returns what that was"""
+        if current_epoch is None:
+            current_epoch = int(time.time())
+        minute_epoch = current_epoch // 60 * 60
+        due = self.pop_due(minute_epoch, self.refresh(minute_epoch))
+        for checker_name, (indices, retry_epoch) in list(self.deferred.items()):
+            if checker_name not in self.configs:
+                del self.deferred[checker_name]
+            elif retry_epoch <= current_epoch:
+                due.setdefault(checker_name, set()).update(indices)
+                del self.deferred[checker_name]
+        retention_checkers = None
+        if self.worker_id is not None:
+            due = self.narrow_to_leased(due, current_epoch)
+            retention_checkers = sorted(self.leased)
+        if due:
+            self.deferred.update(check_all(due, current_epoch).deferred)
+        if current_epoch >= self.next_retention:
+            with metrics.timed("purge"):
+                run_retention(current_epoch, retention_checkers)
+            self.next_retention = current_epoch + config.RETENTION_INTERVAL_SECONDS
+        return due
+
+    def narrow_to_leased(self, due, current_epoch):
+        """Renews this worker's leases and keeps just the due work it holds them for"""
+        leased = acquire_leases(self.worker_id, sorted(self.configs), current_epoch)
+        for checker_name in self.leased - leased:
+            # Somebody else will be storing its results now
+            _WINDOW_INDEXES.pop(checker_name, None)
+        for checker_name in leased - self.leased:
+            due[checker_name] = set(range(len(self.configs[checker_name][1])))
+        self.leased = leased
+        return dict((k, v) for k, v in due.items() if k in leased)
+
+    def run_forever(self):
+        """Wakes just after each minute boundary and runs what's due"""
+        while True:
+            with metrics.timed("cycle"):
+                due = self.run_once()
+            if config.METRICS_TEXTFILE_PATH:
+                metrics.write_textfile(config.METRICS_TEXTFILE_PATH)
+            logging.info("Ran %s checkers, sleeping...", len(due))
+            # Aim at the next boundary by the clock so time spent checking doesn't add up
+            time.sleep(60 - time.time() % 60 + config.SCHEDULER_WAKE_DELAY_SECONDS)
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--migrate", action="store_true",
+                        help="upgrade the database schema in place and exit")
+    parser.add_argument("--rebuild-rollups", action="store_true",
+                        help="recompute the per-minute results rollup and exit")
+    parser.add_argument("--hash-keys", metavar="CHECKER",
+                        help="convert a checker's stored keys to hashes and exit")
+    parser.add_argument("--partition-results", action="store_true",
+                        help="move results into partitions (see RESULTS_PARTITION_SECONDS) and exit")
+    parser.add_argument("--worker-id",
+                        help="run as one of several workers sharing the checkers, under this "
+                             "(stable, unique) name")
+    args = parser.parse_args()
+    if args.worker_id and config.STORAGE_ENGINE == "memory":
+        parser.error("--worker-id needs checks that other workers can see, "
+                     "which the memory storage engine doesn't share")
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(name)-8s %(levelname)-8s %(message)s'
+    )
+    if args.migrate:
+        logging.info("Schema is at version %s", migrate_schema())
+        raise SystemExit(0)
+    if args.rebuild_rollups:
+        rebuild_minute_counts()
+        logging.info("Rebuilt results_minute_counts")
+        raise SystemExit(0)
+    if args.partition_results:
+        logging.info("Moved %s rows into partitions", partition_legacy_results())
+        raise SystemExit(0)
+    if args.hash_keys:
+        logging.info("Converted %s rows, dropped %s duplicates",
+                     *convert_to_hashed_keys(args.hash_keys))
+        raise SystemExit(0)
+
     # I put these here because if you're running the tests, you might not necessarily care
     # about testing your custom functions here - they're outside the scope of testing.
     # Mine custom handlers import some packages that others might not have.
@@ -527,11 +2894,14 @@ if __name__ == "__main__":
     import your_org.your_orgs_check_handler as your_orgs_check_handler
     import your_org.your_orgs_row_getter as your_orgs_row_getter
     import your_org.your_orgs_row_purger as your_orgs_row_purger
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s %(name)-8s %(levelname)-8s %(message)s'
-    )
-    while True:
-        check_all()
-        logging.info("Sleeping...")
-        time.sleep(60)
+    if args.worker_id:
+        # Every worker replays its own journal
+        config.HANDLER_JOURNAL_PATH = "%s.%s" % (config.HANDLER_JOURNAL_PATH, args.worker_id)
+    if config.METRICS_HTTP_PORT:
+        metrics.serve(config.METRICS_HTTP_PORT, config.METRICS_HTTP_HOST)
+    try:
+        Scheduler(args.worker_id).run_forever()
+    finally:
+        close_handler_dispatcher(config.HANDLER_SHUTDOWN_TIMEOUT_SECONDS)
+        if args.worker_id:
+            release_leases(args.worker_id)
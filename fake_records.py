@@ -3,13 +3,22 @@ This module is designed to get you started with some fake records/tables
 that you can write queries against for testing etc.
 """
 
+import itertools
 import random
 import sqlite3
 import time
 
 import config
 
-CONN = sqlite3.connect(config.SQLITE_DB_NAME)
+CONN = None
+
+
+def get_conn():
+    """The connection the fake tables live behind, opened on first use"""
+    global CONN
+    if CONN is None:
+        CONN = sqlite3.connect(config.SQLITE_DB_NAME)
+    return CONN
 
 
 def fake_id():
@@ -37,8 +46,8 @@ def fake_an_application():
         VALUES (?, ?, ?)
     """
     insert_data = (application_id, created_date, stage)
-    CONN.cursor().execute(insert_query, insert_data)
-    CONN.commit()
+    get_conn().cursor().execute(insert_query, insert_data)
+    get_conn().commit()
 
 
 def fake_an_execution():
@@ -54,14 +63,40 @@ def fake_an_execution():
         VALUES (?, ?, ?, ?)
     """
     insert_data = (exec_id, exec_ts, model_name, exec_result)
-    CONN.cursor().execute(insert_query, insert_data)
-    CONN.commit()
+    get_conn().cursor().execute(insert_query, insert_data)
+    get_conn().commit()
+
+
+def bulk_fake_executions(num_rows, start_epoch, end_epoch, model_names,
+                         conn=None, seed=None, batch_size=50000):
+    """
+    Loads num_rows fake executions spread at random over [start_epoch, end_epoch]
+    and over model_names, with executemany in big batches rather than a commit
+    per row.  Good for building up enough history to benchmark against.
+    """
+    conn = conn or get_conn()
+    rand = random.Random(seed)
+    insert_query = """
+        INSERT INTO model_executions (execution_id, ts, model_name, result)
+        VALUES (?, ?, ?, ?)
+    """
+    rows = (
+        ("exec%s" % i, rand.randint(start_epoch, end_epoch), rand.choice(model_names), "fake")
+        for i in range(num_rows)
+    )
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            break
+        conn.cursor().executemany(insert_query, batch)
+        conn.commit()
 
 
-def create_tables():
+def create_tables(conn=None):
     """
     Creates some fake tables.
     """
+    conn = conn or get_conn()
     applications_creation_query = """
         CREATE TABLE applications (
             application_id text,
@@ -77,9 +112,13 @@ def create_tables():
             result text
         )
     """
-    CONN.cursor().execute(applications_creation_query, ())
-    CONN.cursor().execute(model_executions_creation_query, ())
-    CONN.commit()
+    model_executions_index_query = """
+        CREATE INDEX idx_model_executions ON model_executions (model_name, ts)
+    """
+    conn.cursor().execute(applications_creation_query, ())
+    conn.cursor().execute(model_executions_creation_query, ())
+    conn.cursor().execute(model_executions_index_query, ())
+    conn.commit()
 
 
 if __name__ == "__main__":
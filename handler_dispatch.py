@@ -0,0 +1,276 @@
+"""
+Hands check details to your_orgs_check_handler off dwmon's main thread, so a
+handler that sends email or calls a webhook doesn't hold up evaluating the
+next checker.  Details go on a bounded queue that a few worker threads
+serve, in batches.  If the handler module has handle_checks(batch) it gets a
+whole batch, a list of (details, extra_config) pairs, in one call; otherwise
+handle_check(details, extra_config) is called for each.
+
+Every detail is written to a journal file, and fsynced, before dwmon commits
+the check it belongs to, and is only crossed off once the handler has dealt
+with it.  Whatever was journaled but never handled - because dwmon died, was
+stopped, or the queue was full - is fed back in from the journal, when the
+queue runs dry and on the next start.  So a check that was logged is
+followed up at least once, whatever happens in between.
+
+Failed calls are left in the journal and retried a few times with a growing
+delay, without anybody sleeping on them.  What still fails after that is
+appended to a "failed" JSON lines file for somebody to look at.  See the
+HANDLER_ settings in config.py.
+"""
+
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+
+import metrics
+
+
+class HandlerDispatcher(object):
+    """
+    Args:
+    handler -- the module (or anything) with handle_check and/or handle_checks
+    workers -- worker threads; 0 calls the handler right away on the caller's thread
+    """
+
+    def __init__(self, handler, workers, queue_size, batch_size, max_retries,
+                 retry_delay_seconds, journal_path, failed_path):
+        self.handler = handler
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.retry_delay_seconds = retry_delay_seconds
+        self.journal_path = journal_path
+        self.failed_path = failed_path
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stopping = threading.Event()
+        # Guards the journal and failed files, and the two below
+        self.lock = threading.Lock()
+        # Ids of the journal entries waiting on their checks' commit, queued, or being handled
+        self.in_flight = set()
+        # {entry id: (failed tries so far, when it can be tried again)}
+        self.retries = {}
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(
+                target=self._work, name="dwmon-handler-%s" % i, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        if not self.threads:
+            self.replay_journal()
+
+    def journal(self, items):
+        """
+        Writes (details, extra_config) pairs to the journal, and makes sure
+        they're on disk.  Returns them as (entry id, details, extra_config)
+        entries, for enqueue or discard.  Until then replay leaves them alone:
+        their checks aren't committed yet.
+        """
+        entries = [(uuid.uuid4().hex, details, extra_config) for details, extra_config in items]
+        if entries:
+            with self.lock:
+                self._append_lines(self.journal_path, [
+                    {"id": x[0], "details": x[1], "extra_config": x[2]} for x in entries])
+                self.in_flight.update(x[0] for x in entries)
+        return entries
+
+    def discard(self, entries):
+        """Crosses journal entries off without handling them, for checks that were rolled back"""
+        self._cross_off([x[0] for x in entries])
+        with self.lock:
+            self.in_flight.difference_update(x[0] for x in entries)
+
+    def enqueue(self, entries):
+        """
+        Queues journal entries for the handler.  Never waits on the handler,
+        unless there are no workers; what doesn't fit stays in the journal
+        until there's room.
+        """
+        self._dispatch(entries)
+        if not self.threads:
+            self.replay_journal()
+
+    def submit(self, items):
+        """Journals (details, extra_config) pairs and queues them for the handler"""
+        self.enqueue(self.journal(items))
+
+    def _dispatch(self, entries):
+        if not self.threads:
+            for start in range(0, len(entries), self.batch_size):
+                self._handle(entries[start:start + self.batch_size])
+            return
+        with self.lock:
+            self.in_flight.update(x[0] for x in entries)
+        overflow = []
+        for entry in entries:
+            if overflow or self.stopping.is_set():
+                overflow.append(entry)
+                continue
+            try:
+                self.queue.put_nowait(entry)
+            except queue.Full:
+                overflow.append(entry)
+        if overflow:
+            with self.lock:
+                self.in_flight.difference_update(x[0] for x in overflow)
+            metrics.increment("handler_overflow", len(overflow))
+
+    @staticmethod
+    def _append_lines(path, records):
+        """Appends records to a JSON lines file, and makes sure they're on disk"""
+        with open(path, "a") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _read_journal(self):
+        """
+        The journal entries not crossed off yet, oldest first.  Rewrites the
+        journal without the crossed off ones while it's at it.  Call with the lock held.
+        """
+        if not os.path.exists(self.journal_path):
+            return []
+        entries = {}
+        crossed_off = False
+        with open(self.journal_path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if "done" in record:
+                    entries.pop(record["done"], None)
+                    crossed_off = True
+                else:
+                    entries[record["id"]] = (record["id"], record["details"], record["extra_config"])
+        if not entries:
+            os.remove(self.journal_path)
+        elif crossed_off:
+            rewritten_path = self.journal_path + ".tmp"
+            if os.path.exists(rewritten_path):
+                os.remove(rewritten_path)
+            self._append_lines(rewritten_path, [
+                {"id": x[0], "details": x[1], "extra_config": x[2]} for x in entries.values()])
+            os.replace(rewritten_path, self.journal_path)
+        return list(entries.values())
+
+    def replay_journal(self):
+        """
+        Feeds back in whatever the journal still has that isn't already on its
+        way to the handler (failed entries once their retry is due).  Returns how many.
+        """
+        now = time.time()
+        with self.lock:
+            entries = [
+                x for x in self._read_journal()
+                if x[0] not in self.in_flight and self.retries.get(x[0], (0, 0))[1] <= now
+            ]
+            if self.threads:
+                # So another idle worker doesn't pick them up as well
+                self.in_flight.update(x[0] for x in entries)
+        if entries:
+            logging.info("Replaying %s journaled check details", len(entries))
+            self._dispatch(entries)
+        return len(entries)
+
+    def _work(self):
+        """A worker thread: handle batches until told to stop, replaying the journal when idle"""
+        while not self.stopping.is_set():
+            try:
+                batch = [self.queue.get(timeout=1)]
+            except queue.Empty:
+                self.replay_journal()
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._handle(batch)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    @staticmethod
+    def _call(call, what):
+        """Calls call().  Returns whether it worked."""
+        try:
+            call()
+            return True
+        except Exception:
+            logging.exception("Check handler failed on %s", what)
+            return False
+
+    def _handle(self, batch):
+        """
+        Gives one batch of journal entries a go at the handler.  What it
+        handles is crossed off the journal; what it fails on stays there to be
+        retried later, until it runs out of retries and goes to the failed file.
+        """
+        if hasattr(self.handler, "handle_checks"):
+            with metrics.timed("handler"):
+                worked = self._call(
+                    lambda: self.handler.handle_checks([(x[1], x[2]) for x in batch]),
+                    "a batch of %s" % len(batch))
+            failed = [] if worked else batch
+        else:
+            failed = []
+            for entry in batch:
+                checker_name = entry[1]["checker_name"]
+                with metrics.timed("handler", checker=checker_name):
+                    worked = self._call(
+                        lambda: self.handler.handle_check(entry[1], entry[2]),
+                        "%s at %s" % (checker_name, entry[1]["minute_epoch"]))
+                if not worked:
+                    failed.append(entry)
+        failed_ids = set(x[0] for x in failed)
+        given_up = []
+        with self.lock:
+            for entry in batch:
+                tries = self.retries.pop(entry[0], (0, 0))[0]
+                if entry[0] not in failed_ids:
+                    continue
+                if tries >= self.max_retries:
+                    given_up.append(entry)
+                else:
+                    retry_at = time.time() + self.retry_delay_seconds * 2 ** tries
+                    self.retries[entry[0]] = (tries + 1, retry_at)
+                    metrics.increment("handler_retries")
+            if given_up:
+                logging.error("Check handler gave up on %s check details", len(given_up))
+                self._append_lines(self.failed_path, [
+                    {"details": x[1], "extra_config": x[2]} for x in given_up])
+                metrics.increment("handler_failures", len(given_up))
+        retrying_ids = failed_ids - set(x[0] for x in given_up)
+        self._cross_off([x[0] for x in batch if x[0] not in retrying_ids])
+        with self.lock:
+            self.in_flight.difference_update(x[0] for x in batch)
+
+    def _cross_off(self, entry_ids):
+        if entry_ids:
+            with self.lock:
+                self._append_lines(self.journal_path, [{"done": x} for x in entry_ids])
+
+    def join(self):
+        """Waits until everything queued so far has been handled"""
+        self.queue.join()
+
+    def close(self, timeout=None):
+        """
+        Stops the workers once their current batches are done.  Whatever is
+        still queued is in the journal already, so the next start picks it up.
+        """
+        self.stopping.set()
+        deadline = None if timeout is None else time.time() + timeout
+        for thread in self.threads:
+            thread.join(None if deadline is None else max(0, deadline - time.time()))
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                break
+            self.queue.task_done()
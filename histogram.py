@@ -9,32 +9,53 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-s", type=int, help="lookback from now, in seconds")
     parser.add_argument("-c", help="checker name")
+    parser.add_argument("--snapshot", metavar="DIR",
+                        help="read a snapshot (see snapshot.py) instead of the database, "
+                             "for one checker or, without -c, all of them")
+    parser.add_argument("--by", default="day_of_week_hour",
+                        choices=["day_of_week_hour", "day_of_week", "hour", "minute"],
+                        help="what to bucket by, with --snapshot")
     args = parser.parse_args()
 
-    db_conn = sqlite3.connect(config.SQLITE_DB_NAME)
-
     lookback_seconds = args.s
     checker = args.c
 
+    if args.snapshot:
+        import snapshot
+        manifest = snapshot.read_manifest(args.snapshot)
+        checker_names = [checker] if checker else sorted(manifest["checkers"])
+        epoch_lower = int(time.time() - lookback_seconds) if lookback_seconds else None
+        key_names = {"day_of_week_hour": "day_of_week|hour"}.get(args.by, args.by)
+        print("checker|%s|count" % key_names)
+        for checker_name in checker_names:
+            timestamps = snapshot.load_timestamps(args.snapshot, checker_name, manifest)
+            counts = snapshot.histogram(timestamps, args.by, epoch_lower)
+            for key in sorted(counts):
+                print("%s|%s|%s" % (checker_name, "|".join(str(x) for x in key), counts[key]))
+        raise SystemExit(0)
+
+    db_conn = sqlite3.connect(config.SQLITE_DB_NAME)
+
     epoch_lower = time.time() - lookback_seconds
 
+    # Reads the per-minute rollup dwmon keeps rather than re-aggregating raw results
     query = """
         SELECT
-        strftime('%w', datetime(timestamp, 'unixepoch')) as day_of_week,
-        strftime('%H', datetime(timestamp, 'unixepoch')) as hour,
-        min(datetime(timestamp, 'unixepoch', 'localtime')) as mytime,
-        count(1),
-        min(timestamp)
+        strftime('%w', datetime(minute_epoch, 'unixepoch')) as day_of_week,
+        strftime('%H', datetime(minute_epoch, 'unixepoch')) as hour,
+        min(datetime(minute_epoch, 'unixepoch', 'localtime')) as mytime,
+        sum(n),
+        min(minute_epoch)
         FROM
-        results
+        results_minute_counts
         WHERE day_of_week IN ('1', '2', '3', '4', '5')
         AND checker = ?
-        AND timestamp > ?
+        AND minute_epoch > ?
         GROUP BY hour, day_of_week
         ORDER BY day_of_week, hour ASC
     """
 
-    print "day_of_week|hour|min_local_time|count|min_epoch"
+    print("day_of_week|hour|min_local_time|count|min_epoch")
     results = db_conn.cursor().execute(query, (checker, epoch_lower))
     for result in results:
-        print "%s|%s|%s|%s|%s" % (result[0], result[1], result[2], result[3], result[4])
+        print("%s|%s|%s|%s|%s" % (result[0], result[1], result[2], result[3], result[4]))
@@ -0,0 +1,137 @@
+"""
+Timings and counters for each phase of dwmon's cycles, so you can see which
+checker is eating the minute.  They can be exported in Prometheus' text format
+as a file (for node_exporter's textfile collector) and/or from a small local
+HTTP endpoint.  See the METRICS_ settings in config.py.
+"""
+
+import contextlib
+import os
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+PREFIX = "dwmon_"
+
+_LOCK = threading.Lock()
+# (phase, labels) -> [runs, total seconds, seconds of the latest run]
+_TIMINGS = {}
+# (name, labels) -> running total
+_COUNTERS = {}
+
+
+def _label_key(labels):
+    """Labels as something hashable and in a stable order"""
+    return tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+
+def observe(phase, seconds, **labels):
+    """Records one run of a phase that took seconds"""
+    key = (phase, _label_key(labels))
+    with _LOCK:
+        timing = _TIMINGS.setdefault(key, [0, 0.0, 0.0])
+        timing[0] += 1
+        timing[1] += seconds
+        timing[2] = seconds
+
+
+@contextlib.contextmanager
+def timed(phase, **labels):
+    """Times the block as a run of phase"""
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        observe(phase, time.time() - start_time, **labels)
+
+
+def increment(name, amount=1, **labels):
+    """Adds amount to a counter"""
+    key = (name, _label_key(labels))
+    with _LOCK:
+        _COUNTERS[key] = _COUNTERS.get(key, 0) + amount
+
+
+def get_counter(name, **labels):
+    """A counter's current value"""
+    with _LOCK:
+        return _COUNTERS.get((name, _label_key(labels)), 0)
+
+
+def reset():
+    """Forgets everything recorded so far"""
+    with _LOCK:
+        _TIMINGS.clear()
+        _COUNTERS.clear()
+
+
+def _format_labels(label_key):
+    """{a="1",b="2"} from a label key"""
+    if not label_key:
+        return ""
+    escaped = (
+        (k, v.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n"))
+        for k, v in label_key
+    )
+    return "{" + ",".join("%s=\"%s\"" % x for x in escaped) + "}"
+
+
+def render():
+    """Everything recorded so far in Prometheus' text exposition format"""
+    with _LOCK:
+        timings = sorted(_TIMINGS.items())
+        counters = sorted(_COUNTERS.items())
+    lines = []
+    for suffix, metric_type, index, help_text in [
+            ("phase_runs_total", "counter", 0, "Times each phase has run"),
+            ("phase_seconds_total", "counter", 1, "Seconds spent in each phase"),
+            ("phase_last_seconds", "gauge", 2, "Seconds the latest run of each phase took")]:
+        lines.append("# HELP %s%s %s" % (PREFIX, suffix, help_text))
+        lines.append("# TYPE %s%s %s" % (PREFIX, suffix, metric_type))
+        for (phase, label_key), timing in timings:
+            labels = _format_labels((("phase", phase),) + label_key)
+            lines.append("%s%s%s %s" % (PREFIX, suffix, labels, round(timing[index], 6)))
+    names_seen = set()
+    for (name, label_key), value in counters:
+        if name not in names_seen:
+            names_seen.add(name)
+            lines.append("# TYPE %s%s_total counter" % (PREFIX, name))
+        lines.append("%s%s_total%s %s" % (PREFIX, name, _format_labels(label_key), value))
+    return "\n".join(lines) + "\n"
+
+
+def write_textfile(path):
+    """Writes render() to path, atomically so a scraper never sees half a file"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f_handle:
+        f_handle.write(render())
+    os.rename(tmp_path, path)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    """Serves render() at /metrics"""
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        # Scrapes every 15 seconds would drown out everything else in the log
+        pass
+
+
+def serve(port, host="127.0.0.1"):
+    """Serves /metrics from a background thread, returns the server"""
+    server = HTTPServer((host, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="dwmon-metrics")
+    thread.daemon = True
+    thread.start()
+    return server
@@ -0,0 +1,190 @@
+"""
+Suggests MINNUM/MAXNUM for every requirements line of every checker, from
+how the stored history would have counted.  Each line's windows are counted
+at every minute its schedule would have checked over the last few weeks,
+and the bounds are taken from quantiles of those counts, widened by a margin.
+
+Each checker's history is read once, as one primary key range of the
+per-minute rollup, into a running total per minute.  Every window count
+is then a subtraction, not a query.  Only
+lines whose LOOKBACKSECONDS isn't a whole number of minutes need that
+checker's raw timestamps.  Nothing is written anywhere.
+"""
+
+import argparse
+import bisect
+import itertools
+import math
+import re
+import time
+
+import dwmon
+
+
+def _requirements_lines(checker_name):
+    """A checker's requirements lines as written, in the order parse_config_file returns them"""
+    with open(dwmon._config_path(checker_name)) as f_handle:
+        config_sections = dwmon.pull_sections_from_config(f_handle.read())
+    requirements_sets = re.split(r"\s*\n", config_sections["requirements_string"])
+    return [x.strip() for x in requirements_sets if x.strip() != "" and not x.startswith("#")]
+
+
+def _quantile(sorted_counts, quantile, round_up):
+    """The count at quantile, between neighbouring ranks rounding down (or up)"""
+    position = quantile * (len(sorted_counts) - 1)
+    index = int(math.ceil(position)) if round_up else int(math.floor(position))
+    return sorted_counts[index]
+
+
+def propose_bounds(sorted_counts, low_quantile=0.01, high_quantile=0.99, margin=0.1):
+    """
+    (min_num, max_num) that the low_quantile..high_quantile range of
+    sorted_counts fits in, with margin (a fraction) of slack on both sides
+    """
+    low = _quantile(sorted_counts, low_quantile, False)
+    high = _quantile(sorted_counts, high_quantile, True)
+    min_num = int(math.floor(low * (1 - margin)))
+    max_num = max(int(math.ceil(high * (1 + margin))), min_num)
+    return max(min_num, 0), max_num
+
+
+def _count_bad(sorted_counts, min_num, max_num):
+    below = bisect.bisect_left(sorted_counts, min_num)
+    return below + len(sorted_counts) - bisect.bisect_right(sorted_counts, max_num, below)
+
+
+class MinuteTotals(object):
+    """
+    A checker's events per minute over [first_minute, first_minute +
+    60 * num_minutes), as running totals, so that any whole-minute window
+    can be counted with one subtraction
+    """
+
+    def __init__(self, first_minute, num_minutes, minute_counts):
+        """minute_counts -- rollup rows (minute_epoch, n, n_on_minute) in the range"""
+        self.first_minute = first_minute
+        n = [0] * num_minutes
+        self.n_on_minute = [0] * num_minutes
+        for minute_epoch, minute_n, minute_n_on_minute in minute_counts:
+            index = (minute_epoch - first_minute) // 60
+            n[index] = minute_n
+            self.n_on_minute[index] = minute_n_on_minute
+        # totals[i] is how many events there are before minute i
+        self.totals = [0] + list(itertools.accumulate(n))
+
+    def count_in_windows(self, minute_indexes, lookback_seconds):
+        """
+        Same as dwmon.count_in_windows for whole-minute windows inside the
+        range, with the minutes given as indexes from first_minute
+        """
+        totals = self.totals
+        n_on_minute = self.n_on_minute
+        lookback_minutes = lookback_seconds // 60
+        return [totals[i] - totals[i - lookback_minutes] + n_on_minute[i] for i in minute_indexes]
+
+
+def recommend_for_checker(checker_name, minute_totals, start_epoch, end_epoch,
+                          low_quantile=0.01, high_quantile=0.99, margin=0.1,
+                          schedule_cache=None):
+    """
+    One recommendation dict per requirements line of a checker, judged on
+    the minutes in [start_epoch, end_epoch] whose whole window is in range.
+    Args:
+    minute_totals -- the checker's MinuteTotals, starting at start_epoch
+    schedule_cache -- a dict for sharing the matching minutes (and their
+        indexes into minute_totals) of identical schedules between checkers
+    """
+    _, requirements_list, _ = dwmon.parse_config_file(checker_name)
+    requirements_lines = _requirements_lines(checker_name)
+    if schedule_cache is None:
+        schedule_cache = {}
+    recommendations = []
+    for line_number, (requirements, requirements_line) in enumerate(
+            zip(requirements_list, requirements_lines)):
+        lookback_seconds = requirements["lookback_seconds"]
+        schedule_key = tuple(requirements[x] for x in dwmon._SCHEDULE_FIELDS) + (lookback_seconds,)
+        if schedule_key not in schedule_cache:
+            minute_epochs = dwmon.matching_minutes(
+                requirements, start_epoch + lookback_seconds, end_epoch)
+            schedule_cache[schedule_key] = (
+                minute_epochs, [(x - start_epoch) // 60 for x in minute_epochs])
+        minute_epochs, minute_indexes = schedule_cache[schedule_key]
+        if not minute_epochs:
+            continue
+        if lookback_seconds % 60 == 0:
+            event_counts = minute_totals.count_in_windows(minute_indexes, lookback_seconds)
+        else:
+            timestamps = dwmon._get_event_timestamps(checker_name, start_epoch, end_epoch)
+            event_counts = dwmon.count_in_windows(timestamps, minute_epochs, lookback_seconds)
+        sorted_counts = sorted(event_counts)
+        min_num, max_num = propose_bounds(sorted_counts, low_quantile, high_quantile, margin)
+        proposed_line = re.sub(r"MINNUM\d+", "MINNUM%d" % min_num, requirements_line)
+        proposed_line = re.sub(r"MAXNUM\d+", "MAXNUM%d" % max_num, proposed_line)
+        recommendations.append({
+            "checker_name": checker_name,
+            "line": line_number + 1,
+            "minutes": len(sorted_counts),
+            "low_count": _quantile(sorted_counts, low_quantile, False),
+            "median_count": sorted_counts[len(sorted_counts) // 2],
+            "high_count": _quantile(sorted_counts, high_quantile, True),
+            "current_min": requirements["min_num"],
+            "current_max": requirements["max_num"],
+            "current_bad": _count_bad(
+                sorted_counts, requirements["min_num"], requirements["max_num"]),
+            "proposed_min": min_num,
+            "proposed_max": max_num,
+            "proposed_bad": _count_bad(sorted_counts, min_num, max_num),
+            "proposed_requirements": proposed_line,
+        })
+    return recommendations
+
+
+def recommend(checker_names, start_epoch, end_epoch, low_quantile=0.01, high_quantile=0.99,
+              margin=0.1):
+    """
+    Recommendations for every line of every one of checker_names.
+    start_epoch and end_epoch should be whole minutes.
+    """
+    num_minutes = (end_epoch - start_epoch) // 60 + 1
+    minute_counts_query = """
+        SELECT minute_epoch, n, n_on_minute FROM results_minute_counts
+        WHERE checker = ? AND minute_epoch BETWEEN ? AND ?
+    """
+    recommendations = []
+    schedule_cache = {}
+    for checker_name in sorted(set(checker_names)):
+        minute_counts = dwmon._get_rows_from_query(
+            minute_counts_query, (checker_name, start_epoch, end_epoch))
+        minute_totals = MinuteTotals(start_epoch, num_minutes, minute_counts)
+        recommendations.extend(recommend_for_checker(
+            checker_name, minute_totals, start_epoch, end_epoch,
+            low_quantile, high_quantile, margin, schedule_cache))
+    return recommendations
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", action="append", help="checker name, can be repeated, default all")
+    parser.add_argument("--days", type=int, default=28, help="how much history to learn from")
+    parser.add_argument("--low-quantile", type=float, default=0.01,
+                        help="MINNUM comes from this quantile of the window counts")
+    parser.add_argument("--high-quantile", type=float, default=0.99,
+                        help="MAXNUM comes from this quantile of the window counts")
+    parser.add_argument("--margin", type=float, default=0.1,
+                        help="widen the bounds by this fraction either side")
+    args = parser.parse_args()
+
+    end_epoch = int(time.time()) // 60 * 60
+    start_epoch = end_epoch - args.days * 24 * 3600
+    checker_names = args.c or dwmon.get_checker_names()
+
+    start_time = time.time()
+    fields = ["checker_name", "line", "minutes", "low_count", "median_count", "high_count",
+              "current_min", "current_max", "current_bad", "proposed_min", "proposed_max",
+              "proposed_bad", "proposed_requirements"]
+    print("|".join(fields))
+    for recommendation in recommend(checker_names, start_epoch, end_epoch, args.low_quantile,
+                                    args.high_quantile, args.margin):
+        print("|".join(str(recommendation[x]) for x in fields))
+    print("# recommended in %s seconds" % round(time.time() - start_time, 3))
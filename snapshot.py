@@ -0,0 +1,188 @@
+"""
+Exports every checker's result timestamps to a directory of compact binary
+files, so analytics (see histogram.py --snapshot) can run over long histories
+without going near the live database.
+
+Each checker gets <checker>.i64, its timestamps sorted ascending as little
+endian 64 bit integers, and manifest.json says how many are in each file and
+up to when they go.  Exports are incremental: each one appends the results
+stamped after the previous export, up to SNAPSHOT_SETTLE_SECONDS ago, so rows
+that arrive late still make it in.  Anything later than that is only picked
+up with --full, which rewrites the snapshot from scratch.  Results purged by
+retention stay in the snapshot.
+"""
+
+import argparse
+import array
+import bisect
+import json
+import mmap
+import os
+import sys
+import time
+
+import config
+import dwmon
+
+SNAPSHOT_VERSION = 1
+MANIFEST_NAME = "manifest.json"
+_EXPORT_CHUNK_ROWS = 100000
+
+
+def read_manifest(directory):
+    """The snapshot's manifest, or an empty one if there's no snapshot yet"""
+    path = os.path.join(directory, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {"version": SNAPSHOT_VERSION, "checkers": {}}
+    with open(path) as f:
+        manifest = json.load(f)
+    assert manifest["version"] == SNAPSHOT_VERSION, "Unknown snapshot version"
+    return manifest
+
+
+def _write_manifest(directory, manifest):
+    path = os.path.join(directory, MANIFEST_NAME)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+def _iter_timestamp_chunks(checker_name, after_epoch, through_epoch):
+    """
+    A checker's stored timestamps in (after_epoch, through_epoch], oldest
+    first, a chunk at a time as int64 arrays
+    """
+    tables = dwmon._results_tables(after_epoch, through_epoch)
+    timestamps_query = " UNION ALL ".join("""
+        SELECT timestamp FROM %s WHERE checker = ?
+        AND timestamp > ? AND timestamp <= ?
+    """ % x for x in tables) + " ORDER BY timestamp"
+    cursor = dwmon._get_connection().cursor().execute(
+        timestamps_query, (checker_name, after_epoch, through_epoch) * len(tables))
+    while True:
+        rows = cursor.fetchmany(_EXPORT_CHUNK_ROWS)
+        if not rows:
+            return
+        yield array.array("q", (int(x[0]) for x in rows))
+
+
+def export_snapshot(directory, checker_names=None, through_epoch=None, full=False):
+    """
+    Appends results stamped after the last export, up to through_epoch
+    (default SNAPSHOT_SETTLE_SECONDS ago), for every checker or just
+    checker_names.  full starts the snapshot over.  Returns {checker_name:
+    timestamps appended}.
+    """
+    if through_epoch is None:
+        through_epoch = int(time.time()) - config.SNAPSHOT_SETTLE_SECONDS
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    manifest = {"version": SNAPSHOT_VERSION, "checkers": {}} if full else read_manifest(directory)
+    if checker_names is None:
+        rows = dwmon._get_rows_from_query(
+            "SELECT DISTINCT checker FROM results_minute_counts ORDER BY checker", ())
+        checker_names = [x[0] for x in rows]
+    appended = {}
+    for checker_name in checker_names:
+        entry = manifest["checkers"].get(checker_name)
+        if entry is None:
+            entry = {"file": "%s.i64" % checker_name, "count": 0,
+                     "min_timestamp": None, "max_timestamp": None, "through_epoch": -2 ** 62}
+        if through_epoch <= entry["through_epoch"]:
+            continue
+        path = os.path.join(directory, entry["file"])
+        appended[checker_name] = 0
+        with open(path, "ab") as f:
+            # Throw away anything a previous export wrote but never got into the manifest
+            f.truncate(entry["count"] * 8)
+            chunks = _iter_timestamp_chunks(checker_name, entry["through_epoch"], through_epoch)
+            for chunk in chunks:
+                if entry["min_timestamp"] is None:
+                    entry["min_timestamp"] = chunk[0]
+                entry["max_timestamp"] = chunk[-1]
+                entry["count"] += len(chunk)
+                appended[checker_name] += len(chunk)
+                if sys.byteorder == "big":
+                    chunk.byteswap()
+                chunk.tofile(f)
+        entry["through_epoch"] = through_epoch
+        manifest["checkers"][checker_name] = entry
+    _write_manifest(directory, manifest)
+    return appended
+
+
+def load_timestamps(directory, checker_name, manifest=None):
+    """
+    A checker's snapshot timestamps as a sorted sequence of ints, memory
+    mapped rather than read in where the platform allows
+    """
+    entry = (manifest or read_manifest(directory))["checkers"][checker_name]
+    if not entry["count"]:
+        return array.array("q")
+    with open(os.path.join(directory, entry["file"]), "rb") as f:
+        if sys.byteorder == "big":
+            timestamps = array.array("q")
+            timestamps.fromfile(f, entry["count"])
+            timestamps.byteswap()
+            return timestamps
+        mapped = mmap.mmap(f.fileno(), entry["count"] * 8, access=mmap.ACCESS_READ)
+    return memoryview(mapped).cast("q")
+
+
+def _day_of_week(epoch):
+    """0 for Sunday, like strftime's %w.  The epoch fell on a Thursday."""
+    return (epoch // 86400 + 4) % 7
+
+
+# How to bucket for each kind of histogram, and what each bucket's start (in UTC) counts as
+HISTOGRAM_KINDS = {
+    "hour": (3600, lambda epoch: (epoch // 3600 % 24,)),
+    "minute": (60, lambda epoch: (epoch // 60 % 60,)),
+    "day_of_week": (3600, lambda epoch: (_day_of_week(epoch),)),
+    "day_of_week_hour": (3600, lambda epoch: (_day_of_week(epoch), epoch // 3600 % 24)),
+}
+
+
+def histogram(timestamps, kind, seconds_lower=None, seconds_upper=None):
+    """
+    Event counts by hour of day, minute of hour, day of week (0 is Sunday) or
+    day of week and hour, all in UTC like the SQL histogram.  Rather than
+    looking at every timestamp, the sorted array is cut at each bucket
+    boundary with a binary search, so the work goes with the length of the
+    history, not the number of events.  Returns {key tuple: count}.
+    """
+    bucket_seconds, get_key = HISTOGRAM_KINDS[kind]
+    if not len(timestamps):
+        return {}
+    if seconds_lower is None:
+        seconds_lower = timestamps[0]
+    if seconds_upper is None:
+        seconds_upper = timestamps[-1]
+    counts = {}
+    bucket_start = int(seconds_lower) // bucket_seconds * bucket_seconds
+    position = bisect.bisect_left(timestamps, seconds_lower)
+    while bucket_start <= seconds_upper:
+        bucket_end = min(bucket_start + bucket_seconds, seconds_upper + 1)
+        next_position = bisect.bisect_left(timestamps, bucket_end, position)
+        if next_position > position:
+            key = get_key(bucket_start)
+            counts[key] = counts.get(key, 0) + next_position - position
+        position = next_position
+        bucket_start += bucket_seconds
+    return counts
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directory", help="where the snapshot lives")
+    parser.add_argument("-c", action="append", help="checker name, can be repeated, default all")
+    parser.add_argument("--full", action="store_true", help="rewrite the snapshot from scratch")
+    args = parser.parse_args()
+
+    start_time = time.time()
+    appended = export_snapshot(args.directory, args.c, full=args.full)
+    print("checker|timestamps_appended")
+    for checker_name in sorted(appended):
+        print("%s|%s" % (checker_name, appended[checker_name]))
+    print("# exported in %s seconds" % round(time.time() - start_time, 3))
@@ -1,6 +1,19 @@
+import functools
+import json
+import math
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
 import unittest
+import urllib.request
 
 import dwmon
+import handler_dispatch
+import metrics
 
 class CronTests(unittest.TestCase):
 
@@ -76,3 +89,1444 @@ class CronTests(unittest.TestCase):
         self.assertFalse(dwmon.matches_time_pattern(requirements_2, epoch))
         self.assertFalse(dwmon.matches_time_pattern(requirements_3, epoch))
 
+
+
+def sqlite_only(test):
+    """For tests of things only the sqlite storage engine has"""
+    @functools.wraps(test)
+    def wrapper(self):
+        if self.STORAGE_ENGINE != "sqlite":
+            raise unittest.SkipTest("sqlite storage engine only")
+        return test(self)
+    return wrapper
+
+
+class DatabaseTestCase(unittest.TestCase):
+    """
+    Points dwmon at a throwaway sqlite file, and a fresh storage engine, for
+    the duration of a test
+    """
+
+    # The Memory* subclasses at the bottom run the same tests on the memory engine
+    STORAGE_ENGINE = "sqlite"
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.old_db_name = dwmon.DB_NAME
+        dwmon.DB_NAME = os.path.join(self.tmp_dir, "dwmon_test.db")
+        self.old_storage_engine = dwmon.config.STORAGE_ENGINE
+        dwmon.config.STORAGE_ENGINE = self.STORAGE_ENGINE
+        dwmon.reset_storage_engine()
+        dwmon.create_tables()
+
+    def tearDown(self):
+        dwmon.close_connection()
+        dwmon._WINDOW_INDEXES.clear()
+        dwmon.DB_NAME = self.old_db_name
+        dwmon.config.STORAGE_ENGINE = self.old_storage_engine
+        dwmon.reset_storage_engine()
+        shutil.rmtree(self.tmp_dir)
+
+    def count_results(self, checker_name):
+        if self.STORAGE_ENGINE != "sqlite":
+            return len(dwmon._get_event_timestamps(checker_name, -2 ** 62, 2 ** 62))
+        rows = dwmon._get_rows_from_query(
+            "SELECT count(1) FROM results WHERE checker = ?", (checker_name,))
+        return rows[0][0]
+
+
+class StoreResultsTests(DatabaseTestCase):
+
+    def test_dedupes_against_existing_and_within_batch(self):
+        dwmon.store_results("a", [(1, 100), (2, 101), (2, 101)])
+        dwmon.store_results("a", [(1, 100), (3, 102)])
+        self.assertEqual(self.count_results("a"), 3)
+
+    def test_switching_to_hashed_keys_keeps_deduping(self):
+        dwmon.store_results("a", [(i, 100 + i) for i in range(5)])
+        dwmon.store_results("b", [(1, 100)])
+        # A conversion rolled back with the rest leaves the plain keys in place
+        with self.assertRaises(ValueError):
+            with dwmon.get_storage_engine().transaction():
+                dwmon.store_results("a", [(9, 109)], hashed_keys=True)
+                raise ValueError("handler blew up")
+        dwmon.store_results("a", [(i, 100 + i) for i in range(3, 8)], hashed_keys=True)
+        self.assertEqual(self.count_results("a"), 8)
+        dwmon.store_results("a", [(i, 100 + i) for i in range(8)], hashed_keys=True)
+        self.assertEqual(self.count_results("a"), 8)
+        dwmon.store_results("b", [(1, 100)])
+        self.assertEqual(self.count_results("b"), 1)
+
+    def test_same_key_different_checkers(self):
+        dwmon.store_results("a", [("x", 100)])
+        dwmon.store_results("b", [("x", 100)])
+        self.assertEqual(self.count_results("a"), 1)
+        self.assertEqual(self.count_results("b"), 1)
+
+    def test_rollback_undoes_every_write(self):
+        dwmon.store_results("a", [(1, 100)])
+        dwmon.log_check("a", 60)
+        dwmon.advance_watermark("a", 100)
+        with self.assertRaises(ValueError):
+            with dwmon.get_storage_engine().transaction():
+                dwmon.store_results("a", [(3, 200), (2, 50)])
+                dwmon.log_check("a", 120)
+                dwmon.advance_watermark("a", 200)
+                raise ValueError("handler blew up")
+        self.assertEqual(self.count_results("a"), 1)
+        self.assertEqual(dwmon.get_storage_engine().get_checked_minutes("a"), [60])
+        self.assertEqual(dwmon.get_time_of_most_recent_check("a"), 60)
+        self.assertEqual(dwmon.get_watermark("a"), 100)
+        # The rolled back keys aren't in the way of storing them for real
+        dwmon.store_results("a", [(2, 50)])
+        self.assertEqual(self.count_results("a"), 2)
+
+    def test_bookkeeping_is_forgotten_with_the_results(self):
+        dwmon.store_results("a", [(1, 100)])
+        dwmon.advance_watermark("a", 100)
+        dwmon.record_fetch("a", 100, True)
+        # A restart: the memory engine forgets everything, sqlite nothing
+        dwmon.close_connection()
+        dwmon.reset_storage_engine()
+        kept = self.count_results("a") == 1
+        self.assertEqual(dwmon.get_watermark("a") is not None, kept)
+        self.assertEqual(dwmon.get_fetch_state("a") is not None, kept)
+
+    @sqlite_only
+    def test_migrate_collapses_old_duplicates(self):
+        dwmon._write_query("DROP INDEX idx_results_checker_id", ())
+        dwmon._write_query("CREATE INDEX idx_results_id ON results (unique_id)", ())
+        dwmon._write_query(
+            "INSERT INTO results (checker, unique_id, timestamp) VALUES (?, ?, ?)",
+            [("a", "1", 100), ("a", "1", 200), ("a", "2", 300)], many=True)
+        dwmon.migrate_results_dedup()
+        self.assertEqual(self.count_results("a"), 2)
+        rows = dwmon._get_rows_from_query(
+            "SELECT timestamp FROM results WHERE unique_id = '1'", ())
+        self.assertEqual(rows, [(100,)])
+        dwmon.store_results("a", [(1, 400)])
+        self.assertEqual(self.count_results("a"), 2)
+
+
+class TransactionTests(DatabaseTestCase):
+
+    def test_writes_commit_together(self):
+        with dwmon.transaction():
+            dwmon.log_check("a", 60)
+            dwmon.store_results("a", [(1, 100)])
+            with dwmon.transaction():
+                dwmon.log_check("a", 120)
+        other_conn = sqlite3.connect(dwmon.DB_NAME)
+        rows = other_conn.execute("SELECT count(1) FROM checks").fetchall()
+        other_conn.close()
+        self.assertEqual(rows, [(2,)])
+
+    def test_rolls_back_on_error(self):
+        with self.assertRaises(ValueError):
+            with dwmon.transaction():
+                dwmon.log_check("a", 60)
+                raise ValueError("handler blew up")
+        self.assertEqual(dwmon.get_time_of_most_recent_check("a"), None)
+
+    def test_read_then_write_waits_for_other_writers(self):
+        other_wrote = threading.Event()
+
+        def other_worker():
+            dwmon.log_check("a", 120)
+            other_wrote.set()
+            dwmon.close_connection()
+
+        with dwmon.transaction():
+            self.assertEqual(dwmon.get_time_of_most_recent_check("a"), None)
+            other = threading.Thread(target=other_worker)
+            other.start()
+            # The other worker's write has to wait for ours, rather than ours failing
+            self.assertFalse(other_wrote.wait(0.3))
+            dwmon.log_check("a", 60)
+        other.join()
+        self.assertEqual(dwmon.get_storage_engine().get_checked_minutes("a"), [60, 120])
+
+    def test_uses_wal(self):
+        rows = dwmon._get_rows_from_query("PRAGMA journal_mode", ())
+        self.assertEqual(rows, [("wal",)])
+
+
+class BatchedHistoryCheckTests(DatabaseTestCase):
+
+    def test_matches_single_checks(self):
+        rand = random.Random(3)
+        base = 1455997920
+        rows = [(i, base - rand.randint(0, 7200)) for i in range(500)]
+        # Events sitting exactly on window edges must be counted the same way
+        rows += [("edge_%s" % i, base - 60 * i) for i in range(30)]
+        dwmon.store_results("a", rows)
+        dwmon.store_results("b", [(1, base)])
+
+        for lookback in [60, 90, 180, 3600]:
+            requirements = dwmon.parse_requirements(
+                "CHECKHOURS0-23 CHECKMINUTES0-59 WEEKDAYS WEEKENDS "
+                "MINNUM5 MAXNUM20 LOOKBACKSECONDS%s" % lookback)
+            minutes = [base - 60 * i for i in range(0, 90, 7)]
+            batched = dwmon.do_batched_history_check("a", minutes, requirements)
+            singles = [
+                dwmon.do_single_history_check("a", x, requirements) for x in minutes
+            ]
+            self.assertEqual(batched, singles)
+
+    def test_no_minutes(self):
+        requirements = dwmon.parse_requirements(
+            "CHECKHOURS0-23 CHECKMINUTES0-59 WEEKDAYS WEEKENDS "
+            "MINNUM5 MAXNUM20 LOOKBACKSECONDS60")
+        self.assertEqual(dwmon.do_batched_history_check("a", [], requirements), [])
+
+    def test_single_check_counts_ragged_edges(self):
+        dwmon.store_results("a", [(1, 29), (2, 30), (3, 60), (4, 119), (5, 120), (6, 121)])
+        for lookback, expected in [(60, 3), (90, 4), (91, 5), (30, 2)]:
+            requirements = dwmon.parse_requirements(EVERY_MINUTE.replace("60", str(lookback)))
+            details = dwmon.do_single_history_check("a", 120, requirements)
+            self.assertEqual(details["event_count"], expected)
+
+    def test_fractional_timestamps_count_where_they_fall(self):
+        dwmon.store_results("a", [(1, 59.9), (2, 60.5), (3, 119.4), (4, 120.4), (5, 180.5)])
+        requirements = dwmon.parse_requirements(EVERY_MINUTE)
+        minutes = [60, 120, 180]
+        singles = [dwmon.do_single_history_check("a", x, requirements) for x in minutes]
+        self.assertEqual([x["event_count"] for x in singles], [1, 2, 1])
+        self.assertEqual(dwmon.do_batched_history_check("a", minutes, requirements), singles)
+
+    def test_count_in_windows_is_inclusive(self):
+        counts = dwmon.count_in_windows([10, 20, 20, 30], [20, 30, 40], 10)
+        self.assertEqual(counts, [3, 3, 1])
+
+
+class MigrationTests(DatabaseTestCase):
+
+    def index_names(self):
+        rows = dwmon._get_rows_from_query(
+            "SELECT name FROM sqlite_master WHERE type = 'index'", ())
+        return set(x[0] for x in rows)
+
+    def test_new_database_is_current(self):
+        self.assertEqual(dwmon.get_schema_version(), dwmon.SCHEMA_MIGRATIONS[-1][0])
+        self.assertTrue("idx_results_checker_ts" in self.index_names())
+        self.assertTrue("idx_checks_checker_ts" in self.index_names())
+        self.assertFalse("idx_checker_key" in self.index_names())
+
+    def test_upgrades_old_database(self):
+        dwmon.close_connection()
+        os.remove(dwmon.DB_NAME)
+        old_conn = sqlite3.connect(dwmon.DB_NAME)
+        old_conn.execute("CREATE TABLE results (unique_id text, checker text, timestamp integer)")
+        old_conn.execute("CREATE INDEX idx_results_id ON results (unique_id)")
+        old_conn.execute("CREATE TABLE checks (checker text, timestamp integer)")
+        old_conn.execute("CREATE INDEX idx_checker_key ON checks (checker)")
+        old_conn.execute("INSERT INTO checks VALUES ('a', 60)")
+        old_conn.execute("INSERT INTO checks VALUES ('a', 60)")
+        old_conn.commit()
+        old_conn.close()
+
+        self.assertEqual(dwmon.get_schema_version(), 0)
+        dwmon.migrate_schema()
+        self.assertEqual(dwmon.get_schema_version(), dwmon.SCHEMA_MIGRATIONS[-1][0])
+        self.assertFalse("idx_results_id" in self.index_names())
+        self.assertEqual(dwmon.get_time_of_most_recent_check("a"), 60)
+        self.assertEqual(dwmon._get_rows_from_query("SELECT count(1) FROM checks", ())[0][0], 1)
+        # Running it again is a no-op
+        dwmon.migrate_schema()
+
+    def test_most_recent_check_uses_index(self):
+        plan = dwmon._get_rows_from_query(
+            "EXPLAIN QUERY PLAN SELECT max(timestamp) FROM checks WHERE checker = ?",
+            ("a",))
+        self.assertTrue("idx_checks_checker_ts" in plan[0][-1])
+
+
+EVERY_MINUTE = "CHECKHOURS0-23 CHECKMINUTES0-59 WEEKDAYS WEEKENDS " \
+    "MINNUM0 MAXNUM20 LOOKBACKSECONDS60"
+
+
+class FakeRowGetter(object):
+    """Stands in for your_org.your_orgs_row_getter"""
+
+    def __init__(self, rows_by_source=None, delays_by_source=None):
+        self.rows_by_source = rows_by_source or {}
+        self.delays_by_source = delays_by_source or {}
+        self.calls = []
+        self.running = 0
+        self.most_running = 0
+        self.lock = threading.Lock()
+
+    def get_rows_from_query(self, query_details):
+        with self.lock:
+            self.calls.append(query_details)
+            self.running += 1
+            self.most_running = max(self.most_running, self.running)
+        try:
+            time.sleep(self.delays_by_source.get(query_details["source"], 0))
+            return list(self.rows_by_source.get(query_details["source"], []))
+        finally:
+            with self.lock:
+                self.running -= 1
+
+
+class FailingRowGetter(object):
+    """A row getter whose warehouse is down"""
+
+    def get_rows_from_query(self, query_details):
+        raise RuntimeError("warehouse is down")
+
+
+class FakeCheckHandler(object):
+    """Stands in for your_org.your_orgs_check_handler"""
+
+    def __init__(self):
+        self.handled = []
+
+    def handle_check(self, details, extra_config):
+        self.handled.append(details)
+
+
+class FakeRowPurger(object):
+    """Stands in for your_org.your_orgs_row_purger"""
+
+    def __init__(self, epochs_by_checker=None):
+        self.epochs_by_checker = epochs_by_checker or {}
+
+    def identify_old(self, checker_name, extra_config):
+        return {"delete_older_than_epoch": self.epochs_by_checker.get(checker_name)}
+
+
+class CheckAllTestCase(DatabaseTestCase):
+    """A database plus a configs folder and fake org hooks for driving check_all"""
+
+    def setUp(self):
+        super(CheckAllTestCase, self).setUp()
+        self.old_configs_folder = dwmon.CONFIGS_FOLDER
+        dwmon.CONFIGS_FOLDER = os.path.join(self.tmp_dir, "configs")
+        os.mkdir(dwmon.CONFIGS_FOLDER)
+        self.row_getter = FakeRowGetter()
+        self.check_handler = FakeCheckHandler()
+        dwmon.your_orgs_row_getter = self.row_getter
+        dwmon.your_orgs_check_handler = self.check_handler
+        self.row_purger = FakeRowPurger()
+        dwmon.your_orgs_row_purger = self.row_purger
+        self.old_config = dict(
+            (x, getattr(dwmon.config, x)) for x in dir(dwmon.config) if x.isupper())
+        # Handlers run inline unless a test says otherwise, so they're done when check_all is
+        dwmon.config.HANDLER_WORKERS = 0
+        dwmon.config.HANDLER_JOURNAL_PATH = os.path.join(self.tmp_dir, "journal.jsonl")
+        dwmon.config.HANDLER_FAILED_PATH = os.path.join(self.tmp_dir, "failed.jsonl")
+
+    def tearDown(self):
+        dwmon.close_handler_dispatcher()
+        for key, value in self.old_config.items():
+            setattr(dwmon.config, key, value)
+        dwmon.CONFIGS_FOLDER = self.old_configs_folder
+        super(CheckAllTestCase, self).tearDown()
+
+    def write_config(self, checker_name, requirements, source="TEST", extra="{}",
+                     query="SELECT 1 AS dwmon_unique_key, 1 AS dwmon_timestamp"):
+        path = os.path.join(dwmon.CONFIGS_FOLDER, checker_name + ".dwmon")
+        with open(path, "w") as f_handle:
+            f_handle.write("__QUERY__\n%s\n__REQUIREMENTS__\n%s\n__SOURCE__\n%s\n__EXTRA__\n%s\n"
+                           % (query, requirements, source, extra))
+        return path
+
+    def checked_minutes(self, checker_name):
+        return dwmon.get_storage_engine().get_checked_minutes(checker_name)
+
+
+class CheckAllTests(CheckAllTestCase):
+
+    def test_checks_every_eligible_minute_once(self):
+        self.write_config("a", EVERY_MINUTE)
+        dwmon.check_all()
+        # An every-minute 60 second lookback rewinds 10 minutes
+        self.assertEqual(len(self.checked_minutes("a")), 10)
+        self.assertEqual(len(self.check_handler.handled), 10)
+        dwmon.check_all()
+        self.assertTrue(len(self.checked_minutes("a")) <= 11)
+
+    def test_slow_fetch_times_out_without_holding_others(self):
+        dwmon.config.FETCH_TIMEOUT_SECONDS = 0.2
+        self.row_getter.delays_by_source = {"SLOW": 1.5}
+        self.write_config("slow", EVERY_MINUTE, source="SLOW")
+        self.write_config("fast", EVERY_MINUTE, source="FAST")
+        start_time = time.time()
+        dwmon.check_all()
+        self.assertTrue(time.time() - start_time < 1.5)
+        self.assertEqual(self.checked_minutes("slow"), [])
+        self.assertEqual(len(self.checked_minutes("fast")), 10)
+
+    def test_time_spent_on_other_checkers_isnt_a_timeout(self):
+        dwmon.config.FETCH_TIMEOUT_SECONDS = 0.3
+        # b's fetch is done long before we've finished with a's checks
+        self.row_getter.delays_by_source = {"B": 0.05}
+        handle_check = self.check_handler.handle_check
+
+        def slow_for_a(details, extra_config):
+            if details["checker_name"] == "a" and not self.check_handler.handled:
+                time.sleep(0.8)
+            handle_check(details, extra_config)
+
+        self.check_handler.handle_check = slow_for_a
+        self.write_config("a", EVERY_MINUTE, source="A")
+        self.write_config("b", EVERY_MINUTE, source="B")
+        fetch_cache = dwmon.check_all()
+        self.assertEqual(fetch_cache.deferred, {})
+        self.assertEqual(len(self.checked_minutes("b")), 10)
+
+    def test_per_source_concurrency_cap(self):
+        dwmon.config.FETCH_CONCURRENCY_OVERRIDES = {"CAPPED": 1}
+        self.row_getter.delays_by_source = {"CAPPED": 0.05}
+        for i in range(4):
+            self.write_config("c%s" % i, EVERY_MINUTE, source="CAPPED",
+                              query="SELECT %s AS dwmon_unique_key, 1 AS dwmon_timestamp" % i)
+        dwmon.check_all()
+        self.assertEqual(len(self.row_getter.calls), 4)
+        self.assertEqual(self.row_getter.most_running, 1)
+
+
+class ConfigCacheTests(CheckAllTestCase):
+
+    def touch(self, path, mtime):
+        os.utime(path, (mtime, mtime))
+
+    def test_only_reparses_changed_files(self):
+        path = self.write_config("a", EVERY_MINUTE)
+        first = dwmon.load_checker_config("a")
+        self.assertTrue(dwmon.load_checker_config("a") is first)
+
+        self.write_config("a", EVERY_MINUTE.replace("MAXNUM20", "MAXNUM30"))
+        self.touch(path, time.time() + 10)
+        second = dwmon.load_checker_config("a")
+        self.assertFalse(second is first)
+        self.assertEqual(second[1][0]["max_num"], 30)
+
+    def test_broken_edit_keeps_last_good_version(self):
+        path = self.write_config("a", EVERY_MINUTE)
+        good = dwmon.load_checker_config("a")
+        self.write_config("a", EVERY_MINUTE, extra="{not json")
+        self.touch(path, time.time() + 10)
+        with self.assertLogs(level="ERROR"):
+            self.assertTrue(dwmon.load_checker_config("a") is good)
+
+    def test_broken_new_config_still_raises(self):
+        self.write_config("a", EVERY_MINUTE, extra="{not json")
+        with self.assertRaises(ValueError):
+            dwmon.load_checker_config("a")
+
+    def test_deleted_configs_are_forgotten(self):
+        path = self.write_config("a", EVERY_MINUTE)
+        dwmon.load_checker_config("a")
+        os.remove(path)
+        dwmon._forget_missing_configs([])
+        self.assertFalse(path in dwmon._CONFIG_CACHE)
+
+
+class ScheduleTests(unittest.TestCase):
+
+    TIMEZONES = ["America/Chicago", "UTC", "Asia/Kolkata", "Australia/Lord_Howe"]
+    # Ranges straddling DST changes (Chicago spring 2016 and fall 2016) and a week boundary
+    STARTS = [1457852400, 1478413800, 1456012800, 1455997930]
+
+    def setUp(self):
+        self.old_tz = os.environ.get("TZ")
+
+    def tearDown(self):
+        if self.old_tz is None:
+            del os.environ["TZ"]
+        else:
+            os.environ["TZ"] = self.old_tz
+        time.tzset()
+
+    def random_requirements(self, rand):
+        hours = sorted([rand.randint(0, 23), rand.randint(0, 23)])
+        if rand.random() < 0.3:
+            minutes = "*/%s" % rand.randint(1, 30)
+        else:
+            minutes = "%s-%s" % tuple(sorted([rand.randint(0, 59), rand.randint(0, 59)]))
+        days = rand.choice(["WEEKDAYS", "WEEKENDS", "WEEKDAYS WEEKENDS"])
+        return dwmon.parse_requirements(
+            "CHECKHOURS%s-%s CHECKMINUTES%s %s MINNUM0 MAXNUM5 LOOKBACKSECONDS60"
+            % (hours[0], hours[1], minutes, days))
+
+    def test_matching_minutes_agrees_with_matches_time_pattern(self):
+        rand = random.Random(7)
+        for timezone in self.TIMEZONES:
+            os.environ["TZ"] = timezone
+            time.tzset()
+            for start in self.STARTS:
+                for _ in range(6):
+                    requirements = self.random_requirements(rand)
+                    lower = start - rand.randint(0, 3 * 24 * 3600)
+                    upper = start + rand.randint(0, 3 * 24 * 3600)
+                    expected = [
+                        x for x in range(int(math.ceil(lower / 60.0)) * 60, upper + 1, 60)
+                        if dwmon.matches_time_pattern(requirements, x)
+                    ]
+                    self.assertEqual(
+                        dwmon.matching_minutes(requirements, lower, upper), expected)
+
+    def test_next_due_minute(self):
+        rand = random.Random(11)
+        for timezone in self.TIMEZONES:
+            os.environ["TZ"] = timezone
+            time.tzset()
+            for start in self.STARTS:
+                requirements = self.random_requirements(rand)
+                minute_epoch = start // 60 * 60 + 60
+                while not dwmon.matches_time_pattern(requirements, minute_epoch):
+                    minute_epoch += 60
+                self.assertEqual(dwmon.next_due_minute(requirements, start), minute_epoch)
+
+
+class IncrementalFetchTests(CheckAllTestCase):
+
+    def test_not_incremental_by_default(self):
+        prepared = dwmon.prepare_query_details("a", {"query": "q", "source": "s"}, {})
+        self.assertEqual(prepared["params"], ())
+
+    def test_watermark_is_passed_and_persisted(self):
+        extra = '{"dwmon_incremental": true, "dwmon_watermark_overlap_seconds": 60}'
+        self.write_config("a", EVERY_MINUTE, source="INC", extra=extra)
+        self.row_getter.rows_by_source = {"INC": [(1, 1000), (2, 1500), (3, 1200)]}
+        dwmon.check_all()
+        self.assertEqual(self.row_getter.calls[0]["params"], (0,))
+
+        # Survives a reconnect, and only ever moves forward
+        dwmon.close_connection()
+        self.assertEqual(dwmon.get_watermark("a"), 1500)
+        dwmon.advance_watermark("a", 1100)
+        self.assertEqual(dwmon.get_watermark("a"), 1500)
+
+        query_details, _, extra_config = dwmon.load_checker_config("a")
+        prepared = dwmon.prepare_query_details("a", query_details, extra_config)
+        self.assertEqual(prepared["params"], (1440,))
+
+
+class StreamingStoreTests(DatabaseTestCase):
+
+    def setUp(self):
+        super(StreamingStoreTests, self).setUp()
+        self.old_batch_size = dwmon.STORE_BATCH_SIZE
+        dwmon.STORE_BATCH_SIZE = 10
+
+    def tearDown(self):
+        dwmon.STORE_BATCH_SIZE = self.old_batch_size
+        super(StreamingStoreTests, self).tearDown()
+
+    def test_generator_is_consumed_in_chunks(self):
+        stored_while_yielding = []
+
+        def rows():
+            for i in range(25):
+                stored_while_yielding.append(self.count_results("a"))
+                yield (i, 1000 + i)
+
+        self.assertEqual(dwmon.store_results("a", rows()), 1024)
+        self.assertEqual(self.count_results("a"), 25)
+        self.assertEqual(stored_while_yielding, [(i // 10) * 10 for i in range(25)])
+
+    def test_cursor(self):
+        source_conn = sqlite3.connect(":memory:")
+        source_conn.execute("CREATE TABLE things (id integer, ts integer)")
+        source_conn.executemany("INSERT INTO things VALUES (?, ?)", [(i, i) for i in range(33)])
+        cursor = source_conn.execute("SELECT id, ts FROM things")
+        self.assertEqual(dwmon.store_results("a", cursor), 32)
+        self.assertEqual(self.count_results("a"), 33)
+        source_conn.close()
+
+    def test_empty(self):
+        self.assertEqual(dwmon.store_results("a", iter([])), None)
+
+
+class CursorRowGetter(object):
+    """A row getter that hands back a live cursor on its own sqlite database"""
+
+    def __init__(self, path, rows):
+        self.path = path
+        source_conn = sqlite3.connect(path)
+        source_conn.execute("CREATE TABLE things (id integer, ts integer)")
+        source_conn.executemany("INSERT INTO things VALUES (?, ?)", rows)
+        source_conn.commit()
+        source_conn.close()
+
+    def get_rows_from_query(self, query_details):
+        return sqlite3.connect(self.path).execute("SELECT id, ts FROM things")
+
+
+class StreamingFetchTests(CheckAllTestCase):
+
+    NOW = 1455997920
+
+    def setUp(self):
+        super(StreamingFetchTests, self).setUp()
+        self.old_batch_size = dwmon.STORE_BATCH_SIZE
+        dwmon.STORE_BATCH_SIZE = 10
+
+    def tearDown(self):
+        dwmon.STORE_BATCH_SIZE = self.old_batch_size
+        super(StreamingFetchTests, self).tearDown()
+
+    def test_cursor_is_read_on_the_fetch_worker(self):
+        dwmon.your_orgs_row_getter = CursorRowGetter(
+            os.path.join(self.tmp_dir, "source.db"), [(i, self.NOW - i) for i in range(95)])
+        self.write_config("a", EVERY_MINUTE)
+        dwmon.check_all(current_epoch=self.NOW)
+        self.assertEqual(self.count_results("a"), 95)
+        self.assertEqual(self.checked_minutes("a")[-1], self.NOW)
+
+    def test_stalled_fetch_is_given_up_on(self):
+        dwmon.config.FETCH_TIMEOUT_SECONDS = 0.3
+
+        def rows():
+            yield (1, self.NOW)
+            time.sleep(1.5)
+            yield (2, self.NOW)
+
+        self.row_getter.get_rows_from_query = lambda query_details: rows()
+        self.write_config("a", EVERY_MINUTE)
+        fetch_cache = dwmon.check_all(current_epoch=self.NOW)
+        self.assertEqual(fetch_cache.deferred, {"a": (set([0]), self.NOW)})
+        self.assertEqual(self.count_results("a"), 0)
+
+    def test_broken_fetch_only_loses_its_own_checker(self):
+        def rows():
+            yield (1, self.NOW)
+            raise RuntimeError("connection reset")
+
+        self.row_getter.rows_by_source = {"GOOD": [(1, self.NOW)]}
+        getter = self.row_getter.get_rows_from_query
+        self.row_getter.get_rows_from_query = lambda query_details: (
+            rows() if query_details["source"] == "BAD" else getter(query_details))
+        self.write_config("bad", EVERY_MINUTE, source="BAD")
+        self.write_config("good", EVERY_MINUTE, source="GOOD")
+        fetch_cache = dwmon.check_all(current_epoch=self.NOW)
+        self.assertEqual(fetch_cache.deferred, {"bad": (set([0]), self.NOW)})
+        self.assertEqual(self.count_results("bad"), 0)
+        self.assertEqual(self.checked_minutes("bad"), [])
+        self.assertEqual(self.checked_minutes("good")[-1], self.NOW)
+
+
+class SchedulerTests(CheckAllTestCase):
+
+    # A Saturday, 13:52 in Chicago
+    NOW = 1455997920
+
+    def test_runs_only_due_lines(self):
+        self.write_config("every", EVERY_MINUTE)
+        self.write_config("hourly", EVERY_MINUTE.replace("CHECKMINUTES0-59", "CHECKMINUTES0-0")
+                          + "\n" + EVERY_MINUTE.replace("0-59", "*/2"))
+        scheduler = dwmon.Scheduler()
+
+        # Everything is new, so everything is due for its catch-up
+        self.assertEqual(scheduler.run_once(self.NOW), {"every": set([0]), "hourly": set([0, 1])})
+        self.assertEqual(scheduler.run_once(self.NOW + 30), {})
+        self.assertEqual(scheduler.run_once(self.NOW + 60), {"every": set([0])})
+        self.assertEqual(scheduler.run_once(self.NOW + 120), {"every": set([0]), "hourly": set([1])})
+        # Top of the hour
+        self.assertEqual(scheduler.run_once(self.NOW + 480),
+                         {"every": set([0]), "hourly": set([0, 1])})
+        self.assertEqual(self.checked_minutes("every")[-1], self.NOW + 480)
+
+    def test_catches_up_after_a_long_cycle(self):
+        self.write_config("every", EVERY_MINUTE)
+        scheduler = dwmon.Scheduler()
+        scheduler.run_once(self.NOW)
+        scheduler.run_once(self.NOW + 300)
+        checked = self.checked_minutes("every")
+        self.assertEqual(checked[-5:], [self.NOW + 60 * i for i in range(1, 6)])
+        # Nothing stale piles up on the heap
+        self.assertEqual(len(scheduler.heap), 1)
+
+    def test_edited_config_is_due_immediately(self):
+        path = self.write_config("hourly", EVERY_MINUTE.replace("0-59", "0-0"))
+        scheduler = dwmon.Scheduler()
+        scheduler.run_once(self.NOW)
+        self.write_config("hourly", EVERY_MINUTE.replace("0-59", "0-0").replace("MAXNUM20", "MAXNUM9"))
+        os.utime(path, (time.time() + 10, time.time() + 10))
+        self.assertEqual(scheduler.run_once(self.NOW + 60), {"hourly": set([0])})
+        self.assertEqual(scheduler.run_once(self.NOW + 120), {})
+
+    def test_failed_fetch_is_retried_at_the_next_wakeup(self):
+        minute = self.NOW // 60 % 60
+        self.write_config("hourly", EVERY_MINUTE.replace("0-59", "%d-%d" % (minute, minute)))
+        scheduler = dwmon.Scheduler()
+        dwmon.your_orgs_row_getter = FailingRowGetter()
+        self.assertEqual(scheduler.run_once(self.NOW), {"hourly": set([0])})
+        self.assertEqual(self.checked_minutes("hourly"), [])
+        # Not due again by its schedule for an hour, when its lookback no longer reaches NOW
+        dwmon.your_orgs_row_getter = self.row_getter
+        self.assertEqual(scheduler.run_once(self.NOW + 60), {"hourly": set([0])})
+        self.assertEqual(self.checked_minutes("hourly"), [self.NOW])
+        self.assertEqual(scheduler.run_once(self.NOW + 120), {})
+
+
+class WorkerLeaseTests(CheckAllTestCase):
+
+    NOW = 1455997920
+
+    def test_log_check_only_once(self):
+        self.assertTrue(dwmon.log_check("a", 60))
+        self.assertFalse(dwmon.log_check("a", 60))
+        self.assertEqual(self.checked_minutes("a"), [60])
+
+    def test_workers_share_checkers_and_take_over_from_dead_ones(self):
+        checker_names = ["c%s" % i for i in range(6)]
+        for checker_name in checker_names:
+            self.write_config(checker_name, EVERY_MINUTE)
+        worker_a = dwmon.Scheduler("a")
+        worker_b = dwmon.Scheduler("b")
+        # a is alone at first, so it takes everything, and hands half over once b shows up
+        self.assertEqual(sorted(worker_a.run_once(self.NOW)), checker_names)
+        self.assertEqual(worker_b.run_once(self.NOW), {})
+        for minute in range(1, 4):
+            worker_a.run_once(self.NOW + 60 * minute)
+            worker_b.run_once(self.NOW + 60 * minute)
+        self.assertEqual(len(worker_a.leased), 3)
+        self.assertEqual(worker_a.leased | worker_b.leased, set(checker_names))
+        for checker_name in checker_names:
+            self.assertEqual(self.checked_minutes(checker_name)[-4:],
+                             [self.NOW + 60 * i for i in range(4)])
+        # Every logged check was handled exactly once
+        handled = [(x["checker_name"], x["minute_epoch"]) for x in self.check_handler.handled]
+        self.assertEqual(len(handled), len(set(handled)))
+        self.assertEqual(
+            len(handled), dwmon._get_rows_from_query("SELECT count(1) FROM checks", ())[0][0])
+
+        # b goes quiet, and once its leases run out a picks its checkers up and catches them up
+        later = self.NOW + 181 + dwmon.config.WORKER_LEASE_SECONDS
+        due = worker_a.run_once(later)
+        self.assertEqual(worker_a.leased, set(checker_names))
+        self.assertEqual(sorted(due), checker_names)
+        for checker_name in checker_names:
+            self.assertEqual(self.checked_minutes(checker_name)[-1], later // 60 * 60)
+
+    def test_release_on_shutdown(self):
+        self.write_config("c", EVERY_MINUTE)
+        dwmon.Scheduler("a").run_once(self.NOW)
+        dwmon.release_leases("a")
+        self.assertEqual(dwmon.acquire_leases("b", ["c"], self.NOW + 60), set(["c"]))
+
+
+class FetchCacheTests(CheckAllTestCase):
+
+    def test_identical_queries_share_a_fetch(self):
+        self.row_getter.rows_by_source = {"SHARED": [(1, 100)]}
+        self.write_config("a", EVERY_MINUTE, source="SHARED")
+        self.write_config("b", EVERY_MINUTE, source="SHARED")
+        self.write_config("c", EVERY_MINUTE, source="OTHER")
+        fetch_cache = dwmon.check_all()
+        self.assertEqual(len(self.row_getter.calls), 2)
+        self.assertEqual((fetch_cache.hits, fetch_cache.misses), (1, 2))
+        self.assertEqual(self.count_results("a"), 1)
+        self.assertEqual(self.count_results("b"), 1)
+        self.assertEqual(len(self.checked_minutes("b")), 10)
+
+    def test_shared_fetch_that_breaks_defers_everyone_sharing_it(self):
+        def rows():
+            yield (1, 100)
+            raise RuntimeError("connection reset")
+
+        getter = self.row_getter.get_rows_from_query
+        self.row_getter.get_rows_from_query = lambda query_details: (
+            rows() if query_details["source"] == "SHARED" else getter(query_details))
+        self.write_config("a", EVERY_MINUTE, source="SHARED")
+        self.write_config("b", EVERY_MINUTE, source="SHARED")
+        self.write_config("c", EVERY_MINUTE, source="OTHER")
+        fetch_cache = dwmon.check_all(current_epoch=1455997920)
+        self.assertEqual(sorted(fetch_cache.deferred), ["a", "b"])
+        self.assertEqual(self.checked_minutes("a"), [])
+        self.assertEqual(len(self.checked_minutes("c")), 10)
+
+    def test_requirement_lines_share_a_fetch(self):
+        fetch_cache = dwmon.FetchCache()
+        query_details = {"query": "SELECT 1", "source": "S"}
+        for lookback in ["60", "120"]:
+            requirements = dwmon.parse_requirements(EVERY_MINUTE.replace("60", lookback))
+            dwmon.do_multiple_history_check("a", query_details, requirements,
+                                            fetch_cache=fetch_cache)
+        self.assertEqual(len(self.row_getter.calls), 1)
+        self.assertEqual((fetch_cache.hits, fetch_cache.misses), (1, 1))
+
+
+class FetchPolicyTests(CheckAllTestCase):
+
+    NOW = 1455997920
+
+    def test_plan_fetch(self):
+        state = {"last_attempt": 1000, "last_success": 1000, "latency_seconds": 30, "failures": 0}
+        self.assertEqual(dwmon.plan_fetch({}, state, 1060), (True, None, None))
+        self.assertEqual(dwmon.plan_fetch({"dwmon_min_fetch_interval_seconds": 300}, None, 1060),
+                         (True, None, None))
+        self.assertEqual(dwmon.plan_fetch({"dwmon_min_fetch_interval_seconds": 300}, state, 1060),
+                         (False, 1000, 1300))
+        self.assertEqual(dwmon.plan_fetch({"dwmon_max_staleness_seconds": 120}, state, 1060),
+                         (False, 1000, 1120))
+        self.assertEqual(dwmon.plan_fetch({"dwmon_max_staleness_seconds": 120}, state, 1120)[0],
+                         True)
+        # 10 times a 30 second query, then doubling per failure, up to the cap
+        adaptive = {"dwmon_adaptive_fetch": True}
+        self.assertEqual(dwmon.plan_fetch(adaptive, state, 1060), (False, 1000, 1300))
+        state.update(last_attempt=1300, failures=2)
+        self.assertEqual(dwmon.plan_fetch(adaptive, state, 1400), (False, 1000, 2500))
+        state.update(failures=5)
+        self.assertEqual(dwmon.plan_fetch(adaptive, state, 1400)[2],
+                         1300 + dwmon.config.FETCH_ADAPTIVE_MAX_INTERVAL_SECONDS)
+
+    def test_min_interval_defers_minutes_until_the_next_fetch(self):
+        self.write_config("a", EVERY_MINUTE, extra='{"dwmon_min_fetch_interval_seconds": 300}')
+        self.row_getter.rows_by_source = {"TEST": [(1, self.NOW - 30)]}
+        dwmon.check_all(current_epoch=self.NOW)
+        self.assertEqual(len(self.row_getter.calls), 1)
+        self.assertEqual(self.checked_minutes("a")[-1], self.NOW)
+
+        fetch_cache = dwmon.check_all(current_epoch=self.NOW + 60)
+        self.assertEqual(len(self.row_getter.calls), 1)
+        self.assertEqual(fetch_cache.deferred, {"a": (set([0]), self.NOW + 300)})
+        self.assertEqual(self.checked_minutes("a")[-1], self.NOW)
+
+        dwmon.check_all(current_epoch=self.NOW + 300)
+        self.assertEqual(len(self.row_getter.calls), 2)
+        self.assertEqual(self.checked_minutes("a")[-5:],
+                         [self.NOW + 60 * i for i in range(1, 6)])
+        self.assertEqual(set(x["fetch_status"] for x in self.check_handler.handled),
+                         set(["FETCHED"]))
+        self.assertEqual(dwmon.get_fetch_state("a")["last_success"], self.NOW + 300)
+
+    def test_max_staleness_waits_for_rows_that_cover_the_minute(self):
+        self.write_config("a", EVERY_MINUTE.replace("60", "120"),
+                          extra='{"dwmon_max_staleness_seconds": 180}')
+        self.row_getter.rows_by_source = {"TEST": [(1, self.NOW - 30)]}
+        dwmon.check_all(current_epoch=self.NOW)
+        self.check_handler.handled = []
+        # Lands in the warehouse after our fetch, so the stored rows would undercount
+        self.row_getter.rows_by_source["TEST"].append((2, self.NOW + 90))
+        fetch_cache = dwmon.check_all(current_epoch=self.NOW + 120)
+        self.assertEqual(len(self.row_getter.calls), 1)
+        self.assertEqual(fetch_cache.deferred, {"a": (set([0]), self.NOW + 180)})
+        self.assertEqual(self.check_handler.handled, [])
+        dwmon.check_all(current_epoch=self.NOW + 180)
+        self.assertEqual(len(self.row_getter.calls), 2)
+        self.assertEqual(
+            sorted((x["minute_epoch"], x["fetch_status"], x["event_count"])
+                   for x in self.check_handler.handled),
+            [(self.NOW + 60 * i, "FETCHED", 1) for i in range(1, 4)])
+
+    def test_failures_back_off_adaptive_checkers(self):
+        self.write_config("a", EVERY_MINUTE, extra='{"dwmon_adaptive_fetch": true}')
+        dwmon.your_orgs_row_getter = FailingRowGetter()
+        fetch_cache = dwmon.check_all(current_epoch=self.NOW)
+        # Tried again at the next wakeup, where the backoff takes over
+        self.assertEqual(fetch_cache.deferred, {"a": (set([0]), self.NOW)})
+        dwmon.check_all(current_epoch=self.NOW + 60)
+        self.assertEqual(dwmon.get_fetch_state("a")["failures"], 1)
+        self.assertEqual(self.checked_minutes("a"), [])
+        # Nothing has ever been fetched, so nothing can be checked until the warehouse is back
+        dwmon.your_orgs_row_getter = self.row_getter
+        fetch_cache = dwmon.check_all(current_epoch=self.NOW + 60)
+        self.assertEqual(fetch_cache.deferred, {"a": (set([0]), self.NOW + 120)})
+        dwmon.check_all(current_epoch=self.NOW + 120)
+        self.assertEqual(dwmon.get_fetch_state("a")["failures"], 0)
+        self.assertEqual(self.checked_minutes("a")[-1], self.NOW + 120)
+
+    def test_scheduler_retries_deferred_lines_when_the_fetch_is_due(self):
+        minute = self.NOW // 60 % 60
+        self.write_config("a", EVERY_MINUTE.replace("0-59", "%d-%d" % (minute, minute + 1)),
+                          extra='{"dwmon_min_fetch_interval_seconds": 300}')
+        scheduler = dwmon.Scheduler()
+        scheduler.run_once(self.NOW)
+        self.assertEqual(scheduler.run_once(self.NOW + 60), {"a": set([0])})
+        self.assertEqual(self.checked_minutes("a"), [self.NOW])
+        self.assertEqual(scheduler.run_once(self.NOW + 240), {})
+        self.assertEqual(scheduler.run_once(self.NOW + 300), {"a": set([0])})
+        self.assertEqual(self.checked_minutes("a"), [self.NOW, self.NOW + 60])
+
+
+class MinuteCountsTests(DatabaseTestCase):
+
+    def minute_counts(self):
+        return dwmon._get_rows_from_query(
+            "SELECT checker, minute_epoch, n, n_on_minute FROM results_minute_counts "
+            "ORDER BY checker, minute_epoch", ())
+
+    def test_kept_in_step_with_inserts_and_purges(self):
+        dwmon.store_results("a", [(1, 120), (2, 150), (3, 179), (4, 180), (5, 240.5)])
+        dwmon.store_results("a", [(1, 120), (6, 181)])
+        self.assertEqual(self.minute_counts(), [
+            ("a", 120, 3, 1), ("a", 180, 2, 1), ("a", 240, 1, 0)])
+        dwmon.delete_old_rows("a", {"delete_older_than_epoch": 181})
+        self.assertEqual(self.minute_counts(), [("a", 180, 1, 0), ("a", 240, 1, 0)])
+
+    def test_rebuild(self):
+        dwmon.store_results("a", [(1, 120), (2, 150)])
+        dwmon.store_results("b", [(1, 60)])
+        expected = self.minute_counts()
+        dwmon._write_query("DELETE FROM results_minute_counts", ())
+        dwmon._write_query("INSERT INTO results_minute_counts VALUES ('a', 0, 7, 7)", ())
+        dwmon.rebuild_minute_counts("a")
+        self.assertEqual(self.minute_counts(), [x for x in expected if x[0] == "a"])
+        dwmon.rebuild_minute_counts()
+        self.assertEqual(self.minute_counts(), expected)
+
+
+class WindowIndexTests(DatabaseTestCase):
+
+    NOW = 1455997920
+    EXTRA = {"dwmon_window_index": True}
+
+    def sql_count(self, lower, upper):
+        rows = dwmon._get_rows_from_query(
+            "SELECT count(1) FROM results WHERE checker = 'a' AND timestamp BETWEEN ? AND ?",
+            (lower, upper))
+        return rows[0][0]
+
+    def assert_matches_sql(self, window_index, lookback, newest_minute):
+        for minute_epoch in range(newest_minute - 20 * 60, newest_minute + 180, 60):
+            count = window_index.count(minute_epoch - lookback, minute_epoch)
+            if count is not None:
+                self.assertEqual(count, self.sql_count(minute_epoch - lookback, minute_epoch))
+
+    def test_agrees_with_sql_through_inserts_and_purges(self):
+        rand = random.Random(3)
+        requirements = [dwmon.parse_requirements(EVERY_MINUTE.replace("60", "300"))]
+        dwmon.store_results("a", [(i, self.NOW - rand.randint(0, 4000)) for i in range(300)])
+        window_index = dwmon.refresh_window_index("a", requirements, self.EXTRA, self.NOW)
+        self.assertIs(dwmon._WINDOW_INDEXES["a"], window_index)
+        self.assert_matches_sql(window_index, 300, self.NOW)
+        # All new, some new, on the minute, late arrivals, and running ahead of the ring
+        now = self.NOW
+        for step in range(6):
+            now += 240
+            new_rows = [(rand.randint(0, 900), now - rand.randint(-60, 900)) for _ in range(80)]
+            new_rows.append((10000 + step, now // 60 * 60))
+            dwmon.store_results("a", new_rows)
+            self.assert_matches_sql(window_index, 300, now // 60 * 60)
+        dwmon.store_results("a", [(20000, now + 7200)])
+        self.assert_matches_sql(window_index, 300, (now + 7200) // 60 * 60)
+        dwmon.delete_old_rows("a", {"delete_older_than_epoch": now + 7200 - 1500})
+        self.assert_matches_sql(window_index, 300, (now + 7200) // 60 * 60)
+        self.assertIsNone(window_index.count(now + 7200 - 1800, now + 7200))
+        self.assertIsNone(window_index.count(now - 30, now + 30))
+
+    def test_used_by_checks_and_dropped_on_rollback(self):
+        requirements = dwmon.parse_requirements(EVERY_MINUTE)
+        dwmon.store_results("a", [(1, self.NOW - 30), (2, self.NOW)])
+        window_index = dwmon.refresh_window_index("a", [requirements], self.EXTRA, self.NOW)
+        window_index.add([self.NOW - 10])  # Only the index knows about this one
+        details = dwmon.do_batched_history_check("a", [self.NOW], requirements)
+        self.assertEqual(details[0]["event_count"], 3)
+        self.assertEqual(dwmon.do_single_history_check("a", self.NOW, requirements)["event_count"], 3)
+        with self.assertRaises(ValueError):
+            with dwmon.transaction():
+                dwmon.store_results("a", [(3, self.NOW)])
+                raise ValueError()
+        self.assertEqual(dwmon._WINDOW_INDEXES, {})
+        self.assertEqual(dwmon.do_single_history_check("a", self.NOW, requirements)["event_count"], 2)
+        dwmon.refresh_window_index("a", [requirements], {}, self.NOW)
+        self.assertEqual(dwmon._WINDOW_INDEXES, {})
+
+
+class HashedKeyTests(DatabaseTestCase):
+
+    def test_hash_is_stable_64_bit(self):
+        self.assertEqual(dwmon.hash_unique_key("abc"), dwmon.hash_unique_key("abc"))
+        self.assertEqual(dwmon.hash_unique_key(123), dwmon.hash_unique_key("123"))
+        self.assertNotEqual(dwmon.hash_unique_key("abc"), dwmon.hash_unique_key("abd"))
+        self.assertTrue(-2 ** 63 <= dwmon.hash_unique_key("abc") < 2 ** 63)
+
+    def test_hashed_storage_dedupes(self):
+        dwmon.store_results("a", [("x" * 80, 100), ("y" * 80, 101)], hashed_keys=True)
+        dwmon.store_results("a", [("x" * 80, 100), ("z" * 80, 102)], hashed_keys=True)
+        self.assertEqual(self.count_results("a"), 3)
+        rows = dwmon._get_rows_from_query(
+            "SELECT count(1) FROM results WHERE unique_id IS NULL", ())
+        self.assertEqual(rows, [(3,)])
+
+    def test_convert_existing_keys(self):
+        dwmon.store_results("a", [(i, 100 + i) for i in range(25)])
+        dwmon.store_results("b", [(1, 100)])
+        # As far as hashed storage can tell, the same key as plain key 3
+        dwmon._write_query(
+            "INSERT INTO results (checker, unique_hash, timestamp) VALUES (?, ?, ?)",
+            ("a", dwmon.hash_unique_key(3), 103))
+        self.assertEqual(dwmon.convert_to_hashed_keys("a", batch_size=10), (24, 1))
+        self.assertEqual(self.count_results("a"), 25)
+        dwmon.store_results("a", [(i, 100 + i) for i in range(30)], hashed_keys=True)
+        self.assertEqual(self.count_results("a"), 30)
+        # Nobody else was touched
+        rows = dwmon._get_rows_from_query(
+            "SELECT unique_id FROM results WHERE checker = 'b'", ())
+        self.assertEqual(rows, [("1",)])
+
+
+class RetentionTests(CheckAllTestCase):
+
+    def test_retention_pass(self):
+        dwmon.config.RETENTION_BATCH_SIZE = 7
+        dwmon.config.CHECKS_RETENTION_SECONDS = 1000
+        self.write_config("a", EVERY_MINUTE)
+        self.write_config("b", EVERY_MINUTE)
+        dwmon.store_results("a", [(i, 1000 + i) for i in range(50)])
+        dwmon.store_results("b", [(i, 1000 + i) for i in range(50)])
+        for minute_epoch in [60, 120, 180]:
+            dwmon.log_check("a", minute_epoch)
+        dwmon.log_check("gone", 60)
+        self.row_purger.epochs_by_checker = {"a": 1030}
+
+        self.assertEqual(dwmon.run_retention(current_epoch=5000),
+                         {"results_deleted": 30, "checks_deleted": 2})
+        self.assertEqual(self.count_results("a"), 20)
+        self.assertEqual(self.count_results("b"), 50)
+        # The latest check survives so we still know where we're up to
+        self.assertEqual(self.checked_minutes("a"), [180])
+        self.assertEqual(self.checked_minutes("gone"), [60])
+
+    @sqlite_only
+    def test_new_databases_vacuum_incrementally(self):
+        rows = dwmon._get_rows_from_query("PRAGMA auto_vacuum", ())
+        self.assertEqual(rows, [(2,)])
+
+    def test_scheduler_runs_retention_on_its_own_schedule(self):
+        dwmon.config.RETENTION_INTERVAL_SECONDS = 600
+        self.write_config("a", EVERY_MINUTE)
+        self.row_purger.epochs_by_checker = {"a": 2000}
+        scheduler = dwmon.Scheduler()
+        now = SchedulerTests.NOW
+        scheduler.run_once(now)
+        dwmon.store_results("a", [(1, 1000)])
+        scheduler.run_once(now + 60)
+        self.assertEqual(self.count_results("a"), 1)
+        scheduler.run_once(now + 600)
+        self.assertEqual(self.count_results("a"), 0)
+
+
+class PartitionTests(CheckAllTestCase):
+
+    DAY = 24 * 3600
+
+    def setUp(self):
+        super(PartitionTests, self).setUp()
+        dwmon.config.RESULTS_PARTITION_SECONDS = self.DAY
+
+    def all_results(self, checker_name):
+        return dwmon._get_event_timestamps(checker_name, 0, 100 * self.DAY)
+
+    def minute_counts(self):
+        return dwmon._get_rows_from_query(
+            "SELECT * FROM results_minute_counts ORDER BY checker, minute_epoch", ())
+
+    def test_rows_land_in_daily_partitions(self):
+        rows = [(i, i * 3600 + 30) for i in range(72)]
+        dwmon.store_results("a", rows)
+        self.assertEqual(dwmon.store_results("a", rows[:10] + [(100, 50)]), 9 * 3600 + 30)
+        self.assertEqual([x[1] for x in dwmon.get_partitions()], [0, self.DAY, 2 * self.DAY])
+        self.assertEqual(self.count_results("a"), 0)
+        self.assertEqual(len(self.all_results("a")), 73)
+        # Only the partitions a window overlaps are looked at
+        self.assertEqual(dwmon._results_tables(self.DAY + 10, self.DAY + 20),
+                         ["results", "results_p%s" % self.DAY])
+        requirements = dwmon.parse_requirements(EVERY_MINUTE.replace("60", "7230"))
+        details = dwmon.do_single_history_check("a", self.DAY + 3660, requirements)
+        self.assertEqual(details["event_count"], 3)
+        expected = self.minute_counts()
+        dwmon.rebuild_minute_counts()
+        self.assertEqual(self.minute_counts(), expected)
+
+    def test_keys_are_unique_across_partitions(self):
+        dwmon.store_results("a", [(1, self.DAY - 30), (2, self.DAY - 20)])
+        # Re-fetched the next day with new timestamps, like a source stamping rows with now
+        dwmon.store_results("a", [(1, self.DAY + 30), (2, self.DAY + 40), (3, self.DAY + 50)])
+        self.assertEqual(self.all_results("a"), [self.DAY - 30, self.DAY - 20, self.DAY + 50])
+        dwmon.store_results("a", [(4, 2 * self.DAY + 10)], True)
+        dwmon.store_results("a", [(4, 3 * self.DAY + 10)], True)
+        self.assertEqual(len(self.all_results("a")), 4)
+
+    def test_moving_an_existing_database_over(self):
+        dwmon.config.RESULTS_PARTITION_SECONDS = None
+        dwmon.store_results("a", [(i, i * 3600) for i in range(48)])
+        expected = self.minute_counts()
+        dwmon.config.RESULTS_PARTITION_SECONDS = self.DAY
+        # Keys still in the original table aren't stored again
+        self.assertEqual(dwmon.store_results("a", [(0, 0), (47, 47 * 3600), (48, 48 * 3600)]),
+                         48 * 3600)
+        self.assertEqual(len(self.all_results("a")), 49)
+        self.assertEqual(dwmon.partition_legacy_results(batch_size=10), 48)
+        self.assertEqual(self.count_results("a"), 0)
+        self.assertEqual(self.all_results("a"), [i * 3600 for i in range(49)])
+        self.assertEqual(self.minute_counts(), expected + [("a", 48 * 3600, 1, 1)])
+
+    def test_retention_drops_whole_partitions(self):
+        dwmon.config.RETENTION_BATCH_SIZE = 5
+        self.write_config("a", EVERY_MINUTE)
+        self.write_config("b", EVERY_MINUTE)
+        for checker_name in ["a", "b", "gone"]:
+            dwmon.store_results(checker_name, [(i, i * 3600) for i in range(72)])
+        # a is done with two days, b with one and a half, and a removed checker doesn't count
+        self.row_purger.epochs_by_checker = {"a": 2 * self.DAY, "b": 36 * 3600}
+        result = dwmon.run_retention(current_epoch=5 * self.DAY)
+        self.assertEqual(result["results_deleted"], 24 + 24 + 24 + 24 + 12)
+        self.assertEqual([x[1] for x in dwmon.get_partitions()], [self.DAY, 2 * self.DAY])
+        self.assertEqual(self.all_results("a"), [i * 3600 for i in range(48, 72)])
+        self.assertEqual(self.all_results("b"), [i * 3600 for i in range(36, 72)])
+        self.assertEqual(len(self.all_results("gone")), 48)
+        self.assertEqual(sum(x[2] for x in self.minute_counts()), 24 + 36 + 48)
+
+
+class BlockingCheckHandler(FakeCheckHandler):
+    """A handler that holds up until released, and fails the first few calls if asked"""
+
+    def __init__(self, failures=0, batches=False):
+        super(BlockingCheckHandler, self).__init__()
+        self.release = threading.Event()
+        self.failures = failures
+        self.batches = []
+        if batches:
+            self.handle_checks = self._handle_checks
+
+    def handle_check(self, details, extra_config):
+        self.release.wait(5)
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError("handler down")
+        self.handled.append(details)
+
+    def _handle_checks(self, batch):
+        self.release.wait(5)
+        self.batches.append(batch)
+        self.handled.extend(x[0] for x in batch)
+
+
+class HandlerDispatchTests(CheckAllTestCase):
+
+    def make_dispatcher(self, handler, workers=1, queue_size=100, max_retries=2,
+                        retry_delay_seconds=0):
+        return handler_dispatch.HandlerDispatcher(
+            handler, workers=workers, queue_size=queue_size, batch_size=10,
+            max_retries=max_retries, retry_delay_seconds=retry_delay_seconds,
+            journal_path=dwmon.config.HANDLER_JOURNAL_PATH,
+            failed_path=dwmon.config.HANDLER_FAILED_PATH)
+
+    def items(self, count, start=0):
+        return [({"checker_name": "a", "minute_epoch": 60 * i}, {}) for i in range(start, count)]
+
+    def test_checks_logged_without_waiting_on_handler(self):
+        dwmon.config.HANDLER_WORKERS = 2
+        handler = BlockingCheckHandler(batches=True)
+        dwmon.your_orgs_check_handler = handler
+        self.write_config("a", EVERY_MINUTE)
+        dwmon.check_all()
+        self.assertEqual(len(self.checked_minutes("a")), 10)
+        self.assertEqual(handler.handled, [])
+        handler.release.set()
+        dwmon.get_handler_dispatcher().join()
+        self.assertEqual(len(handler.handled), 10)
+        self.assertTrue(all(extra == {} for batch in handler.batches for _, extra in batch))
+
+    def test_retries_then_gives_up(self):
+        handler = BlockingCheckHandler(failures=5)
+        handler.release.set()
+        dispatcher = self.make_dispatcher(handler, workers=0)
+        # The first try, and with no retry delay, the second straight after
+        dispatcher.submit(self.items(2))
+        self.assertEqual(handler.handled, [])
+        dispatcher.replay_journal()
+        # The first item fails all 3 tries, the second gets through on its third
+        self.assertEqual([x["minute_epoch"] for x in handler.handled], [60])
+        with open(dwmon.config.HANDLER_FAILED_PATH) as f:
+            failed = [json.loads(x) for x in f]
+        self.assertEqual(failed, [{"details": {"checker_name": "a", "minute_epoch": 0},
+                                   "extra_config": {}}])
+        self.assertEqual(dispatcher.replay_journal(), 0)
+        self.assertFalse(os.path.exists(dwmon.config.HANDLER_JOURNAL_PATH))
+
+    def test_inline_retries_dont_hold_up_checks(self):
+        handler = BlockingCheckHandler(failures=1)
+        handler.release.set()
+        dispatcher = self.make_dispatcher(handler, workers=0, retry_delay_seconds=60)
+        started = time.time()
+        dispatcher.submit(self.items(1))
+        self.assertLess(time.time() - started, 5)
+        self.assertEqual(handler.handled, [])
+        # Not due for a retry yet
+        self.assertEqual(dispatcher.replay_journal(), 0)
+        # It's still in the journal, so it gets another go on the next start
+        self.make_dispatcher(handler, workers=0)
+        self.assertEqual([x["minute_epoch"] for x in handler.handled], [0])
+
+    def test_replay_leaves_uncommitted_entries_alone(self):
+        handler = BlockingCheckHandler()
+        handler.release.set()
+        dispatcher = self.make_dispatcher(handler, workers=0)
+        # Journaled, but their checks aren't committed yet
+        committed = dispatcher.journal(self.items(1))
+        rolled_back = dispatcher.journal(self.items(2, start=1))
+        self.assertEqual(dispatcher.replay_journal(), 0)
+        self.assertEqual(handler.handled, [])
+        dispatcher.discard(rolled_back)
+        dispatcher.enqueue(committed)
+        self.assertEqual(dispatcher.replay_journal(), 0)
+        self.assertEqual([x["minute_epoch"] for x in handler.handled], [0])
+
+    def test_overflow_waits_in_the_journal(self):
+        handler = BlockingCheckHandler(batches=True)
+        dispatcher = self.make_dispatcher(handler, queue_size=5)
+        dispatcher.submit(self.items(30))
+        dispatcher.close(timeout=0)
+        handler.release.set()
+        dispatcher.threads[0].join()
+        # What never got handled comes back with the next dispatcher, just the once
+        dispatcher = self.make_dispatcher(handler, workers=0)
+        self.assertEqual(sorted(x["minute_epoch"] for x in handler.handled),
+                         [60 * i for i in range(30)])
+        self.assertEqual(dispatcher.replay_journal(), 0)
+        self.assertFalse(os.path.exists(dwmon.config.HANDLER_JOURNAL_PATH))
+
+    def test_logged_checks_survive_a_crash(self):
+        dwmon.config.HANDLER_WORKERS = 1
+        handler = BlockingCheckHandler()
+        dwmon.your_orgs_check_handler = handler
+        self.write_config("a", EVERY_MINUTE)
+        dwmon.check_all()
+        # Killed with the handler still stuck on the first batch
+        crashed = dwmon._HANDLER_DISPATCHER
+        crashed.stopping.set()
+        dwmon._HANDLER_DISPATCHER = None
+        dwmon.config.HANDLER_WORKERS = 0
+        dwmon.your_orgs_check_handler = self.check_handler
+        dwmon.get_handler_dispatcher()
+        self.assertEqual(sorted(x["minute_epoch"] for x in self.check_handler.handled),
+                         self.checked_minutes("a"))
+        handler.release.set()
+        crashed.threads[0].join()
+
+    def test_rolled_back_checks_are_crossed_off(self):
+        self.write_config("a", EVERY_MINUTE)
+        original_log_check = dwmon.log_check
+
+        def log_check(checker_name, minute_epoch):
+            logged = original_log_check(checker_name, minute_epoch)
+            if len(self.checked_minutes("a")) == 10:
+                raise RuntimeError("disk full")
+            return logged
+
+        dwmon.log_check = log_check
+        try:
+            dwmon.check_all()
+        finally:
+            dwmon.log_check = original_log_check
+        self.assertEqual(self.checked_minutes("a"), [])
+        self.assertEqual(dwmon.get_handler_dispatcher().replay_journal(), 0)
+        self.assertEqual(self.check_handler.handled, [])
+
+
+class RecommendTests(CheckAllTestCase):
+
+    NOW = 1455997920
+
+    def test_recommendations_match_backfill(self):
+        import backfill
+        import recommend
+        rand = random.Random(7)
+        self.write_config("a", EVERY_MINUTE.replace("MAXNUM20", "MAXNUM2") + "\n"
+                          + EVERY_MINUTE.replace("0-59", "*/10").replace("60", "1800") + "\n"
+                          + EVERY_MINUTE.replace("60", "90"))
+        self.write_config("quiet", EVERY_MINUTE)
+        start_epoch = self.NOW - 6 * 3600
+        dwmon.store_results("a", [(i, rand.randint(start_epoch, self.NOW)) for i in range(3000)])
+        dwmon.store_results("not_configured", [(1, self.NOW)])
+
+        recommendations = recommend.recommend(["a", "quiet"], start_epoch, self.NOW)
+        self.assertEqual([(x["checker_name"], x["line"]) for x in recommendations],
+                         [("a", 1), ("a", 2), ("a", 3), ("quiet", 1)])
+        _, requirements_list, _ = dwmon.parse_config_file("a")
+        for recommendation, requirements in zip(recommendations, requirements_list):
+            lookback = requirements["lookback_seconds"]
+            check_details = backfill.evaluate_history(
+                "a", [requirements], start_epoch + lookback, self.NOW)[0]
+            event_counts = [x["event_count"] for x in check_details]
+            self.assertEqual(recommendation["minutes"], len(event_counts))
+            self.assertEqual(recommendation["current_bad"],
+                             sum(1 for x in check_details if x["check_status"] == "BAD"))
+            self.assertTrue(recommendation["low_count"] <= recommendation["median_count"]
+                            <= recommendation["high_count"] <= max(event_counts))
+            self.assertTrue(recommendation["proposed_bad"] <= 0.02 * len(event_counts) + 1)
+            proposed = dwmon.parse_requirements(recommendation["proposed_requirements"])
+            self.assertEqual((proposed["min_num"], proposed["max_num"]),
+                             (recommendation["proposed_min"], recommendation["proposed_max"]))
+            self.assertEqual(proposed["lookback_seconds"], lookback)
+        self.assertTrue(recommendations[0]["current_bad"] > 0)
+        self.assertEqual(recommendations[3]["proposed_max"], 0)
+
+    def test_propose_bounds(self):
+        import recommend
+        self.assertEqual(recommend.propose_bounds(list(range(101)), 0.05, 0.95, 0), (5, 95))
+        self.assertEqual(recommend.propose_bounds([10] * 50, margin=0.2), (8, 12))
+        self.assertEqual(recommend.propose_bounds([0, 0, 1]), (0, 2))
+
+
+class SnapshotTests(DatabaseTestCase):
+
+    def test_incremental_export(self):
+        import snapshot
+        directory = os.path.join(self.tmp_dir, "snapshot")
+        dwmon.store_results("a", [(i, 1000 + i * 10) for i in range(100)])
+        dwmon.store_results("b", [(1, 1000.5)])
+        self.assertEqual(snapshot.export_snapshot(directory, through_epoch=1500), {"a": 51, "b": 1})
+        # Late rows from before the last export are left for a full one
+        dwmon.store_results("a", [(200, 1001), (201, 5000)])
+        self.assertEqual(snapshot.export_snapshot(directory, through_epoch=6000), {"a": 50, "b": 0})
+        manifest = snapshot.read_manifest(directory)
+        timestamps = snapshot.load_timestamps(directory, "a", manifest)
+        self.assertEqual(list(timestamps), [1000 + i * 10 for i in range(100)] + [5000])
+        self.assertEqual(list(snapshot.load_timestamps(directory, "b")), [1000])
+        self.assertEqual(manifest["checkers"]["a"]["max_timestamp"], 5000)
+        self.assertEqual(snapshot.export_snapshot(directory, through_epoch=6000, full=True),
+                         {"a": 102, "b": 1})
+
+    def test_histogram_matches_counting_every_event(self):
+        import snapshot
+        rand = random.Random(11)
+        timestamps = sorted(rand.randint(0, 30 * 86400) for _ in range(2000))
+        for kind, get_key in snapshot.HISTOGRAM_KINDS.items():
+            lower = 5 * 86400 + 17
+            expected = {}
+            for timestamp in timestamps:
+                if timestamp >= lower:
+                    key = get_key[1](timestamp)
+                    expected[key] = expected.get(key, 0) + 1
+            self.assertEqual(snapshot.histogram(timestamps, kind, lower), expected)
+        time_struct = time.gmtime(1455997920)
+        self.assertEqual(snapshot._day_of_week(1455997920), int(time.strftime("%w", time_struct)))
+
+
+class BenchmarkTests(unittest.TestCase):
+
+    def test_cycle_benchmark_runs(self):
+        import benchmark
+        old_db_name = dwmon.DB_NAME
+        results = benchmark.bench_cycle(2, 2, 500, 1)
+        self.assertEqual(dwmon.DB_NAME, old_db_name)
+        self.assertEqual(results["num_rows"], 500)
+        self.assertEqual(
+            sorted(results["seconds"]),
+            ["check_all_catch_up", "check_all_steady_state", "do_multiple_history_check",
+             "generate_source_rows", "handler_drain", "retention", "store_results"])
+        self.assertTrue(results["checks_after_catch_up"] > 0)
+
+    def test_cycle_benchmark_runs_in_memory(self):
+        import benchmark
+        results = benchmark.bench_cycle(2, 2, 500, 1, storage_engine="memory")
+        self.assertEqual(dwmon.config.STORAGE_ENGINE, "sqlite")
+        self.assertEqual(results["storage_engine"], "memory")
+        self.assertTrue(results["checks_after_catch_up"] > 0)
+        self.assertTrue(results["retention_results_deleted"] > 0)
+
+
+class MetricsTests(CheckAllTestCase):
+
+    def setUp(self):
+        super(MetricsTests, self).setUp()
+        metrics.reset()
+
+    def test_cycle_is_instrumented(self):
+        self.row_getter.rows_by_source = {"TEST": [(1, 100), (2, 100), (1, 100)]}
+        self.write_config("a", EVERY_MINUTE)
+        dwmon.check_all()
+        self.assertEqual(metrics.get_counter("rows_fetched", checker="a"), 3)
+        self.assertEqual(metrics.get_counter("rows_inserted", checker="a"), 2)
+        self.assertEqual(metrics.get_counter("duplicates_skipped", checker="a"), 1)
+        self.assertEqual(metrics.get_counter("checks_run", checker="a", status="GOOD"), 10)
+        rendered = metrics.render()
+        for phase in ["config_load", "schedule", "store", "count", "handler", "log_check"]:
+            self.assertTrue('phase="%s",checker="a"' % phase in rendered, phase)
+        self.assertTrue('dwmon_phase_runs_total{phase="fetch",checker="a",source="TEST"} 1'
+                        in rendered)
+        self.assertTrue('dwmon_checks_run_total{checker="a",status="GOOD"} 10' in rendered)
+
+    def test_labels_are_escaped(self):
+        metrics.increment("odd", checker='say "hi"\n')
+        self.assertTrue('dwmon_odd_total{checker="say \\"hi\\"\\n"} 1' in metrics.render())
+
+    def test_exports(self):
+        metrics.observe("cycle", 1.5)
+        path = os.path.join(self.tmp_dir, "dwmon.prom")
+        metrics.write_textfile(path)
+        with open(path) as f_handle:
+            self.assertTrue('dwmon_phase_last_seconds{phase="cycle"} 1.5' in f_handle.read())
+
+        server = metrics.serve(0)
+        try:
+            url = "http://127.0.0.1:%s/metrics" % server.server_address[1]
+            body = urllib.request.urlopen(url).read().decode("utf-8")
+            self.assertEqual(body, metrics.render())
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class BackfillTests(DatabaseTestCase):
+
+    def test_matches_single_checks_and_writes_nothing(self):
+        import backfill
+        rand = random.Random(5)
+        base = 1455997920
+        dwmon.store_results("a", [(i, base - rand.randint(0, 4 * 3600)) for i in range(400)])
+        requirements_list = [
+            dwmon.parse_requirements(EVERY_MINUTE.replace("60", "600")),
+            dwmon.parse_requirements(
+                "CHECKHOURS0-23 CHECKMINUTES*/15 WEEKDAYS WEEKENDS MINNUM10 MAXNUM30 "
+                "LOOKBACKSECONDS1800"),
+        ]
+        start_epoch = base - 3 * 3600
+        results = backfill.evaluate_history("a", requirements_list, start_epoch, base)
+        self.assertEqual(len(results[0]), 181)
+        self.assertEqual(len(results[1]), 12)
+        for requirements, check_details in zip(requirements_list, results):
+            expected = [
+                dwmon.do_single_history_check("a", x["minute_epoch"], requirements)
+                for x in check_details
+            ]
+            self.assertEqual(check_details, expected)
+        self.assertEqual(dwmon.get_time_of_most_recent_check("a"), None)
+
+    def test_summary(self):
+        import backfill
+        details = [{"event_count": x, "check_status": "BAD" if x > 2 else "GOOD"}
+                   for x in [1, 3, 4, 2, 5]]
+        summary = backfill.summarize(details)
+        self.assertEqual((summary["good"], summary["bad"], summary["bad_runs"]), (2, 3, 2))
+        self.assertEqual(summary["median_count"], 3)
+
+
+class MemoryStoreResultsTests(StoreResultsTests):
+    STORAGE_ENGINE = "memory"
+
+
+class MemoryBatchedHistoryCheckTests(BatchedHistoryCheckTests):
+    STORAGE_ENGINE = "memory"
+
+
+class MemoryStreamingStoreTests(StreamingStoreTests):
+    STORAGE_ENGINE = "memory"
+
+
+class MemoryCheckAllTests(CheckAllTests):
+    STORAGE_ENGINE = "memory"
+
+
+class MemorySchedulerTests(SchedulerTests):
+    STORAGE_ENGINE = "memory"
+
+
+class MemoryIncrementalFetchTests(IncrementalFetchTests):
+    STORAGE_ENGINE = "memory"
+
+
+class MemoryFetchPolicyTests(FetchPolicyTests):
+    STORAGE_ENGINE = "memory"
+
+
+class MemoryRetentionTests(RetentionTests):
+    STORAGE_ENGINE = "memory"